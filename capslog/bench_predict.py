@@ -0,0 +1,74 @@
+import sys
+import time
+import random
+import numpy as np
+from calc_mem_stats import generate_partitionings, predict, mem_stats_to_arrays, predict_batch
+
+# Generate random memory statistics in the same format as average_results() outputs.
+# Shapes:
+#   random: independent uniformly random statistics per layer.
+#   transformer: identical layers, with a little noise.
+#   embedding: like transformer, but the first and last layers (the embedding
+#       and the output layer) are much larger.
+#   conv: memory usage decreases over the layers, like in a CNN where the
+#       activations get smaller deeper in the network.
+def random_mem_stats(n_layers, seed=0, shape="random"):
+    GB = 1024**3
+    rng = random.Random(seed)
+    mem_stats = {}
+    for layer in range(n_layers):
+        if shape == "random":
+            isolated = rng.randint(GB, 2*GB)
+            added = rng.randint(GB // 10, GB // 2) if layer != 0 else None
+        elif shape == "transformer":
+            isolated = GB + rng.randint(0, GB // 100)
+            added = GB // 4 + rng.randint(0, GB // 100)
+        elif shape == "embedding":
+            factor = 8 if layer in (0, n_layers - 1) else 1
+            isolated = factor * GB + rng.randint(0, GB // 100)
+            added = factor * GB // 4 + rng.randint(0, GB // 100)
+        elif shape == "conv":
+            factor = 1 - layer / n_layers
+            isolated = GB // 2 + int(factor * 2 * GB) + rng.randint(0, GB // 100)
+            added = GB // 20 + int(factor * GB // 2) + rng.randint(0, GB // 100)
+        else:
+            raise NotImplementedError
+
+        mem_stats[layer] = {"mem_isolated": isolated, "mem_added": None if layer == 0 else added}
+    return mem_stats
+
+# Compares the time it takes to predict the peak memory usage of all possible
+# partitionings with predict() (one partitioning at a time) and with
+# predict_batch() (all partitionings at once), and checks that both agree.
+def main(n_layers, n_gpus):
+    print("Benchmarking for", n_gpus, "gpus and", n_layers, "layers")
+    mem_stats = random_mem_stats(n_layers)
+    partitionings = np.array(list(generate_partitionings(n_layers, n_gpus)), dtype=np.int64)
+    print("Number of partitionings:", len(partitionings))
+
+    start = time.time()
+    peaks_loop = [max(predict(p, mem_stats)) for p in partitionings.tolist()]
+    time_loop = time.time() - start
+
+    start = time.time()
+    mem_arrays = mem_stats_to_arrays(mem_stats, n_layers)
+    predictions, peaks_batch = predict_batch(partitionings, mem_arrays)
+    time_batch = time.time() - start
+
+    assert peaks_loop == peaks_batch.tolist()
+
+    print("predict() took (s)", time_loop)
+    print("predict_batch() took (s)", time_batch)
+    print("Speedup:", time_loop / time_batch)
+
+if __name__ == "__main__":
+    n_layers = 24
+    n_gpus = 8
+
+    if len(sys.argv) > 1:
+        n_layers = int(sys.argv[1])
+
+    if len(sys.argv) > 2:
+        n_gpus = int(sys.argv[2])
+
+    main(n_layers, n_gpus)
@@ -0,0 +1,195 @@
+import os
+import sys
+import json
+import math
+import time
+import signal
+import tracemalloc
+import multiprocessing
+from queue import Empty
+import numpy as np
+from calc_mem_stats import find_balanced_partitioning, mem_stats_to_arrays
+from bench_predict import random_mem_stats
+
+# Benchmark of the predictors of find_balanced_partitioning() on synthetic
+# memory statistics. For every shape, number of layers and number of GPUs,
+# the wall time, the peak memory usage (of Python and NumPy allocations,
+# measured with tracemalloc) and the optimality gap of each predictor are
+# recorded. The gap is how much higher the predicted peak is than the lowest
+# possible peak:
+#   gap = peak / optimal peak - 1
+# Every predictor runs in its own process, so it can be stopped after
+# 'timeout' seconds. The memory usage of 'bf_parallel' is that of its main
+# process only, not of its worker processes.
+
+predictors = ['bf', 'bf_stream', 'bf_parallel', 'bo', 'bs', 'bs_tb', 'bb', 'dp']
+
+# The brute-force predictors are skipped if there are more partitionings than this.
+max_partitionings = 10**6
+
+timeout = 60
+
+sweeps = {
+    "quick": {"n_layers": [24, 48, 96], "n_gpus": [2, 4, 8]},
+    "full": {"n_layers": [24, 96, 250, 500, 1000], "n_gpus": [2, 8, 32, 128]},
+}
+
+# The lowest possible peak memory usage over all partitionings, found with
+# dynamic programming on the peak only (no tie-breaker), which is fast
+# enough to be used as the reference for large numbers of layers and GPUs.
+def get_optimal_peak(mem_arrays, n_layers, n_gpus):
+    mem_isolated, added_prefix = mem_arrays
+    # best[end]: lowest peak of placing layers [end, n_layers) on the remaining GPUs.
+    best = np.full(n_layers + 1, np.inf)
+    best[n_layers] = 0
+    for g in range(1, n_gpus + 1):
+        new_best = np.full(n_layers + 1, np.inf)
+        for start in range(n_gpus - g, n_layers - g + 1):
+            ends = np.arange(start + 1, n_layers - g + 2)
+            stage = mem_isolated[start] + added_prefix[ends] - added_prefix[start+1]
+            new_best[start] = np.maximum(stage, best[ends]).min()
+        best = new_best
+    return int(best[0])
+
+def should_skip(predictor, n_layers, n_gpus):
+    if predictor in ("bf", "bf_stream", "bf_parallel") and math.comb(n_layers - 1, n_gpus - 1) > max_partitionings:
+        return True
+    if predictor == "bo" and n_gpus < 2:
+        return True
+    return False
+
+def run_predictor(queue, mem_stats, n_layers, n_gpus, predictor):
+    # In its own process group, so that the worker processes of 'bf_parallel'
+    # are stopped with it on a timeout.
+    os.setpgrp()
+    try:
+        tracemalloc.start()
+        start = time.time()
+        result = find_balanced_partitioning(mem_stats, n_layers, n_gpus, predictor, verbose=False)
+        wall_time = time.time() - start
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        queue.put({"status": "ok", "peak": result["peak"], "wall_time": wall_time, "memory": peak_memory})
+    except ImportError as e:
+        queue.put({"status": "unavailable", "error": str(e)})
+    except Exception as e:
+        queue.put({"status": "error", "error": repr(e)})
+
+# Run a predictor in a separate process. Returns a dict with the status
+# ('ok', 'timeout', 'unavailable' or 'error') and, if it finished, the
+# peak, wall time and memory usage, or else the reason it failed.
+def benchmark_predictor(mem_stats, n_layers, n_gpus, predictor):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_predictor, args=(queue, mem_stats, n_layers, n_gpus, predictor))
+    process.start()
+    process.join(timeout)
+
+    if process.is_alive():
+        os.killpg(process.pid, signal.SIGTERM)
+        process.join()
+        return {"status": "timeout"}
+
+    try:
+        return queue.get(timeout=1)
+    except Empty:
+        return {"status": "error", "error": "exited with code {}".format(process.exitcode)}
+
+def run(sweep, shapes=("transformer", "embedding", "conv")):
+    results = []
+    # Predictors that timed out for a shape and number of GPUs are not run
+    # for more layers.
+    timed_out = set()
+
+    for shape in shapes:
+        for n_gpus in sweep["n_gpus"]:
+            for n_layers in sweep["n_layers"]:
+                if n_gpus > n_layers:
+                    continue
+                mem_stats = random_mem_stats(n_layers, shape=shape)
+                optimal_peak = get_optimal_peak(mem_stats_to_arrays(mem_stats, n_layers), n_layers, n_gpus)
+
+                for predictor in predictors:
+                    if should_skip(predictor, n_layers, n_gpus) or (shape, n_gpus, predictor) in timed_out:
+                        result = {"status": "skipped"}
+                    else:
+                        result = benchmark_predictor(mem_stats, n_layers, n_gpus, predictor)
+
+                    if result["status"] == "timeout":
+                        timed_out.add((shape, n_gpus, predictor))
+                    if result["status"] == "ok":
+                        result["gap"] = result["peak"] / optimal_peak - 1
+
+                    result.update({"shape": shape, "n_layers": n_layers, "n_gpus": n_gpus,
+                                   "predictor": predictor, "optimal_peak": optimal_peak})
+                    results.append(result)
+                    print_benchmark_result(result)
+
+    return results
+
+def print_benchmark_result(result):
+    line = "{:<12} L={:<5} G={:<4} {:<12} {:<11}".format(result["shape"], result["n_layers"], result["n_gpus"],
+                                                     result["predictor"], result["status"])
+    if result["status"] == "ok":
+        line += " time (s): {:.4f}  memory (MB): {:.1f}  gap: {:.4%}".format(
+            result["wall_time"], result["memory"] / 1024**2, result["gap"])
+    elif "error" in result:
+        line += " " + result["error"]
+    print(line, flush=True)
+
+def save_results(results, filename):
+    with open(filename, 'w') as f:
+        json.dump(results, f, indent=1)
+
+def load_results(filename):
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+# Report the benchmarks that got slower by more than 'tolerance' times, or
+# that got a larger optimality gap, compared to a baseline.
+# Returns the number of regressions.
+def compare_results(baseline, results, tolerance=1.5):
+    def key(r):
+        return (r["shape"], r["n_layers"], r["n_gpus"], r["predictor"])
+
+    baseline = {key(r): r for r in baseline}
+    n_regressions = 0
+    for r in results:
+        old = baseline.get(key(r))
+        if old is None or old["status"] != "ok":
+            continue
+
+        if r["status"] != "ok":
+            print("REGRESSION:", key(r), "was ok, now", r["status"])
+            n_regressions += 1
+            continue
+
+        if r["wall_time"] > tolerance * old["wall_time"] and r["wall_time"] > 0.01:
+            print("REGRESSION:", key(r), "time (s)", old["wall_time"], "->", r["wall_time"])
+            n_regressions += 1
+
+        if r["gap"] > old["gap"] + 1e-9:
+            print("REGRESSION:", key(r), "gap", old["gap"], "->", r["gap"])
+            n_regressions += 1
+
+    print(n_regressions, "regressions")
+    return n_regressions
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python3 bench_predictors.py run <results.json> [quick/full]")
+        print("       python3 bench_predictors.py compare <baseline.json> <results.json>")
+        sys.exit()
+
+    if sys.argv[1] == "run":
+        sweep = sweeps["quick"]
+        if len(sys.argv) > 3:
+            sweep = sweeps[sys.argv[3]]
+        results = run(sweep)
+        save_results(results, sys.argv[2])
+
+    elif sys.argv[1] == "compare":
+        n_regressions = compare_results(load_results(sys.argv[2]), load_results(sys.argv[3]))
+        sys.exit(1 if n_regressions > 0 else 0)
+
+    else:
+        raise NotImplementedError
@@ -0,0 +1,399 @@
+import os
+import sys
+import json
+import random
+import importlib.util
+from collections import defaultdict
+from calc_mem_stats import do_completeness_check, average_results, find_balanced_partitioning
+
+# Per-layer memory statistics from allocator snapshots at the CutPoint
+# boundaries (Varuna(..., boundary_allocator=torch.cuda), written to the
+# telemetry file), instead of from differences between dozens of profiling runs.
+# A single run in which every layer is on a profiled stage gives all statistics.
+#
+# From the snapshots of a stage, the following terms are derived per layer l:
+#   static: parameter, gradient and optimizer memory, the memory allocated
+#       at the start of the step split over the layers by parameter size.
+#   in: the input activations of l for one micro-batch.
+#   act: the activations l keeps for the backward pass (recompute or forward with grad).
+#   tf, tb: the transient peak while running l forward and backward, on top
+#       of the memory allocated when l started.
+#   n_stashed: the number of micro-batches whose stage input is stashed at
+#       the peak (in flight), which depends on the position of the profiled stage.
+# The peak memory usage of a stage [a, b) is then modelled as
+#   sum(static) + (n_stashed + 1) * in[a] + max over l in [a, b) of
+#       max(act[a] + ... + act[l-1] + tf[l], act[a] + ... + act[l] + tb[l])
+# (without recomputation, all activations of the stashed micro-batches are
+# kept as well), which gives mem isolated and mem added. The statistics are
+# approximate: they hold for the position at which the layer was profiled,
+# and allocations by the communication threads are attributed to the layer
+# that runs at the time.
+
+# Read the boundary snapshots of the last iteration of every profiled stage.
+# Out args (per profiled stage):
+#   start, end: the layers [start, end) of the stage.
+#   layer_params: parameter memory per layer.
+#   snapshots: [phase, cut, allocated, peak] (see varuna/boundary_snapshots.py).
+#   peak: the peak allocated memory of that iteration, as reported by the stage.
+def read_boundary_telemetry(telemetry_filename):
+    stages = []
+    current = {}
+    with open(telemetry_filename, 'r') as f:
+        for line in f:
+            if not line.endswith("\n"):
+                # The last record is still being written.
+                break
+            record = json.loads(line)
+            key = (record["run_id"], record.get("rank"))
+
+            # A stage is (re)initialized for every partitioning.
+            if record["type"] == "layer_params":
+                current[key] = {"start": record["start"], "end": record["end"],
+                                "layer_params": {int(l): p for l, p in record["layer_params"].items()},
+                                "snapshots": None, "iteration": None, "peaks": {}}
+                stages.append(current[key])
+            elif key not in current:
+                continue
+            elif record["type"] == "boundaries":
+                current[key]["snapshots"] = record["snapshots"]
+                current[key]["iteration"] = record["iteration"]
+            elif record["type"] == "memory":
+                current[key]["peaks"][record["iteration"]] = record["peak_allocated"]
+
+    profiled = []
+    for stage in stages:
+        if stage["snapshots"] is None:
+            continue
+        stage["peak"] = stage["peaks"].get(stage["iteration"])
+        profiled.append(stage)
+    return profiled
+
+# Split the snapshots into the passes over the stage, per phase.
+# Every pass is {cut: (allocated, peak)}, with the "entry" and "exit" of the pass.
+def split_passes(snapshots):
+    passes = defaultdict(list)
+    current = None
+    for phase, cut, allocated, peak in snapshots:
+        if cut == "entry":
+            current = {}
+            passes[phase].append(current)
+        if current is None:
+            continue
+        current[cut] = (allocated, peak)
+        if cut == "exit":
+            current = None
+    return passes
+
+# Largest number of micro-batches that were run forward but not yet backward
+# on the stage, from the order of the passes.
+def get_max_in_flight(snapshots):
+    in_flight = 0
+    max_in_flight = 0
+    for phase, cut, _, _ in snapshots:
+        if cut != "entry":
+            continue
+        if phase == "forward":
+            in_flight += 1
+        elif phase == "backward":
+            in_flight -= 1
+        max_in_flight = max(max_in_flight, in_flight)
+    return max_in_flight
+
+# The snapshot at a cut. The first stage has no CutPoint before its first
+# layer and the last stage none after its last layer, there the entry or exit of the pass is used.
+def at_cut(p, cut, fallback):
+    return p[cut] if cut in p else p[fallback]
+
+# Derive the per-layer terms (see the top of this file) of a profiled stage.
+# Returns {layer: {"static", "in", "act", "tf", "tb", "n_stashed", "recompute"}}.
+def derive_layer_terms(stage):
+    start, end = stage["start"], stage["end"]
+    layers = range(start, end)
+    passes = split_passes(stage["snapshots"])
+    recompute = len(passes["recompute"]) > 0
+    # the passes that keep activations for the backward pass, and their backward passes (in order)
+    grad_passes = passes["recompute"] if recompute else passes["forward"]
+
+    terms = {l: {"act": 0, "tf": 0, "tb": 0, "in": 0} for l in layers}
+    for g, b in zip(grad_passes, passes["backward"]):
+        for l in layers:
+            allocated = at_cut(g, l, "entry")[0]
+            allocated_next, peak_next = at_cut(g, l+1, "exit")
+            terms[l]["act"] = max(terms[l]["act"], allocated_next - allocated)
+            terms[l]["tf"] = max(terms[l]["tf"], peak_next - allocated)
+
+            # Backward of l runs from the boundary after it (or the entry) to the boundary before it.
+            peak = at_cut(b, l, "exit")[1]
+            if l == end - 1 and end in b:
+                peak = max(peak, b[end][1]) # receiving the gradients
+            terms[l]["tb"] = max(terms[l]["tb"], peak - allocated_next)
+
+    # The stage input, received at the CutPoint before the first layer.
+    for g in grad_passes:
+        terms[start]["in"] = max(terms[start]["in"], at_cut(g, start, "entry")[0] - g["entry"][0])
+    # Without grad, the forward pass keeps only the stage input and the input of the running layer.
+    if recompute:
+        for p in passes["forward"]:
+            for l in range(start + 1, end):
+                terms[l]["in"] = max(terms[l]["in"], at_cut(p, l, "entry")[0] - at_cut(p, start, "entry")[0])
+
+    all_passes = [p for phase_passes in passes.values() for p in phase_passes]
+    static = min(p["entry"][0] for p in all_passes)
+    # With recomputation, the input of the micro-batch that is recomputed is stashed as well.
+    n_stashed = get_max_in_flight(stage["snapshots"])
+    if not recompute:
+        n_stashed = max(n_stashed - 1, 0)
+
+    total_params = sum(stage["layer_params"].get(l, 0) for l in layers)
+    for l in layers:
+        share = stage["layer_params"].get(l, 0) / total_params if total_params > 0 else 1 / len(layers)
+        terms[l].update({"static": static * share, "n_stashed": n_stashed, "recompute": recompute})
+    return terms
+
+# Merge the terms of the profiled stages. If a layer was profiled more than
+# once, the largest of each term is used.
+def merge_layer_terms(stages):
+    merged = {}
+    for stage in stages:
+        for layer, terms in derive_layer_terms(stage).items():
+            if layer not in merged:
+                merged[layer] = dict(terms)
+                continue
+            for term in ("static", "in", "act", "tf", "tb", "n_stashed"):
+                merged[layer][term] = max(merged[layer][term], terms[term])
+    return merged
+
+# Predicted peak memory usage of a stage with layers [a, b).
+def predict_stage_peak(terms, a, b):
+    first = terms[a]
+    stashed_size = first["in"]
+    if not first["recompute"]:
+        stashed_size += sum(terms[l]["act"] for l in range(a, b))
+
+    peak = 0
+    acts = 0
+    for l in range(a, b):
+        peak = max(peak, acts + terms[l]["tf"])
+        acts += terms[l]["act"]
+        peak = max(peak, acts + terms[l]["tb"])
+    static = sum(terms[l]["static"] for l in range(a, b))
+    return int(round(static + first["n_stashed"] * stashed_size + first["in"] + peak))
+
+# Statistics in the format of get_mem_stats(). Mem added of a layer is taken
+# with the stage starting at the first layer of the stage the layer was
+# profiled on, like it would be measured, or at the layer before if it was the first.
+def get_boundary_mem_stats(stages, n_layers):
+    terms = merge_layer_terms(stages)
+    results = {}
+    for layer in range(n_layers):
+        results[layer] = {"mem_isolated": [], "mem_added": None if layer == 0 else []}
+
+    for stage in stages:
+        for layer in range(stage["start"], stage["end"]):
+            results[layer]["mem_isolated"].append(predict_stage_peak(terms, layer, layer + 1))
+            prev_cut = stage["start"] if layer > stage["start"] else layer - 1
+            if layer == 0 or prev_cut not in terms:
+                continue
+            results[layer]["mem_added"].append(predict_stage_peak(terms, prev_cut, layer + 1) -
+                                               predict_stage_peak(terms, prev_cut, layer))
+    return results, terms
+
+# Largest difference between the modelled and the reported peak memory usage
+# of the profiled stages, relative to the reported peak.
+def get_max_model_error(stages, terms):
+    max_error = 0.0
+    for stage in stages:
+        if stage["peak"] is None or stage["peak"] == 0:
+            continue
+        error = abs(predict_stage_peak(terms, stage["start"], stage["end"]) - stage["peak"]) / stage["peak"]
+        max_error = max(max_error, error)
+    return max_error
+
+# Find the best memory-balanced partitioning from the boundary snapshots in a telemetry file.
+# Returns the result of find_balanced_partitioning().
+def predict_from_boundaries(telemetry_filename, n_gpus, predictor='dp'):
+    stages = read_boundary_telemetry(telemetry_filename)
+    n_layers = max(stage["end"] for stage in stages)
+    results, terms = get_boundary_mem_stats(stages, n_layers)
+    print("Profiled stages:", [(stage["start"], stage["end"]) for stage in stages])
+    print("Largest relative error of the modelled stage peaks:", get_max_model_error(stages, terms))
+
+    do_completeness_check(results, n_layers)
+    results = average_results(results)
+    return find_balanced_partitioning(results, n_layers, n_gpus, predictor)
+
+# Simulation on CPU, to test the recording (varuna/boundary_snapshots.py)
+# and the derivation without GPUs.
+
+# Allocator backend with the counters of torch.cuda, driven by malloc() and free().
+class FakeAllocator:
+    def __init__(self):
+        self.allocated = 0
+        self.peak = 0
+        # the caching allocator keeps what it reserved
+        self.reserved = 0
+
+    def malloc(self, size):
+        self.allocated += size
+        self.peak = max(self.peak, self.allocated)
+        self.reserved = max(self.reserved, self.allocated)
+
+    def free(self, size):
+        self.allocated -= size
+
+    def memory_allocated(self):
+        return self.allocated
+
+    def max_memory_allocated(self):
+        return self.peak
+
+    def max_memory_reserved(self):
+        return self.reserved
+
+    def reset_peak_memory_stats(self):
+        self.peak = self.allocated
+
+# Varuna's BoundarySnapshots, loaded from the file so that the varuna package
+# (which needs torch) is not imported.
+def load_boundary_snapshots():
+    filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "varuna", "boundary_snapshots.py")
+    spec = importlib.util.spec_from_file_location("boundary_snapshots", filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.BoundarySnapshots
+
+# Random layers with the sizes of the terms (see the top of this file).
+# in[l] is the output of layer l-1, and a layer keeps at least its output.
+def generate_layers(n_layers, seed=0):
+    rng = random.Random(seed)
+    MB = 1024**2
+    layers = {"params": [], "in": [0], "act": [], "tf": [], "tb": []}
+    for l in range(n_layers):
+        out = 0 if l == n_layers - 1 else rng.randint(8, 64) * MB
+        layers["in"].append(out)
+        layers["params"].append(rng.randint(10, 400) * MB)
+        layers["act"].append(out + rng.randint(0, 256) * MB)
+        layers["tf"].append(rng.randint(0, 128) * MB)
+        layers["tb"].append(rng.randint(0, 256) * MB)
+    return layers
+
+# Simulate a step of a stage with layers [start, end) under Varuna's schedule
+# with recomputation, recording the boundary snapshots like a Varuna stage does.
+# The stage input of n_stashed micro-batches is kept until their backward pass.
+def simulate_stage(recorder, allocator, layers, start, end, n_layers, n_microbatches, n_stashed):
+    first = start == 0
+    last = end == n_layers
+    n_stashed = min(max(n_stashed, 1), n_microbatches)
+    allocator.malloc(sum(layers["params"][start:end]))
+
+    def run_layers(phase, keep_activations):
+        recorder.snapshot(phase, "entry")
+        if not first:
+            allocator.malloc(layers["in"][start])
+            recorder.snapshot(phase, start)
+        for l in range(start, end):
+            if l > start:
+                recorder.snapshot(phase, l)
+            if keep_activations:
+                allocator.malloc(layers["act"][l])
+            else:
+                allocator.malloc(layers["in"][l+1])
+            allocator.malloc(layers["tf"][l])
+            allocator.free(layers["tf"][l])
+            if not keep_activations and l > start:
+                allocator.free(layers["in"][l])
+        if not keep_activations:
+            # the output is sent, the stage input is stashed
+            allocator.free(layers["in"][end])
+        if not last:
+            recorder.snapshot(phase, end)
+        recorder.snapshot(phase, "exit")
+
+    def backward():
+        recorder.snapshot("backward", "entry")
+        if not last:
+            recorder.snapshot("backward", end)
+        for l in reversed(range(start, end)):
+            allocator.malloc(layers["tb"][l])
+            allocator.free(layers["tb"][l])
+            allocator.free(layers["act"][l])
+            if l > start or not first:
+                recorder.snapshot("backward", l)
+        # the recomputed and the stashed input
+        allocator.free(2 * layers["in"][start])
+        recorder.snapshot("backward", "exit")
+
+    n_forward = 0
+    for _ in range(n_stashed):
+        run_layers("forward", False)
+        n_forward += 1
+    for _ in range(n_microbatches):
+        run_layers("recompute", True)
+        backward()
+        if n_forward < n_microbatches:
+            run_layers("forward", False)
+            n_forward += 1
+
+# Simulate a profiling run of a partitioning (the first layer of each stage),
+# in the format of read_boundary_telemetry().
+def simulate_run(layers, partitioning, n_microbatches):
+    BoundarySnapshots = load_boundary_snapshots()
+    n_layers = len(layers["params"])
+    ends = list(partitioning[1:]) + [n_layers]
+    stages = []
+    for position, (start, end) in enumerate(zip(partitioning, ends)):
+        allocator = FakeAllocator()
+        recorder = BoundarySnapshots(allocator)
+        simulate_stage(recorder, allocator, layers, start, end, n_layers, n_microbatches,
+                       len(partitioning) - position)
+        snapshots, (peak, _) = recorder.pop()
+        stages.append({"start": start, "end": end, "snapshots": snapshots, "peak": peak,
+                       "layer_params": {l: layers["params"][l] for l in range(start, end)}})
+    return stages
+
+# Peak of a stage [a, b) in the simulation, with as many stashed micro-batches
+# as the profiled stage that a is on.
+def simulate_stage_peak(layers, a, b, n_microbatches, n_stashed):
+    allocator = FakeAllocator()
+    recorder = load_boundary_snapshots()(allocator)
+    simulate_stage(recorder, allocator, layers, a, b, len(layers["params"]), n_microbatches, n_stashed)
+    return recorder.pop()[1][0]
+
+# Profile a simulated model with one run and compare the derived statistics
+# to the simulated peaks of the stages they describe.
+# Returns the largest relative error.
+def check_simulation(n_layers, n_gpus, n_microbatches=8, seed=0):
+    layers = generate_layers(n_layers, seed)
+    partitioning = [n_layers * s // n_gpus for s in range(n_gpus)]
+    stages = simulate_run(layers, partitioning, n_microbatches)
+    results, terms = get_boundary_mem_stats(stages, n_layers)
+    print("Largest relative error of the modelled stage peaks:", get_max_model_error(stages, terms))
+
+    max_error = 0.0
+    for stage in stages:
+        for layer in range(stage["start"], stage["end"]):
+            n_stashed = terms[layer]["n_stashed"]
+            expected = simulate_stage_peak(layers, layer, layer + 1, n_microbatches, n_stashed)
+            max_error = max(max_error, abs(results[layer]["mem_isolated"][0] - expected) / expected)
+            if layer == 0:
+                continue
+            prev_cut = stage["start"] if layer > stage["start"] else layer - 1
+            n_stashed = terms[prev_cut]["n_stashed"]
+            expected = simulate_stage_peak(layers, prev_cut, layer + 1, n_microbatches, n_stashed) - \
+                simulate_stage_peak(layers, prev_cut, layer, n_microbatches, n_stashed)
+            reference = simulate_stage_peak(layers, prev_cut, layer + 1, n_microbatches, n_stashed)
+            max_error = max(max_error, abs(results[layer]["mem_added"][0] - expected) / reference)
+
+    print("Largest relative error of the derived statistics:", max_error)
+    return max_error
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4:
+        print("Usage: python3 boundary_stats.py <telemetry.jsonl> <predictor> <n_gpus>")
+        print("       python3 boundary_stats.py simulate <n_layers> <n_gpus (profiling run)>")
+        sys.exit()
+
+    if sys.argv[1] == "simulate":
+        check_simulation(int(sys.argv[2]), int(sys.argv[3]))
+    else:
+        predict_from_boundaries(sys.argv[1], int(sys.argv[3]), sys.argv[2])
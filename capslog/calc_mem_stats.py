@@ -2,14 +2,34 @@ import sys
 import re
 import time
 import math
+import json
+import contextlib
+import statistics
+import itertools
+import multiprocessing
 import numpy as np
-from varuna_mem_stats import read_input_varuna
+from collections import defaultdict
+from varuna_mem_stats import read_input_varuna_metrics
 
 debug = False
 # debug = True
 plot = False
 global_n_layers = None
-global_mem_stats = None
+global_n_gpus = None
+global_mem_arrays = None
+global_capacities = None
+global_margins = None
+global_schedule_terms = None
+# Number of partitionings evaluated at once by the brute-force predictor.
+batch_size = 2**16
+# Number of processes used by the parallel brute-force predictor (None: all CPUs).
+n_processes = None
+# Minimum number of shards per process for the parallel brute-force predictor.
+shards_per_process = 4
+# Number of highest per-GPU predictions of the remaining layers that the
+# branch-and-bound predictor uses as a lower bound (None: all compared by the
+# tie-breaker rule, which is needed to prune ties between identical layers).
+bound_depth = None
 
 #----------------------------------
 # Printing functions for debugging.
@@ -29,27 +49,11 @@ def print_results(results):
 
     print("\n")
 
-def print_bf_result(results, best_index, time_taken):
-    partitioning = convert_to_forward_layers(results[best_index][0])
-    prediction = results[best_index][1]
-    peak = max(prediction)
-
-    print_predictor_result(partitioning, prediction, peak, time_taken)
-
-def print_bo_result(opt, n_layers, time_taken):
-    global global_mem_stats
-
-    partitioning = percent_to_layers(opt.get_result().x, n_layers)
-    prediction = predict(partitioning, global_mem_stats)
-    peak = max(prediction)
-
-    print_predictor_result(partitioning, prediction, peak, time_taken)
-
-    if plot:
-        from skopt.plots import plot_convergence
-        import matplotlib.pyplot as plt
-        plot_convergence(opt.get_result())
-        plt.show()
+def plot_bo_convergence(opt):
+    from skopt.plots import plot_convergence
+    import matplotlib.pyplot as plt
+    plot_convergence(opt.get_result())
+    plt.show()
 
 def print_predictor_result(partitioning, prediction, peak, time_taken):
     GB = 1024**3
@@ -183,21 +187,66 @@ def find_mem_added(data, layer):
 
     return results
 
+# Index the profiling data by cutpoint, so that the statistics of a layer can
+# be extracted without going through all profiling runs again.
+# Out args:
+#   by_cut: for each cutpoint, the (run, position) pairs of all profiling runs
+#       with that cutpoint, where position is the index of the cutpoint in the run.
+#   by_prev_cut: the same, keyed by (cutpoint, previous cutpoint in the run).
+def index_profiling_data(data):
+    by_cut = defaultdict(list)
+    by_prev_cut = defaultdict(list)
+
+    for p in data:
+        cutpoints = p["partitioning"]
+        for position, cut in enumerate(cutpoints):
+            by_cut[cut].append((p, position))
+            by_prev_cut[(cut, cutpoints[position-1])].append((p, position))
+
+    return by_cut, by_prev_cut
+
+# Extract the mem isolated statistic for layer from the indexed profiling data.
+# Same as find_mem_isolated().
+def find_mem_isolated_indexed(by_cut, layer):
+    results = []
+    for p, position in by_cut.get(layer, []):
+        cutpoints = p["partitioning"]
+        # Find a partitioning with cutpoints just before and after 'layer'.
+        if position + 1 < len(cutpoints) and cutpoints[position+1] == layer+1:
+            mem = p["mem"][position]
+            if mem > 0: # if the memory is not from a trimmed stage
+                results.append(mem)
+    return results
+
+# Extract the mem added statistic for layer from the indexed profiling data.
+# Same as find_mem_added(), but only combines partitionings with matching
+# previous cutpoints instead of comparing all of them.
+def find_mem_added_indexed(by_cut, by_prev_cut, layer):
+    results = []
+    for s, position in by_cut.get(layer, []):
+        prev_cut = s["partitioning"][position-1]
+        mem_s = s["mem"][position-1]
+
+        for e, e_position in by_prev_cut.get((layer+1, prev_cut), []):
+            mem_e = e["mem"][e_position-1]
+            # only proceed if neither statistic is from a trimmed stage
+            if mem_s > 0 and mem_e > 0:
+                results.append(mem_e - mem_s)
+
+    return results
+
 # Determine mem isolated and mem added for all layers based on the profiling partitionings.
 # Multiple results can exist for each layer.
 def get_mem_stats(data, n_layers):
-    # print(n_layers)
-    # print(data)
-    # import json
-    # print(json.dumps(data, sort_keys=True, indent=4))
-    
+    by_cut, by_prev_cut = index_profiling_data(data)
+
     results = {}
     for layer in range(n_layers):
         results[layer] = {"mem_isolated": None, "mem_added": None}
-        results[layer]["mem_isolated"] = find_mem_isolated(data, layer)
+        results[layer]["mem_isolated"] = find_mem_isolated_indexed(by_cut, layer)
 
         if layer != 0:
-            results[layer]["mem_added"] = find_mem_added(data, layer)
+            results[layer]["mem_added"] = find_mem_added_indexed(by_cut, by_prev_cut, layer)
 
     return results
 
@@ -214,19 +263,52 @@ def average_results(results):
 
     return results
 
+# Variance of the mem isolated and mem added samples of each layer, in the
+# same format as get_mem_stats() (with a variance instead of a list of samples).
+# Must be called before average_results(), which replaces the samples by their mean.
+# Layers with fewer than two samples get the mean variance of the other layers.
+def get_mem_variances(results):
+    variances = {}
+    pooled = {"mem_isolated": [], "mem_added": []}
+    missing = []
+    for layer in results:
+        variances[layer] = {"mem_isolated": None, "mem_added": None}
+        for metric in ("mem_isolated", "mem_added"):
+            samples = results[layer][metric]
+            if samples is None:
+                continue
+            if len(samples) < 2:
+                missing.append((layer, metric))
+                continue
+            variances[layer][metric] = float(np.var(samples, ddof=1))
+            pooled[metric].append(variances[layer][metric])
+
+    for layer, metric in missing:
+        variances[layer][metric] = float(np.mean(pooled[metric])) if len(pooled[metric]) > 0 else 0.0
+
+    return variances
+
+# The statistics that could not be extracted, as (layer, "mem_isolated" or "mem_added").
+def get_missing_stats(results, n_layers):
+    missing = []
+    for layer in range(n_layers):
+        if len(results[layer]["mem_isolated"]) == 0:
+            missing.append((layer, "mem_isolated"))
+        if layer != 0 and len(results[layer]["mem_added"]) == 0:
+            missing.append((layer, "mem_added"))
+    return missing
+
 # Checks that both metrics were extracted for each layer.
 def do_completeness_check(results, n_layers):
     # Check if all memory stats are present.
-    err = 0
-    for layer in range(n_layers):
-        if len(results[layer]["mem_isolated"]) == 0:
+    missing = get_missing_stats(results, n_layers)
+    for layer, metric in missing:
+        if metric == "mem_isolated":
             print("Mem isolated for layer", layer, "missing!")
-            err = 1
-        if layer != 0 and len(results[layer]["mem_added"]) == 0:
+        else:
             print("Mem added for layer", layer, "missing!")
-            err = 1
 
-    if err:
+    if len(missing) > 0:
         print("Profiling data not complete.", flush=True)
         sys.exit()
     else:
@@ -240,8 +322,95 @@ def generate_partitionings_recursive(n_layers, n_gpus, partial_result):
     for i in range(1, n_layers - n_gpus + 2):
         yield from generate_partitionings_recursive(n_layers - i, n_gpus - 1, partial_result + [i])
 
-def generate_partitionings(n_layers, n_gpus):
-    yield from generate_partitionings_recursive(n_layers, n_gpus, [])
+# If 'prefix' is given, only the partitionings starting with the
+# layers per GPU in 'prefix' are generated.
+def generate_partitionings(n_layers, n_gpus, prefix=None):
+    if prefix is None:
+        prefix = []
+    yield from generate_partitionings_recursive(n_layers - sum(prefix), n_gpus - len(prefix), list(prefix))
+
+# Generate the number of layers on the first 'depth' GPUs of all possible
+# partitionings, in the same order as generate_partitionings().
+def generate_prefixes(n_layers, n_gpus, depth):
+    if depth == 0:
+        yield []
+        return
+    for i in range(1, n_layers - n_gpus + 2):
+        for prefix in generate_prefixes(n_layers - i, n_gpus - 1, depth - 1):
+            yield [i] + prefix
+
+# Same as generate_partitionings(), but yields the partitionings in 2-D arrays
+# of (at most) batch_size rows, to be evaluated with predict_batch().
+def generate_partitioning_batches(n_layers, n_gpus, batch_size, prefix=None):
+    partitionings = generate_partitionings(n_layers, n_gpus, prefix)
+    while True:
+        batch = list(itertools.islice(partitionings, batch_size))
+        if len(batch) == 0:
+            return
+        yield np.array(batch, dtype=np.int64)
+
+# Convert the memory statistics to contiguous arrays, which is done once
+# before searching for a partitioning:
+#   mem_isolated[layer]: mem isolated of 'layer'
+#   added_prefix[layer]: sum of mem added of all layers before 'layer',
+#       such that the predicted memory usage of a stage holding layers [start, end) is:
+#       mem_isolated[start] + added_prefix[end] - added_prefix[start+1]
+def mem_stats_to_arrays(mem_stats, n_layers):
+    mem_isolated = np.array([mem_stats[layer]["mem_isolated"] for layer in range(n_layers)], dtype=np.int64)
+    mem_added = np.array([0] + [mem_stats[layer]["mem_added"] for layer in range(1, n_layers)], dtype=np.int64)
+    added_prefix = np.concatenate(([0], np.cumsum(mem_added)))
+
+    return mem_isolated, added_prefix
+
+# Safety margins for predicting a quantile of the memory usage instead of the
+# mean. The memory usage of a stage is modelled as normally distributed, with
+# the variance of mem isolated of its first layer plus the variances of mem
+# added of its other layers (assuming they are independent). The predicted
+# quantile of a stage is its mean plus z times its standard deviation.
+# Out args (in the same layout as mem_stats_to_arrays()):
+#   (var_isolated, var_prefix, z)
+def get_margins(variances, n_layers, quantile):
+    var_isolated = np.array([variances[layer]["mem_isolated"] for layer in range(n_layers)], dtype=np.float64)
+    var_added = np.array([0] + [variances[layer]["mem_added"] for layer in range(1, n_layers)], dtype=np.float64)
+    var_prefix = np.concatenate(([0], np.cumsum(var_added)))
+    z = statistics.NormalDist().inv_cdf(quantile)
+
+    return var_isolated, var_prefix, z
+
+# Standard deviation of the memory usage of each GPU for a partitioning
+# (number of layers on each GPU), from the arrays of get_margins().
+def get_prediction_sd(partitioning, margins):
+    var_isolated, var_prefix, _ = margins
+    ends = np.cumsum(partitioning)
+    starts = ends - np.asarray(partitioning)
+    return np.sqrt(np.maximum(var_isolated[starts] + var_prefix[ends] - var_prefix[starts+1], 0))
+
+# Predict the peak memory usage for many partitionings at once.
+# In args:
+#   partitionings: 2-D array with the number of layers on each GPU,
+#       one partitioning per row.
+#   mem_arrays: memory statistics as returned by mem_stats_to_arrays().
+#   margins: if given (see get_margins()), predict a quantile of the memory usage.
+#   schedule_terms: if given (see stage_schedule_mem()), add the activations
+#       stashed for the micro-batches in flight at each pipeline position.
+# Out args:
+#   predictions: 2-D array with the predicted memory usage of each GPU,
+#       one partitioning per row.
+#   peaks: the highest predicted memory usage of each partitioning.
+def predict_batch(partitionings, mem_arrays, margins=None, schedule_terms=None):
+    mem_isolated, added_prefix = mem_arrays
+    ends = np.cumsum(partitionings, axis=1)
+    starts = ends - partitionings
+
+    predictions = mem_isolated[starts] + added_prefix[ends] - added_prefix[starts+1]
+    if margins is not None:
+        var_isolated, var_prefix, z = margins
+        variance = np.maximum(var_isolated[starts] + var_prefix[ends] - var_prefix[starts+1], 0)
+        predictions = predictions + np.ceil(z * np.sqrt(variance)).astype(np.int64)
+    if schedule_terms is not None:
+        in_flight, act_sizes = schedule_terms
+        predictions = predictions + np.asarray(in_flight, dtype=np.int64) * np.asarray(act_sizes, dtype=np.int64)[starts]
+    return predictions, predictions.max(axis=1)
 
 # Predict the peak memory usage for a given partitioning,
 # using mem_isolated and mem_added.
@@ -314,7 +483,7 @@ def percent_to_layers(params, n_layers):
 # using mem_isolated and mem_added.
 def predict_bo(params):
     global global_n_layers
-    global global_mem_stats
+    global global_mem_arrays
 
     # The bayesian optimization package does not support integer parameter values, so it
     # gives floats. Convert to integers first.
@@ -326,11 +495,10 @@ def predict_bo(params):
     if sum(partitioning) != global_n_layers:
         return 1000
 
-    # Predict memory usage for this partitioning.
-    prediction = predict(partitioning, global_mem_stats)
-
-    # Return peak memory usage across all GPUs.
-    return max(prediction)
+    # Predict memory usage for this partitioning and
+    # return peak memory usage across all GPUs.
+    predictions, peaks = predict_batch(np.array([partitioning]), global_mem_arrays)
+    return int(peaks[0])
 
 # Convert a partitioning in the 'cutpoints' representation to
 # the 'layers' representation.
@@ -398,50 +566,241 @@ def tie_breaker(results, best_indices, n_gpus):
     # pick the first one/random, since all remaining results are equal.
     return best_indices[0]
 
+# The tie-breaker rule above is equivalent to comparing the per-GPU
+# predictions sorted in descending order lexicographically, ignoring the
+# GPU with the lowest prediction. Returns the sorted predictions of every
+# partitioning in 'predictions' (2-D array) in that form.
+def tie_breaker_keys(predictions, n_gpus):
+    n_compared = max(n_gpus - 1, 1)
+    return -np.sort(-predictions, axis=1)[:, :n_compared]
+
+# Fraction of the memory capacity of each GPU that is used, for GPUs with
+# different memory capacities. capacities[i] is the capacity of the GPU that
+# runs stage i; works for a single prediction and for 2-D arrays of predictions.
+def get_utilization(predictions, capacities):
+    return np.asarray(predictions) / np.asarray(capacities, dtype=np.float64)
+
+# Report the stages that are predicted not to fit on their GPU.
+# Returns True if all stages fit.
+def check_capacities(prediction, capacities):
+    GB = 1024**3
+    utilization = get_utilization(prediction, capacities).tolist()
+
+    print("Predicted utilization per GPU:", utilization)
+    print("Predicted overall peak utilization:", max(utilization))
+
+    fits = True
+    for stage, (mem, capacity) in enumerate(zip(prediction, capacities)):
+        if mem > capacity:
+            print("INFEASIBLE: stage", stage, "needs", mem / GB, "GB, GPU has", capacity / GB, "GB")
+            fits = False
+    return fits
+
+# Returns the index of the best partitioning in 'predictions' according to
+# the tie-breaker rule. If multiple partitionings are equal, the first one is returned.
+def best_in_batch(predictions, n_gpus):
+    keys = tie_breaker_keys(predictions, n_gpus)
+    # np.lexsort sorts on the last key first, and is stable.
+    return int(np.lexsort(keys.T[::-1])[0])
+
+# Brute-force search that only keeps the best partitioning found so far,
+# instead of all partitionings with the same peak memory usage. Uses the
+# same tie-breaker rule, so the result is identical to that of 'bf', but
+# memory usage does not grow with the size of the search space.
+# If 'prefix' is given, only the partitionings starting with 'prefix' are searched.
+# If 'capacities' is given, the utilization of the GPUs is balanced instead
+# (see get_utilization()).
+# If 'margins' is given, a quantile of the memory usage is balanced (see get_margins()).
+# If 'schedule_terms' is given, the stashed activations of each position are added (see stage_schedule_mem()).
+def stream_balanced_partitioning(mem_arrays, n_layers, n_gpus, prefix=None, capacities=None, margins=None,
+                                 schedule_terms=None):
+    best_key = None
+    partitioning, prediction = None, None
+
+    for partitionings in generate_partitioning_batches(n_layers, n_gpus, batch_size, prefix):
+        predictions, peaks = predict_batch(partitionings, mem_arrays, margins, schedule_terms)
+        costs = predictions if capacities is None else get_utilization(predictions, capacities)
+        i = best_in_batch(costs, n_gpus)
+        key = tie_breaker_keys(costs[i:i+1], n_gpus)[0].tolist()
+
+        # Only replace the incumbent if strictly better, so the first one wins ties.
+        if best_key is None or key < best_key:
+            best_key = key
+            partitioning = partitionings[i].tolist()
+            prediction = predictions[i].tolist()
+
+    return partitioning, prediction
+
+# The worker processes of the parallel brute-force predictor get the
+# memory statistics once, when they are started.
+def init_shard_worker(mem_arrays, n_layers, n_gpus, capacities=None, margins=None, schedule_terms=None):
+    global global_n_layers
+    global global_mem_arrays
+    global global_n_gpus
+    global global_capacities
+    global global_margins
+    global global_schedule_terms
+    global_n_layers = n_layers
+    global_mem_arrays = mem_arrays
+    global_n_gpus = n_gpus
+    global_capacities = capacities
+    global_margins = margins
+    global_schedule_terms = schedule_terms
+
+def search_shard(prefix):
+    return stream_balanced_partitioning(global_mem_arrays, global_n_layers, global_n_gpus, prefix, global_capacities,
+                                        global_margins, global_schedule_terms)
+
+# Brute-force search in parallel. The search space is split into shards
+# by the number of layers on the first GPUs, which are searched in a process
+# pool. The best partitionings of the shards are merged in the order in
+# which 'bf' enumerates them, with the same tie-breaker rule, so the result
+# is identical to that of 'bf'.
+def parallel_balanced_partitioning(mem_arrays, n_layers, n_gpus, processes=None, capacities=None, margins=None,
+                                   schedule_terms=None):
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    # Fix the layers on as many GPUs as needed to get enough shards to
+    # keep all processes busy.
+    depth = 0
+    shards = [[]]
+    while len(shards) < shards_per_process * processes and depth < n_gpus - 1:
+        depth += 1
+        shards = list(generate_prefixes(n_layers, n_gpus, depth))
+
+    best_key = None
+    partitioning, prediction = None, None
+
+    with multiprocessing.Pool(processes, initializer=init_shard_worker,
+                              initargs=(mem_arrays, n_layers, n_gpus, capacities, margins, schedule_terms)) as pool:
+        # imap returns the results in the order of the shards.
+        for shard_partitioning, shard_prediction in pool.imap(search_shard, shards):
+            costs = np.array([shard_prediction])
+            if capacities is not None:
+                costs = get_utilization(costs, capacities)
+            key = tie_breaker_keys(costs, n_gpus)[0].tolist()
+            if best_key is None or key < best_key:
+                best_key = key
+                partitioning = shard_partitioning
+                prediction = shard_prediction
+
+    return partitioning, prediction
+
+# Predictors that can balance the utilization of GPUs with different memory capacities.
+capacity_predictors = ("bf", "bf_stream", "bf_parallel", "dp")
+# Predictors that can balance a quantile of the memory usage.
+quantile_predictors = ("bf", "bf_stream", "bf_parallel", "dp")
+# Predictors that can add the activations stashed at each pipeline position (see stage_schedule_mem()).
+schedule_predictors = ("bf", "bf_stream", "bf_parallel", "dp")
+
+# Check that the predictor supports the given options, so that unsupported
+# combinations can be rejected before the profiling output is read.
+# Raises ValueError naming the predictors that do support them.
+def check_predictor_options(predictor, capacities=None, quantile=None, schedule_terms=None):
+    if capacities is not None and predictor not in capacity_predictors:
+        raise ValueError("predictor '{}' does not support per-GPU capacities, supported: {}".format(
+            predictor, ", ".join(capacity_predictors)))
+    if quantile is not None and predictor not in quantile_predictors:
+        raise ValueError("predictor '{}' cannot balance a quantile of the memory usage, supported: {}".format(
+            predictor, ", ".join(quantile_predictors)))
+    if schedule_terms is not None and predictor not in schedule_predictors:
+        raise ValueError("predictor '{}' cannot add the activations stashed at each pipeline position, "
+                         "supported: {}".format(predictor, ", ".join(schedule_predictors)))
+
 # Find the best memory-balanced partitioning.
 # If predictor == 'bf', this function predicts the peak memory usage for all
 # possible partitionings  and picks the best balanced one (brute-force).
 # If predictor == 'bo', it uses bayesian optimization to navigate the search space.
-def find_balanced_partitioning(mem_stats, n_layers=24, n_gpus=8, predictor='bf'):
+# If predictor == 'bf_stream', it does the same as 'bf', but only keeps the best partitioning in memory.
+# If predictor == 'bf_parallel', it does the same as 'bf_stream', using multiple processes.
+# If predictor == 'bb', it finds the same partitioning as 'bf' with branch-and-bound.
+# If predictor == 'dp', it finds the same partitioning as 'bf' with dynamic programming.
+# If capacities (memory capacity of the GPU at each position in the pipeline)
+# is given, the highest utilization is minimized instead of the highest memory
+# usage, and stages that do not fit are reported. Only the capacity_predictors
+# support this ('bf' then searches like 'bf_stream', with the same result).
+# If variances (see get_mem_variances()) and a quantile (e.g. 0.99) are given,
+# that quantile of the memory usage is balanced instead of the mean, so the
+# partitioning is robust against the variation between runs. Only the
+# quantile_predictors support this.
+# If schedule_terms (see stage_schedule_mem()) is given, mem_stats holds the
+# position-independent memory usage, and the activations stashed for the
+# micro-batches in flight at each pipeline position are added to it.
+# Only the schedule_predictors support this.
+# The result is printed if verbose is set, and returned as a dict
+# (see get_predictor_result()).
+def find_balanced_partitioning(mem_stats, n_layers=24, n_gpus=8, predictor='bf', capacities=None,
+                               variances=None, quantile=None, schedule_terms=None, verbose=True):
+    mem_arrays = mem_stats_to_arrays(mem_stats, n_layers)
+
+    if capacities is not None:
+        if len(capacities) != n_gpus:
+            raise ValueError("capacities must have one entry per GPU")
+        check_predictor_options(predictor, capacities=capacities)
+
+    margins = None
+    if quantile is not None:
+        if variances is None:
+            raise ValueError("a quantile can only be predicted with variances")
+        check_predictor_options(predictor, quantile=quantile)
+        margins = get_margins(variances, n_layers, quantile)
+
+    if schedule_terms is not None:
+        check_predictor_options(predictor, schedule_terms=schedule_terms)
 
     # Brute-force:
-    if predictor == 'bf':
+    if predictor == 'bf' and capacities is None:
         start = time.time()
-        results = []
+        results = {}
         best_peak = math.inf
         best_i = []
+        offset = 0
 
-        for i, partitioning in enumerate(generate_partitionings(n_layers, n_gpus)):
-            prediction = predict(partitioning, mem_stats)
-            # prediction = predict_early_stop(partitioning, mem_stats, best_peak)
-            peak = max(prediction)
+        for partitionings in generate_partitioning_batches(n_layers, n_gpus, batch_size):
+            predictions, peaks = predict_batch(partitionings, mem_arrays, margins, schedule_terms)
+            peak = peaks.min()
 
             if peak < best_peak:
-                # Reset list with best results.
-                best_i = [i]
+                # Reset the best results.
+                results = {}
+                best_i = []
                 best_peak = peak
-            elif peak == best_peak:
-                # Add to list of best results, so we can apply tie-breaking rule later.
-                best_i.append(i)
-        
-            results.append((partitioning, prediction))
+
+            if peak == best_peak:
+                # Add to the best results, so we can apply tie-breaking rule later.
+                for i in np.flatnonzero(peaks == best_peak).tolist():
+                    best_i.append(offset + i)
+                    results[offset + i] = (partitionings[i].tolist(), predictions[i].tolist())
+
+            offset += len(partitionings)
 
         # Apply the tie-breaker rule if there are multiple partitionings
         # with the same highest peak memory usage.
         best_i = tie_breaker(results, best_i, n_gpus)
+        partitioning, prediction = results[best_i]
 
         end = time.time()
 
-        # Print the result.
-        print_bf_result(results, best_i, end-start)
+    elif predictor in ("bf", "bf_stream"):
+        start = time.time()
+        partitioning, prediction = stream_balanced_partitioning(mem_arrays, n_layers, n_gpus, capacities=capacities,
+                                                                margins=margins, schedule_terms=schedule_terms)
+        end = time.time()
+
+    elif predictor == "bf_parallel":
+        start = time.time()
+        partitioning, prediction = parallel_balanced_partitioning(mem_arrays, n_layers, n_gpus, n_processes, capacities,
+                                                                  margins, schedule_terms)
+        end = time.time()
 
     elif predictor == "bo":
         # Bayesian optimization:
         # This uses predict_bo function, which we cannot give arguments, so use global variables.
         global global_n_layers
-        global global_mem_stats
+        global global_mem_arrays
         global_n_layers = n_layers
-        global_mem_stats = mem_stats
+        global_mem_arrays = mem_arrays
 
         # Bayesian optimization:
         start = time.time()
@@ -460,10 +819,14 @@ def find_balanced_partitioning(mem_stats, n_layers=24, n_gpus=8, predictor='bf')
         # Run the optimizer and get the result.
         opt.run(predict_bo, n_iter=100)
 
+        partitioning = percent_to_layers(opt.get_result().x, n_layers)
+        predictions, peaks = predict_batch(np.array([partitioning]), mem_arrays)
+        prediction = predictions[0].tolist()
+
         end = time.time()
-        
-        # Print the result.
-        print_bo_result(opt, n_layers, end-start)
+
+        if plot:
+            plot_bo_convergence(opt)
 
     elif predictor == "bs":
         start = time.time()
@@ -471,68 +834,135 @@ def find_balanced_partitioning(mem_stats, n_layers=24, n_gpus=8, predictor='bf')
         # try to load memory on gpus in the begining, if there is a tie
         while l <= r:
             mid = (l + r) // 2
-            layers, pred = fill_first(mem_stats, n_gpus, mid)
+            layers, pred = fill_first(mem_arrays, n_gpus, mid)
             peak = max(pred)
             if peak > mid:
                 l = mid + 1
             else:
                 r = mid - 1
-                partitioning = layers
+                partitioning = [len(gpu) for gpu in layers]
                 prediction = pred
 
         end = time.time()
-        print_predictor_result(partitioning, prediction, max(prediction), end-start)
 
     elif predictor == "bs_tb":
         start = time.time()
-        partitioning, prediction = bs_tb(mem_stats, n_gpus)
+        layers, prediction = bs_tb(mem_arrays, n_gpus)
+        partitioning = [len(gpu) for gpu in layers]
+        end = time.time()
+
+    elif predictor == "bb":
+        start = time.time()
+        partitioning, prediction = branch_and_bound_partitioning(mem_arrays, n_layers, n_gpus)
         end = time.time()
 
-        partitioning = reset_layers(partitioning)
-        print_predictor_result(partitioning, prediction, max(prediction), end-start)
+    elif predictor == "dp":
+        # Exact dynamic programming: same result as 'bf' (including the
+        # tie-breaker rule), but in polynomial time.
+        start = time.time()
+        partitioning, prediction = dp_balanced_partitioning(mem_arrays, n_layers, n_gpus, capacities, margins,
+                                                            schedule_terms)
+        end = time.time()
 
     else:
         raise NotImplementedError
 
-    # return partitioning
+    result = get_predictor_result(partitioning, prediction, end-start, predictor, capacities)
+    if margins is not None:
+        add_confidence_intervals(result, mem_arrays, margins, quantile)
 
-def fill_first(mem_stats, n_gpus, threshold):
+    if verbose:
+        print_predictor_result(convert_to_forward_layers(result["partitioning"]), result["prediction"],
+                               result["peak"], result["time"])
+        if margins is not None:
+            print_confidence_intervals(result)
+        if capacities is not None:
+            check_capacities(result["prediction"], capacities)
+
+    return result
+
+# Collect the result of a predictor in a dict that can be written as JSON:
+#   predictor: name of the predictor
+#   partitioning: number of layers on each GPU, e.g. [3, 3, 4, 2]
+#   prediction: predicted peak memory usage of each GPU (bytes)
+#   peak: highest predicted peak memory usage (bytes)
+#   time: time taken by the search (s)
+#   stage_to_cut: the partitioning as the --stage_to_cut argument of varuna
+#   utilization, feasible: only if capacities is given; the fraction of each
+#       GPU's capacity that is used, and whether all stages fit.
+def get_predictor_result(partitioning, prediction, time_taken, predictor, capacities=None):
+    partitioning = [int(n) for n in partitioning]
+    prediction = [int(mem) for mem in prediction]
+
+    result = {"predictor": predictor,
+              "partitioning": partitioning,
+              "prediction": prediction,
+              "peak": max(prediction),
+              "time": time_taken,
+              "stage_to_cut": to_stage_to_cut(partitioning)}
+
+    if capacities is not None:
+        result["utilization"] = get_utilization(prediction, capacities).tolist()
+        result["feasible"] = all(mem <= capacity for mem, capacity in zip(prediction, capacities))
+
+    return result
+
+# Add the uncertainty of the prediction to a predictor result that balanced
+# a quantile of the memory usage ('prediction' then holds that quantile):
+#   quantile: the quantile that was balanced
+#   mean_prediction: predicted mean memory usage of each GPU (bytes)
+#   prediction_sd: standard deviation of the memory usage of each GPU (bytes)
+#   confidence_interval: [low, high] per GPU, mean -/+ the margin of the quantile
+def add_confidence_intervals(result, mem_arrays, margins, quantile):
+    partitioning = result["partitioning"]
+    predictions, _ = predict_batch(np.array([partitioning]), mem_arrays)
+    mean = predictions[0].tolist()
+    sd = get_prediction_sd(partitioning, margins).tolist()
+    z = margins[2]
+
+    result["quantile"] = quantile
+    result["mean_prediction"] = mean
+    result["prediction_sd"] = sd
+    result["confidence_interval"] = [[m - z * d, m + z * d] for m, d in zip(mean, sd)]
+
+def print_confidence_intervals(result):
+    GB = 1024**3
+    print("Predicted memory usage (GB) per GPU, mean +/- standard deviation:")
+    print(["{:.3f} +/- {:.3f}".format(m / GB, d / GB) for m, d in zip(result["mean_prediction"], result["prediction_sd"])])
+    print("Predicted overall peak memory usage at quantile", result["quantile"], ":")
+    print(result["peak"] / GB, "GB")
+
+def fill_first(mem_arrays, n_gpus, threshold):
+    mem_isolated, added_prefix = mem_arrays
     partitioning, prediction = [], []
     pos = 0
-    n_layers = len(mem_stats)
+    n_layers = len(mem_isolated)
 
     # first k-1 layers
     for gpu_id in range(n_gpus-1):
-        mem = mem_stats[pos]["mem_isolated"]
-        stage = [pos]
-        pos += 1
-        while pos < n_layers + gpu_id - n_gpus + 1:
-            mem_pos = mem_stats[pos]["mem_added"]
-
-            if mem + mem_pos <= threshold:
-                mem += mem_pos
-                stage.append(pos)
-                pos += 1
-            else:
-                break
-        partitioning.append(stage)
-        prediction.append(mem)
+        # Memory usage of the stage for every layer that can still be added,
+        # the stage stops growing at the first layer that exceeds the threshold.
+        max_end = n_layers + gpu_id - n_gpus + 1
+        mems = mem_isolated[pos] + added_prefix[pos+1:max_end+1] - added_prefix[pos+1]
+        end = pos + 1 + int(np.argmax(np.append(mems[1:] > threshold, True)))
+        partitioning.append(list(range(pos, end)))
+        prediction.append(int(mems[end - pos - 1]))
+        pos = end
 
     # last layer
     partitioning.append(list(range(pos, n_layers)))
-    mem = mem_stats[pos]["mem_isolated"]
-
-    for i in range(pos+1, n_layers):
-        mem += mem_stats[i]["mem_added"]
-    prediction.append(mem)
+    prediction.append(int(mem_isolated[pos] + added_prefix[n_layers] - added_prefix[pos+1]))
     
     return partitioning, prediction
 
-def slice_mem_stats(mem_stats, layers):
-    new_mem_stats = {}
-    for i, layer in enumerate(layers):
-        new_mem_stats[i] = mem_stats[layer]
-    return new_mem_stats
+# Select the given (contiguous) layers from the memory statistics arrays.
+# The first selected layer becomes layer 0.
+def slice_mem_arrays(mem_arrays, layers):
+    mem_isolated, added_prefix = mem_arrays
+    mem_added = np.diff(added_prefix)[layers]
+    mem_added[0] = 0
+
+    return mem_isolated[layers], np.concatenate(([0], np.cumsum(mem_added)))
 
 def reset_layers(partitioning):
     counter = 0
@@ -554,7 +984,7 @@ def reset_layer_numbers(partitioning, prediction, mem_stats, starting_layer):
 
     return partitioning, prediction, mem_stats
 
-def fix_and_continue(mem_stats, partitioning, prediction):
+def fix_and_continue(mem_arrays, partitioning, prediction):
 
     n_gpus = len(partitioning)
     if n_gpus == 0:
@@ -569,19 +999,17 @@ def fix_and_continue(mem_stats, partitioning, prediction):
     if len(layers) == 0:
         partitioning1, prediction1 = [], []
     else:
-        new_mem_stats = slice_mem_stats(mem_stats, layers)
-        # print(new_mem_stats)
-        partitioning1, prediction1 = bs_tb(new_mem_stats, fix)
+        new_mem_arrays = slice_mem_arrays(mem_arrays, layers)
+        partitioning1, prediction1 = bs_tb(new_mem_arrays, fix)
 
-    layers = np.arange(fixed_layers[-1] + 1, len(mem_stats))
+    layers = np.arange(fixed_layers[-1] + 1, len(mem_arrays[0]))
     # print("layers part 2:", layers, "\n")
 
     if len(layers) == 0:
         partitioning2, prediction2 = [], []
     else:
-        new_mem_stats = slice_mem_stats(mem_stats, layers)
-        # print(new_mem_stats)
-        partitioning2, prediction2 = bs_tb(new_mem_stats, n_gpus - fix - 1, layers[0])
+        new_mem_arrays = slice_mem_arrays(mem_arrays, layers)
+        partitioning2, prediction2 = bs_tb(new_mem_arrays, n_gpus - fix - 1, layers[0])
 
     partitioning = partitioning1 + [fixed_layers] + partitioning2
     prediction = prediction1 + [prediction[fix]] + prediction2
@@ -589,12 +1017,12 @@ def fix_and_continue(mem_stats, partitioning, prediction):
     return partitioning, prediction
 
 
-def bs_tb(mem_stats, n_gpus, start_layer=0):
+def bs_tb(mem_arrays, n_gpus, start_layer=0):
     l, r = 0, 2**60 # binary search
     # try to load memory on gpus in the begining, if there is a tie
     while l <= r:
         mid = (l + r) // 2
-        layers, pred = fill_first(mem_stats, n_gpus, mid)
+        layers, pred = fill_first(mem_arrays, n_gpus, mid)
         peak = max(pred)
         if peak > mid:
             l = mid + 1
@@ -606,30 +1034,333 @@ def bs_tb(mem_stats, n_gpus, start_layer=0):
     # if start_layer != 0:
         # partitioning, prediction, mem_stats = reset_layer_numbers(partitioning, prediction, mem_stats, start_layer)
 
-    return fix_and_continue(mem_stats, partitioning, prediction)
+    return fix_and_continue(mem_arrays, partitioning, prediction)
 
     # return partitioning, prediction
 
-def main(slurm_filename, predictor='bf', n_gpus=None):
-    partitionings, mem = read_input_varuna(slurm_filename)
-    # print(partitionings[0])
-    # If no n_gpus given to predict for, use same as in profiling runs.
-    if n_gpus is None:
-        n_gpus = len(partitionings[0]) - 1
-    # print(n_gpus)
+# Predicted memory usage of a stage holding layers [start, end), in O(1).
+# If margins is given (see get_margins()), a quantile of the memory usage is predicted.
+def predict_stage(mem_isolated, added_prefix, start, end, margins=None):
+    mem = mem_isolated[start] + added_prefix[end] - added_prefix[start+1]
+    if margins is None:
+        return mem
+    var_isolated, var_prefix, z = margins
+    variance = max(var_isolated[start] + var_prefix[end] - var_prefix[start+1], 0)
+    return mem + math.ceil(z * math.sqrt(variance))
+
+# Memory of the activations a stage starting at layer 'start' stashes for the
+# micro-batches in flight at its position in the pipeline (see pipeline_position.py).
+#   schedule_terms: (number of micro-batches in flight per position, activation size per layer)
+def stage_schedule_mem(start, position, schedule_terms=None):
+    if schedule_terms is None:
+        return 0
+    in_flight, act_sizes = schedule_terms
+    return in_flight[position] * act_sizes[start]
+
+# What the predictors balance for a stage on a GPU: the predicted memory usage,
+# or, if the GPUs have different memory capacities, the fraction of the
+# capacity of the GPU at 'position' in the pipeline that is used.
+def stage_cost(mem, position, capacities=None):
+    if capacities is None:
+        return mem
+    return mem / capacities[position]
+
+# Insert a stage prediction in a tuple of predictions sorted in descending order.
+# Binary search for the position, so it takes O(len(peaks)) time for the copy
+# instead of sorting.
+def insert_sorted(peaks, mem):
+    low, high = 0, len(peaks)
+    while low < high:
+        middle = (low + high) // 2
+        if peaks[middle] >= mem:
+            low = middle + 1
+        else:
+            high = middle
+    return peaks[:low] + (mem,) + peaks[low:]
+
+# Build a table with, for every suffix of the layers and every number of GPUs,
+# the best per-GPU predictions (sorted in descending order) for placing that
+# suffix on that many GPUs. Comparing the sorted predictions lexicographically
+# is what the tie-breaker rule does: first the peak, then the peak with the
+# highest GPU ignored, etc. This order is preserved when the same stage is added
+# to two candidates, so the best solution of a suffix extends to the best
+# solution of the whole model.
+#   best[g][start] = best sorted predictions for layers [start, n_layers) on g GPUs.
+# If all_starts is set, the table holds every suffix, so it can be used for
+# any number of GPUs up to n_gpus.
+# If capacities is given, the utilization of each GPU is balanced instead
+# (see stage_cost()); the GPU that holds [start, ...) on g GPUs is at
+# position n_gpus - g.
+# If margins is given, a quantile of the memory usage is balanced (see get_margins()).
+# If schedule_terms is given, the stashed activations of each position are added (see stage_schedule_mem()).
+def get_suffix_table(mem_isolated, added_prefix, n_layers, n_gpus, all_starts=False, capacities=None, margins=None,
+                     schedule_terms=None):
+    best = [None] * (n_gpus + 1)
+    best[0] = {n_layers: ()}
+
+    for g in range(1, n_gpus + 1):
+        best[g] = {}
+        # Every GPU gets at least one layer.
+        # The remaining n_gpus - g GPUs need at least one layer each as well.
+        first_start = 0 if all_starts else n_gpus - g
+        for start in range(first_start, n_layers - g + 1):
+            if g == 1:
+                mem = predict_stage(mem_isolated, added_prefix, start, n_layers, margins)
+                mem += stage_schedule_mem(start, n_gpus - g, schedule_terms)
+                best[g][start] = (stage_cost(mem, n_gpus - g, capacities),)
+                continue
+            candidate = None
+            for end in range(start + 1, n_layers - g + 2):
+                mem = predict_stage(mem_isolated, added_prefix, start, end, margins)
+                mem += stage_schedule_mem(start, n_gpus - g, schedule_terms)
+                peaks = insert_sorted(best[g-1][end], stage_cost(mem, n_gpus - g, capacities))
+                if candidate is None or peaks < candidate:
+                    candidate = peaks
+            best[g][start] = candidate
+
+    return best
+
+# Find the best memory-balanced partitioning with dynamic programming.
+# The result is identical to that of the brute-force predictor: the peak
+# memory usage is minimized, ties are broken with the tie-breaker rule,
+# and remaining ties are broken by picking the partitioning that
+# generate_partitionings() yields first.
+# Runs in O(n_layers^2 * n_gpus) stage predictions. Every one of them is
+# inserted into and compared as a sorted tuple of up to n_gpus predictions, so
+# the total time is O(n_layers^2 * n_gpus^2): at 1000 layers and 128 GPUs
+# that is too slow in Python (see bench_predictors.py).
+# If capacities (memory capacity of the GPU at each position in the pipeline)
+# is given, the utilization of the GPUs is balanced instead of the memory usage.
+# If margins is given, a quantile of the memory usage is balanced (see get_margins()).
+# If schedule_terms is given, the stashed activations of each position are added (see stage_schedule_mem()).
+# Out args:
+#   partitioning: number of layers on each GPU, e.g. [3, 3, 4, 2]
+#   prediction: predicted peak memory usage of each GPU
+def dp_balanced_partitioning(mem_arrays, n_layers, n_gpus, capacities=None, margins=None, schedule_terms=None):
+    if n_layers < n_gpus:
+        raise ValueError("n_layers must be >= n_gpus")
+
+    # Plain Python integers are faster than NumPy scalars for single stages.
+    mem_isolated, added_prefix = [a.tolist() for a in mem_arrays]
+    if margins is not None:
+        var_isolated, var_prefix, z = margins
+        margins = (var_isolated.tolist(), var_prefix.tolist(), z)
+    if schedule_terms is not None:
+        schedule_terms = [list(terms) for terms in schedule_terms]
+    best = get_suffix_table(mem_isolated, added_prefix, n_layers, n_gpus, capacities=capacities, margins=margins,
+                            schedule_terms=schedule_terms)
+
+    return reconstruct_dp_partitioning(mem_isolated, added_prefix, best, n_layers, n_gpus, capacities, margins,
+                                       schedule_terms)
+
+# Find the partitioning of dp_balanced_partitioning() from a suffix table
+# that holds (at least) the suffixes needed for n_gpus.
+def reconstruct_dp_partitioning(mem_isolated, added_prefix, best, n_layers, n_gpus, capacities=None, margins=None,
+                                schedule_terms=None):
+    # The tie-breaker rule ignores the GPU with the lowest peak memory usage.
+    n_compared = max(n_gpus - 1, 1)
+    optimum = best[n_gpus][0][:n_compared]
+
+    # Walk through the layers and give each GPU as few layers as possible,
+    # as long as the best completion of the remaining layers still reaches
+    # the optimum. This picks the partitioning the brute-force method
+    # enumerates first among all optimal ones.
+    partitioning = []
+    prediction = []
+    placed = ()
+    start = 0
+    for gpu in range(n_gpus - 1):
+        gpus_left = n_gpus - gpu - 1
+        for end in range(start + 1, n_layers - gpus_left + 1):
+            mem = predict_stage(mem_isolated, added_prefix, start, end, margins)
+            mem += stage_schedule_mem(start, gpu, schedule_terms)
+            peaks = insert_sorted(placed, stage_cost(mem, gpu, capacities))
+            completion = tuple(sorted(peaks + best[gpus_left][end], reverse=True))
+            if completion[:n_compared] == optimum:
+                break
+        partitioning.append(end - start)
+        prediction.append(mem)
+        placed = peaks
+        start = end
 
-    if debug:
-        print_partitionings(partitionings, mem)
+    partitioning.append(n_layers - start)
+    prediction.append(predict_stage(mem_isolated, added_prefix, start, n_layers, margins)
+                      + stage_schedule_mem(start, n_gpus - 1, schedule_terms))
 
+    return partitioning, prediction
+
+# Find the best memory-balanced partitioning for every number of GPUs from
+# min_gpus to max_gpus in one pass. The suffix table for max_gpus contains
+# the tables for all smaller numbers of GPUs, so it is only built once.
+# Each result is identical to that of dp_balanced_partitioning().
+# Out args:
+#   {n_gpus: (partitioning, prediction)}
+def dp_balanced_partitionings(mem_arrays, n_layers, max_gpus, min_gpus=2):
+    max_gpus = min(max_gpus, n_layers)
+    mem_isolated, added_prefix = [a.tolist() for a in mem_arrays]
+    best = get_suffix_table(mem_isolated, added_prefix, n_layers, max_gpus, all_starts=True)
+
+    results = {}
+    for n_gpus in range(min_gpus, max_gpus + 1):
+        results[n_gpus] = reconstruct_dp_partitioning(mem_isolated, added_prefix, best, n_layers, n_gpus)
+    return results
+
+# Convert a partitioning (number of layers on each GPU) to the stage_to_cut
+# argument of varuna: the first cutpoint of each stage.
+def to_stage_to_cut(partitioning):
+    cutpoints = []
+    last = 0
+    for n in partitioning:
+        cutpoints.append(last)
+        last += n
+    return ','.join(str(c) for c in cutpoints)
+
+# Write the best partitioning for every number of GPUs from min_gpus to
+# max_gpus to a JSON file, which varuna's launcher can look up with
+# --stage_to_cut_table when the number of pipeline stages changes:
+#   {"<n_gpus>": {"partitioning": [...], "prediction": [...], "peak": ..., "stage_to_cut": "0,3,..."}}
+def write_partitioning_table(mem_stats, n_layers, max_gpus, table_filename, min_gpus=2):
+    mem_arrays = mem_stats_to_arrays(mem_stats, n_layers)
+
+    start = time.time()
+    results = dp_balanced_partitionings(mem_arrays, n_layers, max_gpus, min_gpus)
+    end = time.time()
+
+    table = {}
+    for n_gpus, (partitioning, prediction) in results.items():
+        table[str(n_gpus)] = {"partitioning": partitioning,
+                              "prediction": prediction,
+                              "peak": max(prediction),
+                              "stage_to_cut": to_stage_to_cut(partitioning)}
+        print(n_gpus, "GPUs:", partitioning, "peak:", max(prediction))
+
+    with open(table_filename, 'w') as f:
+        json.dump(table, f, indent=1)
+
+    print("Time taken (s):", end-start)
+    print("Wrote partitionings for", len(table), "GPU counts to", table_filename)
+
+    return table
+
+# Lowest possible 'depth' highest per-GPU predictions (sorted in descending
+# order) when placing the layers [start, n_layers) on g GPUs, for every suffix
+# of the layers and every number of GPUs:
+#   top_peaks[g][start]
+# This is get_suffix_table() limited to the highest 'depth' GPUs, which
+# keeps it cheap, and is used as a lower bound by branch-and-bound.
+def get_top_peaks_table(mem_isolated, added_prefix, n_layers, n_gpus, depth):
+    top_peaks = [None] * (n_gpus + 1)
+    top_peaks[0] = {n_layers: ()}
+
+    for g in range(1, n_gpus + 1):
+        top_peaks[g] = {}
+        for start in range(n_gpus - g, n_layers - g + 1):
+            candidate = None
+            ends = range(start + 1, n_layers - g + 2) if g > 1 else [n_layers]
+            for end in ends:
+                mem = predict_stage(mem_isolated, added_prefix, start, end)
+                peaks = insert_sorted(top_peaks[g-1][end], mem)[:depth]
+                if candidate is None or peaks < candidate:
+                    candidate = peaks
+            top_peaks[g][start] = candidate
+
+    return top_peaks
+
+# Pad or truncate the predictions sorted in descending order to the values
+# compared by the tie-breaker rule. Missing GPUs count as -inf, so a partial
+# partitioning never compares higher than any of its completions.
+def partial_key(peaks, n_compared):
+    key = sorted(peaks, reverse=True)[:n_compared]
+    return key + [-math.inf] * (n_compared - len(key))
+
+# Branch-and-bound search over the partitionings, in the same order as
+# generate_partitionings(). A subtree is pruned as soon as the stages placed
+# so far, together with the lowest possible highest predictions of the
+# remaining stages (see get_top_peaks_table()), cannot beat the best
+# partitioning found so far. Adding the same stages to two candidates does
+# not change which one is better, so this never prunes a better
+# partitioning, and the result is identical to that of 'bf'.
+# The search starts from the peak memory usage found by 'bs_tb', which does
+# not decide ties: until the first partitioning is found, equal subtrees are
+# still searched.
+def branch_and_bound_partitioning(mem_arrays, n_layers, n_gpus):
+    if n_layers < n_gpus:
+        raise ValueError("n_layers must be >= n_gpus")
+
+    mem_isolated, added_prefix = [a.tolist() for a in mem_arrays]
+    n_compared = max(n_gpus - 1, 1)
+    depth = n_compared if bound_depth is None else bound_depth
+    top_peaks = get_top_peaks_table(mem_isolated, added_prefix, n_layers, n_gpus, depth)
+
+    partitioning, prediction = bs_tb(mem_arrays, n_gpus)
+    best = {"key": partial_key(prediction, n_compared), "found": False,
+            "partitioning": None, "prediction": None}
+
+    def cannot_improve(key):
+        if best["found"]:
+            return key >= best["key"]
+        return key > best["key"]
+
+    def search(start, gpus_left, layers, prediction):
+        if gpus_left == 1:
+            prediction = prediction + [predict_stage(mem_isolated, added_prefix, start, n_layers)]
+            if cannot_improve(partial_key(prediction, n_compared)):
+                return
+            best["key"] = partial_key(prediction, n_compared)
+            best["found"] = True
+            best["partitioning"] = layers + [n_layers - start]
+            best["prediction"] = prediction
+            return
+
+        for end in range(start + 1, n_layers - gpus_left + 2):
+            mem = predict_stage(mem_isolated, added_prefix, start, end)
+            bound = prediction + [mem] + list(top_peaks[gpus_left-1][end])
+            if cannot_improve(partial_key(bound, n_compared)):
+                continue
+            search(end, gpus_left - 1, layers + [end - start], prediction + [mem])
+
+    search(0, n_gpus, [], [])
+
+    return best["partitioning"], best["prediction"]
+
+# Determine the number of layers from the partitionings read from the profiling output.
+def get_n_layers(partitionings):
     n_layers = partitionings[0][-1]
     if n_layers == 1:
         n_layers = partitionings[-1][-2]+1
     if n_layers == 41:
         n_layers = 42# TODO: un-hardcode!
+    return n_layers
 
+# Make sure all partitionings end with the number of layers.
+def set_n_layers(partitionings, n_layers):
     for p in partitionings:
         if p[-1] == 1:
             p[-1] = n_layers
+
+# Predict from the profiling output in slurm_filename. Returns the result of
+# find_balanced_partitioning(), or the table of write_partitioning_table() for 'dp_all'.
+# The memory usage is balanced for 'metric' (see varuna_mem_stats.METRICS), the
+# result also holds the predictions for the other metrics:
+#   metric: the metric that was balanced
+#   predictions_by_metric: {metric: predicted memory usage of each GPU}
+def predict_from_profiling_output(slurm_filename, predictor='bf', n_gpus=None,
+                                  table_filename='partitioning_table.json', capacities=None, quantile=None,
+                                  metric="allocated"):
+    check_predictor_options(predictor, capacities, quantile)
+    partitionings, mems = read_input_varuna_metrics(slurm_filename)
+    mem = mems[metric]
+    # print(partitionings[0])
+    # If no n_gpus given to predict for, use same as in profiling runs.
+    if n_gpus is None:
+        n_gpus = len(partitionings[0]) - 1
+    # print(n_gpus)
+
+    if debug:
+        print_partitionings(partitionings, mem)
+
+    n_layers = get_n_layers(partitionings)
+    set_n_layers(partitionings, n_layers)
     # print(n_layers)
 
     if debug:
@@ -651,6 +1382,11 @@ def main(slurm_filename, predictor='bf', n_gpus=None):
     if debug:
         print_results(results)
 
+    # Keep the spread of the results, to predict a quantile of the memory usage.
+    variances = None
+    if quantile is not None:
+        variances = get_mem_variances(results)
+
     # If there are multiple values for mem isolated and mem added for a layer,
     # take the mean of those results.
     results = average_results(results)
@@ -658,14 +1394,71 @@ def main(slurm_filename, predictor='bf', n_gpus=None):
     if debug:
         print_results(results)
 
-    # Find the best memory-balanced partitioning for training on n_gpus gpus.
-    find_balanced_partitioning(results, n_layers, n_gpus, predictor)
+    # Find the best memory-balanced partitioning for training on n_gpus gpus,
+    # or for every number of GPUs up to n_gpus.
+    if predictor == "dp_all":
+        return write_partitioning_table(results, n_layers, n_gpus, table_filename)
+    result = find_balanced_partitioning(results, n_layers, n_gpus, predictor, capacities, variances, quantile)
     # binary_search_find_balanced_partitioning(results, n_layers, n_gpus, predictor)
 
+    # Predict the other metrics for the same partitioning, from their own statistics.
+    result["metric"] = metric
+    result["predictions_by_metric"] = {}
+    for other_metric, other_mem in mems.items():
+        profiling_data = [{"partitioning": p, "mem": m} for p, m in zip(partitionings, other_mem)]
+        other_results = average_results(get_mem_stats(profiling_data, n_layers))
+        predictions, _ = predict_batch(np.array([result["partitioning"]]), mem_stats_to_arrays(other_results, n_layers))
+        result["predictions_by_metric"][other_metric] = predictions[0].tolist()
+
+        if other_metric != metric:
+            GB = 1024**3
+            print("Predicted peak", other_metric, "memory usage (GB):")
+            print([x / GB for x in result["predictions_by_metric"][other_metric]])
+
+    return result
+
+# If json_output is set, only the result is written to stdout, as JSON, so
+# it can be used directly by a launch script, e.g.:
+#   python3 calc_mem_stats.py slurm-<id>.out dp 8 --json | jq -r .stage_to_cut
+# Everything else that is printed goes to stderr.
+def main(slurm_filename, predictor='bf', n_gpus=None, table_filename='partitioning_table.json',
+         capacities=None, json_output=False, quantile=None, metric="allocated"):
+    if not json_output:
+        return predict_from_profiling_output(slurm_filename, predictor, n_gpus, table_filename, capacities,
+                                             quantile, metric)
+
+    with contextlib.redirect_stdout(sys.stderr):
+        result = predict_from_profiling_output(slurm_filename, predictor, n_gpus, table_filename, capacities,
+                                               quantile, metric)
+    print(json.dumps(result))
+    return result
+
 
 if __name__ == "__main__":
+    json_output = "--json" in sys.argv
+    if json_output:
+        sys.argv.remove("--json")
+
+    metric = "allocated"
+    if "--reserved" in sys.argv:
+        sys.argv.remove("--reserved")
+        metric = "reserved"
+
+    quantile = None
+    for arg in list(sys.argv):
+        if arg.startswith("--quantile="):
+            quantile = float(arg.split("=")[1])
+            sys.argv.remove(arg)
+
     if len(sys.argv) < 2:
-        print("Usage: python3 calc_mem_stats.py <slurm-<id>.out> <predictor (bf/bo/bs/bs_tb)> <n_gpus (target run)>")
+        print("Usage: python3 calc_mem_stats.py <slurm-<id>.out> <predictor (bf/bf_stream/bf_parallel/bo/bs/bs_tb/bb/dp)> <n_gpus (target run)>")
+        print("       python3 calc_mem_stats.py <slurm-<id>.out> dp_all <max n_gpus> [<table.json>]")
+        print("       python3 calc_mem_stats.py <slurm-<id>.out> <predictor (" + "/".join(capacity_predictors) +
+              ")> <n_gpus> <capacity per GPU (GB), e.g. 16,16,32,32>")
+        print("       add --json to only write the result to stdout, as JSON")
+        print("       add --quantile=<q> (e.g. 0.99) to balance that quantile of the memory usage (" +
+              "/".join(quantile_predictors) + ")")
+        print("       add --reserved to balance the peak reserved instead of the peak allocated memory")
         sys.exit()
 
     n_gpus = None
@@ -677,4 +1470,22 @@ if __name__ == "__main__":
     if len(sys.argv) > 3:
         n_gpus = int(sys.argv[3])
 
-    main(sys.argv[1], predictor, n_gpus)
\ No newline at end of file
+    capacities = None
+    if len(sys.argv) > 4 and predictor != "dp_all":
+        GB = 1024**3
+        capacities = [int(float(c) * GB) for c in sys.argv[4].split(',')]
+
+    try:
+        check_predictor_options(predictor, capacities, quantile)
+        if capacities is not None and n_gpus is not None and len(capacities) != n_gpus:
+            raise ValueError("capacities must have one entry per GPU")
+    except ValueError as e:
+        print("Error:", e, file=sys.stderr)
+        sys.exit(1)
+
+    if len(sys.argv) > 4 and predictor == "dp_all":
+        main(sys.argv[1], predictor, n_gpus, sys.argv[4], json_output=json_output, quantile=quantile, metric=metric)
+    elif capacities is not None:
+        main(sys.argv[1], predictor, n_gpus, capacities=capacities, json_output=json_output, quantile=quantile, metric=metric)
+    else:
+        main(sys.argv[1], predictor, n_gpus, json_output=json_output, quantile=quantile, metric=metric)
\ No newline at end of file
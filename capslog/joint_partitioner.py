@@ -0,0 +1,184 @@
+import os
+import sys
+import time
+import pickle
+from calc_mem_stats import get_n_layers, set_n_layers, get_mem_stats, do_completeness_check, \
+    average_results, mem_stats_to_arrays, predict_stage, convert_to_forward_layers, to_stage_to_cut
+from varuna_mem_stats import read_input_varuna
+
+# Partitioner that balances both the peak memory usage (predicted with the
+# CAPSlog statistics) and the compute time of the pipeline stages (from the
+# compute-profile-* files written by varuna's Profiler, one per cutpoint).
+# Unlike AutoConfig, the stages do not need to have the same number of cutpoints.
+#
+# Step time model: with n_microbatches micro-batches, a pipeline with stage
+# times t_0, ..., t_{G-1} (forward + backward of one micro-batch) takes
+#   sum(t) + (n_microbatches - 1) * max(t)
+# The sum is the same for every partitioning, so the step time is minimized
+# by minimizing the time of the slowest stage. Communication is not modelled.
+
+# Read the forward and backward time of each cutpoint for a micro-batch size,
+# the same way AutoConfig.read_profile() does. Missing profiles are filled
+# in with the profile of cutpoint 0 if autofill_missing_compute is set.
+def read_compute_times(profile_folder, n_layers, micro_batch_size, autofill_missing_compute=False):
+    compute_profiles = []
+    for i in range(n_layers):
+        profile_path = os.path.join(profile_folder, f"compute-profile-{i}")
+        if os.path.exists(profile_path):
+            with open(profile_path, "rb") as f:
+                compute_profile = pickle.load(f)
+        else:
+            assert autofill_missing_compute and i > 0, \
+                "Missing compute profiles! Profile should have compute for at least one cutpoint." + \
+                "Enable flag autofill_missing_compute if some others are missing."
+            compute_profile = compute_profiles[0]
+        compute_profiles.append(compute_profile)
+
+    times = [p[micro_batch_size]["fwd"] + p[micro_batch_size]["bwd"] for p in compute_profiles]
+    return times
+
+# Simulated step time of a partitioning (number of layers on each GPU).
+def simulate_step_time(partitioning, times, n_microbatches):
+    stage_times = []
+    start = 0
+    for n in partitioning:
+        stage_times.append(sum(times[start:start+n]))
+        start += n
+    return sum(stage_times) + (n_microbatches - 1) * max(stage_times)
+
+# Remove the points that are dominated by another point, i.e. that are not
+# better in either the slowest stage time or the peak memory usage.
+# Points are (time, peak memory, ...); the result is sorted by time.
+def pareto_filter(points):
+    front = []
+    for point in sorted(points, key=lambda p: (p[0], p[1])):
+        if len(front) == 0 or point[1] < front[-1][1]:
+            front.append(point)
+    return front
+
+# Build a table with, for every suffix of the layers and every number of GPUs,
+# the Pareto front of (slowest stage time, peak memory usage) for placing that
+# suffix on that many GPUs. Both objectives are the maximum over the stages,
+# so a point that is dominated for a suffix stays dominated when the same
+# stages are placed in front of it, which makes the front of the whole model exact.
+# Points with a peak memory usage above gpu_memory_capacity are dropped.
+#   front[g][start] = [(stage time, peak memory, end of first stage, index in front[g-1][end]), ...]
+def get_pareto_table(mem_isolated, added_prefix, time_prefix, n_layers, n_gpus, gpu_memory_capacity=None):
+    front = [None] * (n_gpus + 1)
+    front[0] = {n_layers: [(0, 0, None, None)]}
+
+    for g in range(1, n_gpus + 1):
+        front[g] = {}
+        for start in range(n_gpus - g, n_layers - g + 1):
+            ends = [n_layers] if g == 1 else range(start + 1, n_layers - g + 2)
+            candidates = []
+            for end in ends:
+                mem = predict_stage(mem_isolated, added_prefix, start, end)
+                if gpu_memory_capacity is not None and mem > gpu_memory_capacity:
+                    continue
+                stage_time = time_prefix[end] - time_prefix[start]
+                for i, (t, m, _, _) in enumerate(front[g-1][end]):
+                    candidates.append((max(stage_time, t), max(mem, m), end, i))
+            front[g][start] = pareto_filter(candidates)
+
+    return front
+
+# Follow the back-pointers of a point in the Pareto table to get the partitioning.
+def reconstruct_partitioning(mem_isolated, added_prefix, front, n_gpus, point):
+    partitioning = []
+    prediction = []
+    start = 0
+    for g in range(n_gpus, 0, -1):
+        _, _, end, i = point
+        partitioning.append(end - start)
+        prediction.append(predict_stage(mem_isolated, added_prefix, start, end))
+        point = front[g-1][end][i]
+        start = end
+    return partitioning, prediction
+
+# Find all partitionings on the Pareto front of step time and peak memory usage.
+# Out args:
+#   list of (partitioning, prediction, step time), sorted from fastest to
+#   lowest memory usage. Empty if no partitioning fits in gpu_memory_capacity.
+def pareto_partitionings(mem_arrays, times, n_layers, n_gpus, n_microbatches, gpu_memory_capacity=None):
+    if n_layers < n_gpus:
+        raise ValueError("n_layers must be >= n_gpus")
+
+    mem_isolated, added_prefix = [a.tolist() for a in mem_arrays]
+    time_prefix = [0]
+    for t in times:
+        time_prefix.append(time_prefix[-1] + t)
+
+    front = get_pareto_table(mem_isolated, added_prefix, time_prefix, n_layers, n_gpus, gpu_memory_capacity)
+
+    results = []
+    for point in front[n_gpus].get(0, []):
+        partitioning, prediction = reconstruct_partitioning(mem_isolated, added_prefix, front, n_gpus, point)
+        step_time = simulate_step_time(partitioning, times, n_microbatches)
+        results.append((step_time, max(prediction), partitioning, prediction))
+
+    # With a single micro-batch, different slowest stage times give the same step time.
+    results = pareto_filter(results)
+    return [(partitioning, prediction, step_time) for step_time, _, partitioning, prediction in results]
+
+# Find the partitioning with the lowest simulated step time of which all stages
+# fit in gpu_memory_capacity. Of the partitionings with the same step time,
+# the one with the lowest peak memory usage is picked.
+# Returns None if no partitioning fits.
+def joint_balanced_partitioning(mem_arrays, times, n_layers, n_gpus, n_microbatches, gpu_memory_capacity):
+    results = pareto_partitionings(mem_arrays, times, n_layers, n_gpus, n_microbatches, gpu_memory_capacity)
+    if len(results) == 0:
+        return None
+    return results[0]
+
+def print_joint_result(partitioning, prediction, step_time, time_taken):
+    print("Partitioning:", convert_to_forward_layers(partitioning))
+    print("Stage to cut:", to_stage_to_cut(partitioning))
+    print("Prediction:", prediction)
+    print("Peak:", max(prediction))
+    print("Simulated step time:", step_time)
+    print("Time taken (s):", time_taken)
+
+def main(slurm_filename, profile_folder, n_gpus, micro_batch_size, n_microbatches, gpu_memory_capacity=None):
+    partitionings, mem = read_input_varuna(slurm_filename)
+    n_layers = get_n_layers(partitionings)
+    set_n_layers(partitionings, n_layers)
+
+    profiling_data = []
+    for p, m in zip(partitionings, mem):
+        profiling_data.append({"partitioning": p, "mem": m})
+
+    results = get_mem_stats(profiling_data, n_layers)
+    do_completeness_check(results, n_layers)
+    results = average_results(results)
+    mem_arrays = mem_stats_to_arrays(results, n_layers)
+
+    times = read_compute_times(profile_folder, n_layers, micro_batch_size)
+
+    start = time.time()
+    front = pareto_partitionings(mem_arrays, times, n_layers, n_gpus, n_microbatches, gpu_memory_capacity)
+    end = time.time()
+
+    if len(front) == 0:
+        print("No partitioning fits in", gpu_memory_capacity, "bytes")
+        return
+
+    # Without a memory capacity, show the trade-off between the two objectives.
+    if gpu_memory_capacity is None:
+        print("Pareto front (step time, peak memory):")
+        for partitioning, prediction, step_time in front:
+            print(step_time, max(prediction), to_stage_to_cut(partitioning))
+
+    partitioning, prediction, step_time = front[0]
+    print_joint_result(partitioning, prediction, step_time, end-start)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 6:
+        print("Usage: python3 joint_partitioner.py <slurm-<id>.out> <profile_folder> <n_gpus> <micro_batch_size> <n_microbatches> [<gpu_memory_capacity (bytes)>]")
+        sys.exit()
+
+    gpu_memory_capacity = None
+    if len(sys.argv) > 6:
+        gpu_memory_capacity = int(sys.argv[6])
+
+    main(sys.argv[1], sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), int(sys.argv[5]), gpu_memory_capacity)
@@ -0,0 +1,118 @@
+import sys
+import numpy as np
+from calc_mem_stats import get_n_layers, set_n_layers, get_mem_stats, do_completeness_check, \
+    average_results, find_balanced_partitioning
+from varuna_mem_stats import read_input_varuna
+
+# Extrapolate the CAPSlog statistics to micro-batch sizes (chunk sizes) that
+# were not profiled. Mem isolated and mem added of each layer are modelled as
+#   mem(chunk_size) = constant + slope * chunk_size
+# where the constant is the memory that does not depend on the micro-batch
+# size (parameters, gradients and optimizer state) and the slope is the
+# activation memory per sample. The model is fitted (least squares) to the
+# statistics of profiling campaigns with two or more chunk sizes.
+
+# Get the averaged statistics (see average_results()) from the output of a
+# profiling campaign.
+def read_mem_stats(slurm_filename, metric="allocated"):
+    partitionings, mem = read_input_varuna(slurm_filename, metric)
+    n_layers = get_n_layers(partitionings)
+    set_n_layers(partitionings, n_layers)
+
+    profiling_data = []
+    for p, m in zip(partitionings, mem):
+        profiling_data.append({"partitioning": p, "mem": m})
+
+    results = get_mem_stats(profiling_data, n_layers)
+    do_completeness_check(results, n_layers)
+    return average_results(results), n_layers
+
+# Fit the model to the statistics of each layer.
+# In args:
+#   mem_stats_by_chunk_size: {chunk_size: averaged statistics}, at least two chunk sizes.
+# Out args:
+#   model: {layer: {"mem_isolated": (constant, slope), "mem_added": (constant, slope) or None}}
+def fit_model(mem_stats_by_chunk_size, n_layers):
+    if len(mem_stats_by_chunk_size) < 2:
+        raise ValueError("at least two chunk sizes are needed to fit the model")
+
+    chunk_sizes = sorted(mem_stats_by_chunk_size)
+    model = {}
+    for layer in range(n_layers):
+        model[layer] = {}
+        for metric in ("mem_isolated", "mem_added"):
+            if layer == 0 and metric == "mem_added":
+                model[layer][metric] = None
+                continue
+            values = [mem_stats_by_chunk_size[c][layer][metric] for c in chunk_sizes]
+            slope, constant = np.polyfit(chunk_sizes, values, 1)
+            model[layer][metric] = (float(constant), float(slope))
+    return model
+
+# Predict the statistics of each layer for a chunk size, in the same format
+# as average_results() outputs.
+def extrapolate_mem_stats(model, chunk_size):
+    mem_stats = {}
+    for layer, params in model.items():
+        mem_stats[layer] = {}
+        for metric, fit in params.items():
+            if fit is None:
+                mem_stats[layer][metric] = None
+            else:
+                constant, slope = fit
+                mem_stats[layer][metric] = int(round(constant + slope * chunk_size))
+    return mem_stats
+
+# Largest difference between the fitted model and the statistics it was fitted
+# to, relative to the statistic. Zero if the model was fitted to two chunk sizes;
+# with three or more it shows how well the linear model holds.
+def get_max_fit_error(model, mem_stats_by_chunk_size):
+    max_error = 0.0
+    for chunk_size, mem_stats in mem_stats_by_chunk_size.items():
+        predicted = extrapolate_mem_stats(model, chunk_size)
+        for layer in model:
+            for metric in ("mem_isolated", "mem_added"):
+                if predicted[layer][metric] is None or mem_stats[layer][metric] == 0:
+                    continue
+                error = abs(predicted[layer][metric] - mem_stats[layer][metric]) / abs(mem_stats[layer][metric])
+                max_error = max(max_error, error)
+    return max_error
+
+# Find the best memory-balanced partitioning for a chunk size that was not
+# profiled, from profiling campaigns with other chunk sizes.
+# In args:
+#   slurm_filenames_by_chunk_size: {chunk_size: output of the profiling campaign}
+# Returns the result of find_balanced_partitioning().
+def predict_for_chunk_size(slurm_filenames_by_chunk_size, chunk_size, n_gpus, predictor='dp', metric="allocated"):
+    mem_stats_by_chunk_size = {}
+    n_layers = None
+    for profiled_chunk_size, slurm_filename in slurm_filenames_by_chunk_size.items():
+        mem_stats, n = read_mem_stats(slurm_filename, metric)
+        if n_layers is not None and n != n_layers:
+            raise ValueError("the profiling campaigns have a different number of layers")
+        n_layers = n
+        mem_stats_by_chunk_size[profiled_chunk_size] = mem_stats
+
+    model = fit_model(mem_stats_by_chunk_size, n_layers)
+    print("Largest relative error of the fit:", get_max_fit_error(model, mem_stats_by_chunk_size))
+
+    mem_stats = extrapolate_mem_stats(model, chunk_size)
+    print("Predicting for chunk size", chunk_size)
+    return find_balanced_partitioning(mem_stats, n_layers, n_gpus, predictor)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 6:
+        print("Usage: python3 mbs_extrapolation.py <predictor> <n_gpus> <chunk_size (target run)> "
+              "<chunk_size>:<slurm-<id>.out> <chunk_size>:<slurm-<id>.out> [...]")
+        sys.exit()
+
+    predictor = sys.argv[1]
+    n_gpus = int(sys.argv[2])
+    chunk_size = int(sys.argv[3])
+
+    slurm_filenames_by_chunk_size = {}
+    for arg in sys.argv[4:]:
+        profiled_chunk_size, slurm_filename = arg.split(":", 1)
+        slurm_filenames_by_chunk_size[int(profiled_chunk_size)] = slurm_filename
+
+    predict_for_chunk_size(slurm_filenames_by_chunk_size, chunk_size, n_gpus, predictor)
@@ -1,5 +1,8 @@
+import sys
+import math
+import itertools
 from calc_mem_stats import partitionings_to_cutpoints, \
-    find_mem_isolated, find_mem_added, get_mem_stats, do_completeness_check, print_results
+    find_mem_isolated, find_mem_added, get_mem_stats, do_completeness_check, print_results, get_missing_stats
 import numpy as np
 
 
@@ -174,6 +177,267 @@ def get_trimmed_partitionings(n_gpus, n_layers):
 
     return partitionings, profiling_stages
 
+# Put the cutpoints of the given partitionings and mocked(!) memory results
+# in the format of get_mem_stats(). Trimmed stages (not in profiling_stages)
+# get memory 0, like in profiling runs. If profiling_stages is None, no
+# stages are trimmed.
+def get_mocked_profiling_data(ps, profiling_stages=None):
+    partitionings = [partitionings_to_cutpoints(p) for p in convert_to_forward_layers(ps)]
+
+    data = []
+    for i,p in enumerate(partitionings):
+        contentful_stages = range(len(p)) if profiling_stages is None else profiling_stages[i]
+        mem = []
+        for j in range(len(p)):
+            if j in contentful_stages:
+                mem.append(1)
+            else:
+                mem.append(0)
+        data.append({"partitioning": p, "mem": mem})
+    return data
+
+# The statistics that cannot be extracted from the given profiling
+# partitionings (see get_missing_stats()).
+def get_missing_profiling_stats(ps, profiling_stages, n_layers):
+    results = get_mem_stats(get_mocked_profiling_data(ps, profiling_stages), n_layers)
+    return get_missing_stats(results, n_layers)
+
+# Functions for generating a minimal set of profiling partitionings.
+#
+# Finding the fewest profiling runs from which all statistics can be extracted
+# is a covering problem. With trimming, a run profiles at most 2 intact layers
+# per GPU, so the stages that have to be profiled are:
+#   [l, l+1) for every layer l (mem isolated of l), and
+#   [l-1, l+1) for every layer l > 0 (mem added of l, with [l-1, l)).
+# A run places some of these stages on its GPUs, and needs one trimmed stage
+# for every gap between them, so a run with stages [a, b) covers at most
+# n_gpus - (a > 0) - (b < n_layers) of them when they are contiguous.
+# The stages form three chains of contiguous stages (all single layers, pairs
+# starting at even layers and pairs starting at odd layers). Cutting the
+# chains into runs that fill all GPUs, and packing the leftover pieces of the
+# chains together, reaches (or comes within one run of) the lower bound of
+# get_min_trimmed_runs() in practice.
+
+# Number of stages of a run profiling the given (disjoint) stages, including
+# the trimmed stages for the gaps between them.
+def count_run_stages(stages, n_layers):
+    n_stages = len(stages)
+    end = 0
+    for start, stage_end in sorted(stages):
+        if start > end:
+            n_stages += 1
+        end = stage_end
+    if end < n_layers:
+        n_stages += 1
+    return n_stages
+
+# Whether the (disjoint) stages are contiguous, so that a run profiling them
+# only has trimmed stages at the start and end of the pipeline. Varuna does
+# not support trimmed stages in the middle of the pipeline (see
+# PartitionedModel.remove_unused_parameters()).
+def is_contiguous(stages):
+    stages = sorted(stages)
+    return all(stages[i][1] == stages[i+1][0] for i in range(len(stages) - 1))
+
+# Convert the profiled stages of a run to a partitioning with unprofiled
+# stages in the gaps, and the indices of the profiled stages. If the
+# unprofiled stages are trimmed, they can only be at the start and end.
+def stages_to_partitioning(stages, n_layers, trimmed=True):
+    assert not trimmed or is_contiguous(stages), "trimmed stages are only supported at the start and end of the pipeline"
+    partitioning = []
+    profiling_stages = []
+    end = 0
+    for start, stage_end in sorted(stages):
+        if start > end:
+            partitioning.append(start - end)
+        profiling_stages.append(len(partitioning))
+        partitioning.append(stage_end - start)
+        end = stage_end
+    if end < n_layers:
+        partitioning.append(n_layers - end)
+    return partitioning, profiling_stages
+
+def get_profiling_chains(n_layers):
+    singles = [(l, l+1) for l in range(n_layers)]
+    even_pairs = [(l, l+2) for l in range(0, n_layers-1, 2)]
+    odd_pairs = [(l, l+2) for l in range(1, n_layers-1, 2)]
+    return [singles, even_pairs, odd_pairs]
+
+# Cut a chain into pieces that each fill a run. The leftover piece is at the
+# end of the chain, or at the start if backward is set.
+def cut_chain(chain, n_gpus, n_layers, backward=False):
+    pieces = []
+    piece = []
+    for stage in (chain[::-1] if backward else chain):
+        if count_run_stages(piece + [stage], n_layers) > n_gpus:
+            pieces.append(sorted(piece))
+            piece = []
+        piece.append(stage)
+    pieces.append(sorted(piece))
+    return pieces
+
+def overlaps(stages, other_stages):
+    return any(a < d and c < b for a, b in stages for c, d in other_stages)
+
+# Pack pieces into runs, largest first, each into the first run it fits in
+# and is contiguous with (see is_contiguous()).
+def pack_pieces(pieces, n_gpus, n_layers):
+    runs = []
+    for piece in sorted(pieces, key=len, reverse=True):
+        for run in runs:
+            if not overlaps(run, piece) and is_contiguous(run + piece) and \
+                    count_run_stages(run + piece, n_layers) <= n_gpus:
+                run.extend(piece)
+                break
+        else:
+            runs.append(list(piece))
+    return runs
+
+# Lower bound on the number of trimmed profiling runs: every run but those
+# starting at the first or ending at the last layer (at most two of each,
+# as only two of the stages do) needs at least two trimmed stages. Stages
+# [0, 1), [0, 2) and [1, 2) overlap, so at least three runs are needed.
+def get_min_trimmed_runs(n_gpus, n_layers):
+    return max(3, math.ceil((2 * n_layers - 5) / (n_gpus - 2)))
+
+# Remove profiling runs of which all statistics can also be extracted from
+# the other runs, trying the runs that profile the fewest stages first.
+def remove_redundant_runs(ps, profiling_stages, n_layers):
+    ps = list(ps)
+    profiling_stages = None if profiling_stages is None else list(profiling_stages)
+
+    def n_profiled(i):
+        return len(ps[i]) if profiling_stages is None else len(profiling_stages[i])
+
+    for i in sorted(range(len(ps)), key=n_profiled):
+        kept = [j for j in range(len(ps)) if j != i and ps[j] is not None]
+        kept_stages = None if profiling_stages is None else [profiling_stages[j] for j in kept]
+        if len(get_missing_profiling_stats([ps[j] for j in kept], kept_stages, n_layers)) == 0:
+            ps[i] = None
+
+    kept = [j for j in range(len(ps)) if ps[j] is not None]
+    return [ps[j] for j in kept], None if profiling_stages is None else [profiling_stages[j] for j in kept]
+
+# Generates the fewest trimmed profiling partitionings found by the covering
+# search, in the format of get_trimmed_partitionings().
+def get_minimal_trimmed_partitionings(n_gpus, n_layers):
+    if n_gpus < 3 or n_layers < 3:
+        raise ValueError("For minimal profiling, n_gpus and n_layers must be >= 3")
+
+    best = None
+    chains = get_profiling_chains(n_layers)
+    for backward in itertools.product([False, True], repeat=len(chains)):
+        pieces = []
+        for chain, b in zip(chains, backward):
+            pieces += cut_chain(chain, n_gpus, n_layers, b)
+        runs = pack_pieces(pieces, n_gpus, n_layers)
+        if best is None or len(runs) < len(best):
+            best = runs
+
+    partitionings = []
+    profiling_stages = []
+    for run in sorted(best):
+        partitioning, stages = stages_to_partitioning(run, n_layers)
+        partitionings.append(partitioning)
+        profiling_stages.append(stages)
+
+    return remove_redundant_runs(partitionings, profiling_stages, n_layers)
+
+# Generates profiling partitionings from which the given missing statistics
+# (see get_missing_stats()) can be extracted, with at most max_profiled
+# profiled stages per run. Used to replace failed profiling runs: fewer
+# profiled stages per run leave more GPUs for the rest of the model.
+# In args:
+#   isolated: layers of which mem isolated was already profiled, so their
+#       stage does not have to be profiled again for the mem added of the next layer.
+# Out args:
+#   partitionings and profiling stages, as get_minimal_partitionings() returns them.
+def get_substitute_partitionings(missing, n_gpus, n_layers, max_profiled, trimmed=True, isolated=()):
+    stages = set()
+    for layer, metric in missing:
+        if metric == "mem_isolated":
+            stages.add((layer, layer+1))
+        else:
+            stages.add((layer-1, layer+1))
+            if layer-1 not in isolated:
+                stages.add((layer-1, layer))
+
+    runs = []
+    for stage in sorted(stages):
+        for run in runs:
+            if len(run) < max_profiled and not overlaps(run, [stage]) and \
+                    (not trimmed or is_contiguous(run + [stage])) and \
+                    count_run_stages(run + [stage], n_layers) <= n_gpus:
+                run.append(stage)
+                break
+        else:
+            runs.append([stage])
+
+    partitionings = []
+    profiling_stages = []
+    for run in runs:
+        partitioning, stages = stages_to_partitioning(run, n_layers, trimmed)
+        if not trimmed:
+            partitioning, stages = spread_unprofiled_stages(partitioning, stages, n_gpus)
+        partitionings.append(partitioning)
+        profiling_stages.append(stages)
+
+    return partitionings, profiling_stages if trimmed else None
+
+# Split the stages that are not profiled over the unused GPUs, largest first,
+# so that without trimming no GPU holds a large part of the model.
+def spread_unprofiled_stages(partitioning, profiling_stages, n_gpus):
+    partitioning = list(partitioning)
+    profiling_stages = list(profiling_stages)
+    while len(partitioning) < n_gpus:
+        candidates = [i for i in range(len(partitioning)) if i not in profiling_stages and partitioning[i] > 1]
+        if len(candidates) == 0:
+            break
+        i = max(candidates, key=lambda i: partitioning[i])
+        partitioning[i:i+1] = evenly_distribute(2, partitioning[i])
+        profiling_stages = [s + 1 if s > i else s for s in profiling_stages]
+    return partitioning, profiling_stages
+
+# Generates the fewest profiling partitionings found for trimmed or untrimmed
+# profiling. Returns the partitionings and the profiling stages (None if
+# untrimmed), like get_varuna_partitionings() in profile_varuna.py.
+# Untrimmed, all stages are profiled and hold real layers, so the stages are
+# kept as small as those of get_mCAP_partitionings(), of which the redundant
+# runs are removed.
+def get_minimal_partitionings(n_gpus, n_layers, trimmed=True):
+    if trimmed:
+        partitionings, profiling_stages = get_minimal_trimmed_partitionings(n_gpus, n_layers)
+    else:
+        partitionings, profiling_stages = remove_redundant_runs(get_mCAP_partitionings(n_gpus, n_layers), None, n_layers)
+
+    missing = get_missing_profiling_stats(partitionings, profiling_stages, n_layers)
+    assert len(missing) == 0, "statistics missing from the minimal profiling partitionings: {}".format(missing)
+    return partitionings, profiling_stages
+
+# Compare the number of runs of the minimal profiling partitionings with the
+# current generator, and validate that all statistics can be extracted from them.
+def compare_profiling_sets(n_gpus, n_layers, trimmed=True):
+    if trimmed:
+        current, _ = get_trimmed_partitionings(n_gpus, n_layers)
+    else:
+        current = get_mCAP_partitionings(n_gpus, n_layers)
+    partitionings, profiling_stages = get_minimal_partitionings(n_gpus, n_layers, trimmed)
+
+    for i, p in enumerate(partitionings):
+        print(p, None if profiling_stages is None else profiling_stages[i])
+        assert sum(p) == n_layers
+        assert len(p) <= n_gpus
+
+    print("Running validity check...")
+    results = get_mem_stats(get_mocked_profiling_data(partitionings, profiling_stages), n_layers)
+    do_completeness_check(results, n_layers)
+
+    print("Profiling runs:", len(partitionings), "(current generator:", str(len(current)) + ")")
+    if trimmed:
+        print("Lower bound:", get_min_trimmed_runs(n_gpus, n_layers))
+    print("Saving: {} runs ({:.1%})".format(len(current) - len(partitionings), 1 - len(partitionings) / len(current)))
+    return len(current), len(partitionings)
+
 # Generates profiling partitionings for given n_gpus and n_layers as a test.
 # Then runs a validity check to see if mem isolated and mem added can indeed
 # be extracted from the generated profiling partitionings.
@@ -190,25 +454,14 @@ def main(n_gpus, n_layers):
     partitionings = convert_to_forward_layers(ps)
     for p in partitionings: print(p)
 
-    partitionings = [partitionings_to_cutpoints(p) for p in partitionings]
-    n_layers = partitionings[0][-1]
-
-    # Put cutpoints and mocked(!) memory results in dict for validity check.
-    data = []
-    for i,p in enumerate(partitionings):
-        contentful_stages = stages[i]
-        mem = []
-        for j in range(len(p)):
-            if j in contentful_stages:
-                mem.append(1)
-            else:
-                mem.append(0)
-        data.append({"partitioning": p, "mem": mem})
-
     # Check if indeed al profiling data can be extracted from the generated partitionings.
     print("Running validity check...")
-    results = get_mem_stats(data, n_layers)
+    results = get_mem_stats(get_mocked_profiling_data(ps, stages), n_layers)
     do_completeness_check(results, n_layers)
 
 if __name__ == "__main__":
-    main(n_gpus=8, n_layers=42)
+    if len(sys.argv) > 2:
+        compare_profiling_sets(int(sys.argv[1]), int(sys.argv[2]), trimmed="--untrimmed" not in sys.argv)
+    else:
+        print("Usage: python3 mcap_utils.py <n_gpus> <n_layers> [--untrimmed]")
+        main(n_gpus=8, n_layers=42)
@@ -0,0 +1,180 @@
+import os
+import sys
+import json
+from calc_mem_stats import index_profiling_data, get_n_layers, set_n_layers, \
+    do_completeness_check, average_results, find_balanced_partitioning, get_mem_variances
+from varuna_mem_stats import iter_profiling_runs
+
+# Persistent store of the mem isolated and mem added samples per layer,
+# so profiling output only has to be parsed once. The store is a JSON file
+# with one entry per profiled configuration:
+#   {
+#     "<model>/<chunk_size>/<precision>": {
+#       "n_layers": number of layers,
+#       "runs": [{"partitioning": cutpoints, "mem": peak memory per stage}, ...],
+#       "sources": {path of profiling output: number of runs read from it},
+#       "stats": {layer: {"mem_isolated": [samples], "mem_added": [samples]}}
+#     }
+#   }
+# The runs are kept, because mem added of a new run is extracted by
+# combining it with the runs that were added before.
+
+def get_key(model, chunk_size, precision):
+    return "{}/{}/{}".format(model, chunk_size, precision)
+
+def load_store(store_filename):
+    if not os.path.exists(store_filename):
+        return {}
+
+    with open(store_filename, 'r') as f:
+        store = json.load(f)
+
+    # JSON object keys are strings, layers are integers.
+    for entry in store.values():
+        entry["stats"] = {int(layer): stats for layer, stats in entry["stats"].items()}
+
+    return store
+
+def save_store(store, store_filename):
+    # Write to a temporary file first, so an interrupted write does not corrupt the store.
+    tmp_filename = store_filename + ".tmp"
+    with open(tmp_filename, 'w') as f:
+        json.dump(store, f)
+    os.replace(tmp_filename, store_filename)
+
+def new_entry(n_layers):
+    stats = {}
+    for layer in range(n_layers):
+        stats[layer] = {"mem_isolated": [], "mem_added": None if layer == 0 else []}
+    return {"n_layers": n_layers, "runs": [], "sources": {}, "stats": stats}
+
+# Add the statistics that can be extracted with a new profiling run to the
+# entry, without recomputing the statistics of the runs that were already in it.
+# Gives the same samples as get_mem_stats() on all runs (in a different order).
+# In args:
+#   entry: store entry to add the run to.
+#   run: {"partitioning": cutpoints, "mem": peak memory per stage}
+#   by_cut, by_prev_cut: index of the runs in the entry (see index_profiling_data),
+#       updated with the new run.
+def add_run(entry, run, by_cut, by_prev_cut):
+    n_layers = entry["n_layers"]
+    stats = entry["stats"]
+    cutpoints = run["partitioning"]
+    mem = run["mem"]
+
+    for position, cut in enumerate(cutpoints):
+        # Mem isolated: a stage holding only layer 'cut'.
+        if position + 1 < len(cutpoints) and cutpoints[position+1] == cut+1 and cut < n_layers:
+            if mem[position] > 0: # if the memory is not from a trimmed stage
+                stats[cut]["mem_isolated"].append(mem[position])
+
+        if position == 0:
+            continue
+        prev_cut = cutpoints[position-1]
+        mem_stage = mem[position-1]
+        if mem_stage <= 0:
+            continue
+
+        # Mem added of layer 'cut': the new run is the one with a stage [prev_cut, cut).
+        if 0 < cut < n_layers:
+            for e, e_position in by_prev_cut.get((cut+1, prev_cut), []):
+                mem_e = e["mem"][e_position-1]
+                if mem_e > 0:
+                    stats[cut]["mem_added"].append(mem_e - mem_stage)
+
+        # Mem added of layer 'cut-1': the new run is the one with a stage [prev_cut, cut).
+        if 0 < cut - 1 < n_layers:
+            for s, s_position in by_prev_cut.get((cut-1, prev_cut), []):
+                mem_s = s["mem"][s_position-1]
+                if mem_s > 0:
+                    stats[cut-1]["mem_added"].append(mem_stage - mem_s)
+
+    entry["runs"].append(run)
+    for position, cut in enumerate(cutpoints):
+        by_cut[cut].append((run, position))
+        by_prev_cut[(cut, cutpoints[position-1])].append((run, position))
+
+# Read the profiling runs from slurm_filename and add the ones that are not
+# in the store yet. Profiling output that was read before is only read from the
+# first new run on, so a log of a campaign that is still running can be added repeatedly.
+def add_profiling_output(store, key, slurm_filename):
+    source = os.path.abspath(slurm_filename)
+    entry = store.get(key)
+    n_read = 0 if entry is None else entry["sources"].get(source, 0)
+
+    new_runs = []
+    n_runs = 0
+    for i, run in enumerate(iter_profiling_runs(slurm_filename)):
+        n_runs = i + 1
+        if i < n_read or run["mem"] is None:
+            continue
+        new_runs.append({"partitioning": run["partitioning"], "mem": run["mem"]})
+
+    if entry is None:
+        if len(new_runs) == 0:
+            print("No successful profiling runs in", slurm_filename)
+            return 0
+        entry = new_entry(get_n_layers([r["partitioning"] for r in new_runs]))
+        store[key] = entry
+
+    set_n_layers([r["partitioning"] for r in new_runs], entry["n_layers"])
+
+    by_cut, by_prev_cut = index_profiling_data(entry["runs"])
+    for run in new_runs:
+        add_run(entry, run, by_cut, by_prev_cut)
+    entry["sources"][source] = max(n_runs, n_read)
+
+    return len(new_runs)
+
+# Get the statistics of an entry in the format of get_mem_stats().
+def get_entry_mem_stats(entry):
+    results = {}
+    for layer, stats in entry["stats"].items():
+        results[layer] = {"mem_isolated": list(stats["mem_isolated"]),
+                          "mem_added": None if stats["mem_added"] is None else list(stats["mem_added"])}
+    return results
+
+# Find the best memory-balanced partitioning from the statistics in the store.
+# Returns the result of find_balanced_partitioning().
+# If quantile is given, that quantile of the memory usage is balanced.
+def predict_from_store(store, key, predictor, n_gpus, quantile=None):
+    entry = store[key]
+    n_layers = entry["n_layers"]
+
+    results = get_entry_mem_stats(entry)
+    do_completeness_check(results, n_layers)
+    variances = get_mem_variances(results) if quantile is not None else None
+    results = average_results(results)
+
+    return find_balanced_partitioning(results, n_layers, n_gpus, predictor, variances=variances, quantile=quantile)
+
+def main(args):
+    command, store_filename, model, chunk_size, precision = args[:5]
+    key = get_key(model, chunk_size, precision)
+    store = load_store(store_filename)
+
+    if command == "add":
+        for slurm_filename in args[5:]:
+            n_added = add_profiling_output(store, key, slurm_filename)
+            print("Added", n_added, "profiling runs from", slurm_filename)
+        save_store(store, store_filename)
+
+    elif command == "predict":
+        if key not in store:
+            print("No statistics for", key, "in", store_filename)
+            sys.exit()
+        predictor = args[5]
+        n_gpus = int(args[6])
+        quantile = float(args[7]) if len(args) > 7 else None
+        predict_from_store(store, key, predictor, n_gpus, quantile)
+
+    else:
+        raise NotImplementedError
+
+if __name__ == "__main__":
+    if len(sys.argv) < 7:
+        print("Usage: python3 mem_stats_store.py add <store.json> <model> <chunk_size> <precision> <slurm-<id>.out> [...]")
+        print("       python3 mem_stats_store.py predict <store.json> <model> <chunk_size> <precision> <predictor> <n_gpus> [<quantile>]")
+        sys.exit()
+
+    main(sys.argv[1:])
@@ -0,0 +1,194 @@
+import io
+import os
+import sys
+import contextlib
+import importlib.util
+import numpy as np
+from calc_mem_stats import get_n_layers, set_n_layers, index_profiling_data, do_completeness_check, \
+    average_results, find_balanced_partitioning, schedule_predictors
+from varuna_mem_stats import read_input_varuna
+
+# Pipeline-position-aware memory model. With Varuna's schedule, a stage keeps
+# the input activations of every micro-batch that it has run forward but not
+# yet backward, so its memory usage depends on how many micro-batches are in
+# flight at its position in the pipeline, which depends on the pipeline depth
+# and the number of micro-batches. Mem isolated of each layer is modelled as
+#   mem_isolated(position) = base + in_flight(position) * activation size
+# where base does not depend on the position and the activation size is the
+# input of the layer for one micro-batch. The model is fitted (least squares)
+# to the mem isolated samples of the layer at the positions it was profiled at.
+# Mem added samples combine two stages starting at the same layer, possibly at
+# different positions; the in-flight term of that layer is taken out of both.
+# With the position-independent statistics, the memory usage can be predicted
+# for other pipeline depths than profiled.
+
+# Number of micro-batches per mini-batch of a Varuna run, the same way
+# Varuna.__init__() calculates it.
+def get_n_microbatches(batch_size, chunk_size, n_gpus, n_stages):
+    data_depth = max(n_gpus // n_stages, 1)
+    return int(np.ceil((batch_size // data_depth) / chunk_size))
+
+# Varuna's generate_schedule(), loaded from varuna/schedule.py so that the
+# varuna package and its utils (which import torch) are not imported. None if
+# the genschedule binary, compiled from varuna/generate_schedule.cc, is missing.
+def load_generate_schedule():
+    varuna_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "varuna")
+    if not os.path.exists(os.path.join(varuna_dir, "genschedule")):
+        return None
+    spec = importlib.util.spec_from_file_location("varuna_schedule", os.path.join(varuna_dir, "schedule.py"))
+    schedule = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(schedule)
+    return schedule.generate_schedule
+
+in_flight_cache = {}
+
+# Largest number of micro-batches that are in flight (run forward but not yet
+# backward) on a stage during Varuna's schedule. Tasks in the schedule are
+# 0: forward, 1: recompute, 2: backward.
+# Without the genschedule binary, the closed form that the schedule follows
+# is used (checked against genschedule for depths 2 to 8 with 16 micro-batches):
+# 3 * (number of stages after it), at most n_microbatches, and 1 on the last stage.
+def get_in_flight(n_stages, n_microbatches, stage):
+    key = (n_stages, n_microbatches, stage)
+    if key in in_flight_cache:
+        return in_flight_cache[key]
+
+    generate_schedule = load_generate_schedule()
+    if generate_schedule is None:
+        in_flight = min(n_microbatches, max(1, 3 * (n_stages - 1 - stage)))
+    else:
+        with contextlib.redirect_stdout(io.StringIO()): # generate_schedule() prints the number of chunks
+            schedule = generate_schedule(n_microbatches, stage, n_stages)
+        in_flight = 0
+        max_in_flight = 0
+        for task, _ in schedule:
+            if task == 0:
+                in_flight += 1
+            elif task == 2:
+                in_flight -= 1
+            max_in_flight = max(max_in_flight, in_flight)
+        in_flight = max_in_flight
+
+    in_flight_cache[key] = in_flight
+    return in_flight
+
+# Number of micro-batches in flight at each position of a pipeline with n_stages stages.
+def get_in_flight_per_stage(n_stages, n_microbatches):
+    return [get_in_flight(n_stages, n_microbatches, stage) for stage in range(n_stages)]
+
+# Extract the mem isolated samples of a layer together with the number of
+# micro-batches in flight on the stage they were measured on.
+# Same samples as find_mem_isolated_indexed().
+#   n_microbatches: function of the number of stages of a profiling run.
+def find_mem_isolated_positions(by_cut, layer, n_microbatches):
+    results = []
+    for p, position in by_cut.get(layer, []):
+        cutpoints = p["partitioning"]
+        if position + 1 < len(cutpoints) and cutpoints[position+1] == layer+1:
+            mem = p["mem"][position]
+            if mem > 0: # if the memory is not from a trimmed stage
+                n_stages = len(cutpoints) - 1
+                results.append((mem, get_in_flight(n_stages, n_microbatches(n_stages), position)))
+    return results
+
+# Extract the mem added samples of a layer, with the in-flight activations of
+# the first layer of both stages taken out. Same pairs as find_mem_added_indexed().
+def find_mem_added_positions(by_cut, by_prev_cut, layer, act_sizes, n_microbatches):
+    results = []
+    for s, position in by_cut.get(layer, []):
+        prev_cut = s["partitioning"][position-1]
+        mem_s = s["mem"][position-1]
+        n_stages_s = len(s["partitioning"]) - 1
+        in_flight_s = get_in_flight(n_stages_s, n_microbatches(n_stages_s), position-1)
+
+        for e, e_position in by_prev_cut.get((layer+1, prev_cut), []):
+            mem_e = e["mem"][e_position-1]
+            n_stages_e = len(e["partitioning"]) - 1
+            in_flight_e = get_in_flight(n_stages_e, n_microbatches(n_stages_e), e_position-1)
+            # only proceed if neither statistic is from a trimmed stage
+            if mem_s > 0 and mem_e > 0:
+                results.append((mem_e - mem_s) - (in_flight_e - in_flight_s) * act_sizes[prev_cut])
+
+    return results
+
+# Fit mem_isolated = base + in_flight * act_size to the samples of a layer.
+# Returns None if the samples do not have two different in-flight counts.
+def fit_act_size(samples):
+    mems = np.array([m for m, _ in samples], dtype=np.float64)
+    in_flight = np.array([f for _, f in samples], dtype=np.float64)
+    if len(np.unique(in_flight)) < 2:
+        return None
+    slope, _ = np.polyfit(in_flight, mems, 1)
+    return max(float(slope), 0.0)
+
+# Decompose the profiling data into position-independent statistics and the
+# activation size of each layer.
+# In args:
+#   n_microbatches: function of the number of stages of a profiling run that
+#       returns its number of micro-batches (see get_n_microbatches()).
+# Out args:
+#   results: position-independent statistics, in the format of get_mem_stats().
+#   act_sizes: activation size per micro-batch of each layer. Layers that
+#       were only profiled with one in-flight count get the mean of the others.
+def get_position_mem_stats(data, n_layers, n_microbatches):
+    by_cut, by_prev_cut = index_profiling_data(data)
+
+    samples = {}
+    act_sizes = [None] * n_layers
+    for layer in range(n_layers):
+        samples[layer] = find_mem_isolated_positions(by_cut, layer, n_microbatches)
+        act_sizes[layer] = fit_act_size(samples[layer])
+
+    fitted = [a for a in act_sizes if a is not None]
+    pooled = float(np.mean(fitted)) if len(fitted) > 0 else 0.0
+    act_sizes = [int(round(pooled if a is None else a)) for a in act_sizes]
+
+    results = {}
+    for layer in range(n_layers):
+        results[layer] = {"mem_isolated": None, "mem_added": None}
+        results[layer]["mem_isolated"] = [m - f * act_sizes[layer] for m, f in samples[layer]]
+
+        if layer != 0:
+            results[layer]["mem_added"] = find_mem_added_positions(by_cut, by_prev_cut, layer, act_sizes,
+                                                                   n_microbatches)
+
+    return results, act_sizes
+
+# Find the best memory-balanced partitioning for a pipeline depth (n_gpus
+# stages, without data parallelism) from a profiling campaign run on
+# profiling_gpus GPUs. Both use batch_size and chunk_size.
+# Returns the result of find_balanced_partitioning().
+def predict_for_depth(slurm_filename, n_gpus, batch_size, chunk_size, profiling_gpus, predictor='dp',
+                      metric="allocated"):
+    partitionings, mem = read_input_varuna(slurm_filename, metric)
+    n_layers = get_n_layers(partitionings)
+    set_n_layers(partitionings, n_layers)
+
+    profiling_data = []
+    for p, m in zip(partitionings, mem):
+        profiling_data.append({"partitioning": p, "mem": m})
+
+    def n_microbatches(n_stages):
+        return get_n_microbatches(batch_size, chunk_size, profiling_gpus, n_stages)
+
+    results, act_sizes = get_position_mem_stats(profiling_data, n_layers, n_microbatches)
+    do_completeness_check(results, n_layers)
+    results = average_results(results)
+
+    in_flight = get_in_flight_per_stage(n_gpus, get_n_microbatches(batch_size, chunk_size, n_gpus, n_gpus))
+    print("Micro-batches in flight per stage:", in_flight)
+    return find_balanced_partitioning(results, n_layers, n_gpus, predictor, schedule_terms=(in_flight, act_sizes))
+
+if __name__ == "__main__":
+    if len(sys.argv) < 7:
+        print("Usage: python3 pipeline_position.py <slurm-<id>.out> <predictor> <n_gpus (target run)> "
+              "<batch_size> <chunk_size> <n_gpus (profiling runs)>")
+        sys.exit()
+
+    if sys.argv[2] not in schedule_predictors:
+        print("Error: predictor '{}' cannot add the activations stashed at each pipeline position, supported: {}".format(
+            sys.argv[2], ", ".join(schedule_predictors)), file=sys.stderr)
+        sys.exit(1)
+
+    predict_for_depth(sys.argv[1], int(sys.argv[3]), int(sys.argv[4]), int(sys.argv[5]), int(sys.argv[6]),
+                      sys.argv[2])
@@ -1,10 +1,19 @@
-import os, sys, subprocess
+import os, sys, time, json, math, shutil, subprocess
 from argparse import ArgumentParser, REMAINDER
-from mcap_utils import get_trimmed_partitionings, get_mCAP_partitionings
+from mcap_utils import get_trimmed_partitionings, get_mCAP_partitionings, get_minimal_partitionings, \
+    get_mocked_profiling_data, get_substitute_partitionings
+from calc_mem_stats import get_mem_stats, get_missing_stats
+from mem_stats_store import add_profiling_output
+from varuna_mem_stats import iter_profiling_runs, has_unterminated_run
 from datetime import datetime
 
-def get_varuna_partitionings(n_layers, n_gpus, trimmed):
-    if trimmed:
+# Seconds between checks for finished runs when running concurrently.
+poll_interval = 1
+
+def get_varuna_partitionings(n_layers, n_gpus, trimmed, minimal=False):
+    if minimal:
+        mcap_partitionings, profiling_stages = get_minimal_partitionings(n_gpus, n_layers, trimmed)
+    elif trimmed:
         mcap_partitionings, profiling_stages = get_trimmed_partitionings(n_gpus, n_layers)
     else:
         mcap_partitionings = get_mCAP_partitionings(n_gpus, n_layers)
@@ -18,6 +27,13 @@ def get_varuna_partitionings(n_layers, n_gpus, trimmed):
     
     return varuna_partitionings, profiling_stages
 
+# The partitioning of a single profiling run with boundary snapshots (see
+# capslog/boundary_stats.py): the layers split evenly over n_gpus stages, so
+# that every layer is on a profiled stage.
+def get_boundary_partitioning(n_layers, n_gpus):
+    n_stages = min(n_gpus, n_layers)
+    return [n_layers * s // n_stages for s in range(n_stages)]
+
 def convert_to_varuna_cutpoints(mcap_partitionings):
     cps = []
     for partitioning in mcap_partitionings:
@@ -30,7 +46,48 @@ def convert_to_varuna_cutpoints(mcap_partitionings):
 
     return cps
 
-def launch_cmd(args, partitioning, contentful_stages):
+# Group the partitionings by number of stages for in-process profiling: one job
+# per number of stages profiles all of its partitionings without restarting
+# (see Varuna.profile_campaign()). The configurations of each job are written
+# to a campaign file, a JSON list of
+#   {"stage_to_cut": "0,3,8", "profiling_stages": "1,2" (or None if not trimmed)}
+# that is passed to the training script with --profiling_campaign.
+# Returns, for every job, the partitioning and profiling stages it starts
+# with, and the path of its campaign file.
+def get_in_process_campaigns(args, partitionings, profiling_stages):
+    campaigns = {}
+    for i, partitioning in enumerate(partitionings):
+        stages = profiling_stages[i] if args.trimmed else None
+        campaigns.setdefault(len(partitioning), []).append((partitioning, stages))
+
+    first_partitionings = []
+    first_stages = []
+    campaign_filenames = []
+    for n_stages, runs in sorted(campaigns.items()):
+        campaign = [{"stage_to_cut": ','.join(str(p) for p in partitioning),
+                     "profiling_stages": None if stages is None else ','.join(str(s) for s in stages)}
+                    for partitioning, stages in runs]
+        campaign_filename = os.path.abspath("profiling_campaign_{}_{}.json".format(args.job_id, n_stages))
+        with open(campaign_filename, "w") as f:
+            json.dump(campaign, f)
+
+        first_partitionings.append(runs[0][0])
+        first_stages.append(runs[0][1])
+        campaign_filenames.append(campaign_filename)
+        print("IN-PROCESS PROFILING:", len(runs), "partitionings with", n_stages, "stages in", campaign_filename)
+
+    return first_partitionings, first_stages, campaign_filenames
+
+# JSONL file the workers of all runs of the job write their telemetry records to,
+# read by CAPSlog like a log (see varuna_mem_stats.iter_telemetry_runs()).
+# Runs are told apart by the job id of the run (a slot has its own job id).
+def get_telemetry_file(args):
+    return os.path.abspath(os.path.join("ssh_logs", "telemetry_{}.jsonl".format(args.job_id)))
+
+# Launch command of a profiling run. If 'slot' is given (see allocate_slot()),
+# the run uses only the machines and GPUs of the slot, with its own job id and master port.
+# If 'campaign' is given, the run profiles all configurations in the campaign file.
+def launch_cmd(args, partitioning, contentful_stages, slot=None, campaign=None):
     stage_to_cut = ','.join(str(p) for p in partitioning)
     if contentful_stages is not None:
         profiling_stages = ','.join(str(s) for s in contentful_stages)
@@ -42,38 +99,421 @@ def launch_cmd(args, partitioning, contentful_stages):
     launch_cmd.append("--nstages={}".format(str(num_stages)))
     launch_cmd.append("--chunk_size={}".format(str(args.chunk_size)))
     launch_cmd.append("--batch_size={}".format(str(args.batch_size)))
-    launch_cmd.append("--gpus_per_node={}".format(str(args.gpus_per_node)))
-    launch_cmd.append("--job_id={}".format(str(args.job_id)))
+    if slot is None:
+        launch_cmd.append("--gpus_per_node={}".format(str(args.gpus_per_node)))
+        launch_cmd.append("--job_id={}".format(str(args.job_id)))
+        launch_cmd.append("--machine_list={}".format(str(args.machine_list)))
+    else:
+        launch_cmd.append("--gpus_per_node={}".format(str(slot["gpus_per_node"])))
+        launch_cmd.append("--job_id={}".format(str(slot["job_id"])))
+        launch_cmd.append("--machine_list={}".format(str(slot["machine_list"])))
+        launch_cmd.append("--master_port={}".format(str(slot["master_port"])))
+        launch_cmd.append("--new_logs")
+        if slot["gpus"] is not None:
+            launch_cmd.append("--cuda_visible_devices={}".format(','.join(str(g) for g in slot["gpus"])))
+    if args.telemetry:
+        launch_cmd.append("--telemetry_file={}".format(get_telemetry_file(args)))
     launch_cmd.append("--no_morphing")
-    launch_cmd.append("--machine_list={}".format(str(args.machine_list)))
     launch_cmd.append("--manager_ip={}".format(str(args.manager_ip)))
     launch_cmd.append("--code_dir={}".format(str(args.code_dir)))
     launch_cmd.append(args.training_script)
     if contentful_stages is not None:
         launch_cmd.append("--profiling_stages={}".format(str(profiling_stages)))
     launch_cmd.extend(args.training_script_args)
+    if campaign is not None:
+        launch_cmd.append("--profiling_campaign={}".format(campaign))
+    if args.steady_state:
+        launch_cmd.append("--stop_at_steady_state")
+    if args.boundaries:
+        launch_cmd.append("--profile_boundaries")
     return launch_cmd
 
+def read_machine_list(machine_list):
+    with open(machine_list, "r") as f:
+        return [m for m in f.read().split("\n") if len(m) > 0]
+
+# Find free GPUs for a run with n_stages stages, one GPU per stage. A run that
+# fits on one machine gets the first n_stages free GPUs of the first machine
+# that has them; a larger run gets whole free machines.
+# In args:
+#   free_gpus: {machine: set of free GPU ids}, updated with the allocation.
+# Out args:
+#   {machine: list of GPU ids}, or None if the GPUs are not free.
+def allocate_gpus(free_gpus, n_stages, gpus_per_node):
+    if n_stages <= gpus_per_node:
+        for machine, gpus in free_gpus.items():
+            if len(gpus) >= n_stages:
+                allocated = sorted(gpus)[:n_stages]
+                gpus.difference_update(allocated)
+                return {machine: allocated}
+        return None
+
+    n_machines = math.ceil(n_stages / gpus_per_node)
+    machines = [m for m, gpus in free_gpus.items() if len(gpus) == gpus_per_node][:n_machines]
+    if len(machines) < n_machines:
+        return None
+    allocation = {}
+    for machine in machines:
+        allocation[machine] = sorted(free_gpus[machine])
+        free_gpus[machine].clear()
+    return allocation
+
+def release_gpus(free_gpus, allocation):
+    for machine, gpus in allocation.items():
+        free_gpus[machine].update(gpus)
+
+# Launch settings of the i-th run on the allocated GPUs: a machine list with
+# only the allocated machines, and its own job id, master port and log file.
+# The slot job ids repeat when a campaign is resumed, so the worker output of
+# an interrupted earlier attempt is removed; merge_logs() would copy it in.
+def allocate_slot(args, i, allocation):
+    job_id = "{}_{}".format(args.job_id, i)
+    for name in ("ssh_out", "ssh_err"):
+        stale_log = os.path.join("ssh_logs", "{}_{}".format(name, job_id))
+        if os.path.exists(stale_log):
+            os.remove(stale_log)
+    machine_list = os.path.join("ssh_logs", "machines_{}".format(job_id))
+    with open(machine_list, "w") as f:
+        f.write("\n".join(allocation.keys()) + "\n")
+
+    gpus = next(iter(allocation.values()))
+    whole_machines = len(allocation) > 1 or len(gpus) == args.gpus_per_node
+    return {"job_id": job_id,
+            "machine_list": machine_list,
+            "master_port": args.master_port + i,
+            "gpus_per_node": len(gpus),
+            "gpus": None if whole_machines else gpus,
+            "log": os.path.join("ssh_logs", "profile_out_{}".format(job_id))}
+
+# Append the logs of a run to the logs of the campaign, so they look the same
+# as the logs of runs launched one after another.
+def merge_logs(args, slot, returncode):
+    with open(slot["log"], "r") as f:
+        sys.stdout.write(f.read())
+    print("Process done with return code", returncode, flush=True)
+
+    for name in ("ssh_out", "ssh_err"):
+        run_log = os.path.join("ssh_logs", "{}_{}".format(name, slot["job_id"]))
+        if not os.path.exists(run_log):
+            continue
+        with open(run_log, "r") as src, open(os.path.join("ssh_logs", "{}_{}".format(name, args.job_id)), "a") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(run_log)
+    os.remove(slot["log"])
+    os.remove(slot["machine_list"])
+
+# Run the profiling runs concurrently on disjoint GPUs of the machines in the
+# machine list. Runs start in order as soon as their GPUs are free; a run is
+# not started before an earlier run that does not fit yet, so runs on many
+# GPUs are not starved. The logs are merged in the order of the partitionings.
+def run_concurrent(args, partitionings, profiling_stages, current_env, campaigns=None, manifest=None):
+    free_gpus = {m: set(range(args.gpus_per_node)) for m in read_machine_list(args.machine_list)}
+    for partitioning in partitionings:
+        assert allocate_gpus({m: set(g) for m, g in free_gpus.items()}, len(partitioning), args.gpus_per_node) is not None, \
+            "not enough GPUs for a run with {} stages".format(len(partitioning))
+    os.makedirs("ssh_logs", exist_ok=True)
+
+    running = {}
+    finished = {}
+    next_run = 0
+    next_merge = 0
+    while next_merge < len(partitionings):
+        while next_run < len(partitionings):
+            allocation = allocate_gpus(free_gpus, len(partitionings[next_run]), args.gpus_per_node)
+            if allocation is None:
+                break
+            slot = allocate_slot(args, next_run, allocation)
+            stages = profiling_stages[next_run] if args.trimmed else None
+            campaign = None if campaigns is None else campaigns[next_run]
+            cmd = launch_cmd(args, partitionings[next_run], stages, slot, campaign)
+            log = open(slot["log"], "w")
+            process = subprocess.Popen(cmd, env=current_env, stdout=log, stderr=log)
+            running[next_run] = (process, slot, allocation, log)
+            next_run += 1
+
+        time.sleep(poll_interval)
+        for i, (process, slot, allocation, log) in list(running.items()):
+            if process.poll() is not None:
+                log.close()
+                release_gpus(free_gpus, allocation)
+                finished[i] = (slot, process.returncode)
+                del running[i]
+
+        while next_merge in finished:
+            slot, returncode = finished.pop(next_merge)
+            merge_logs(args, slot, returncode)
+            next_merge += 1
+            if manifest is not None:
+                update_manifest(args, manifest)
+
+# The profiling output the runs are read from: args.log, the telemetry file with
+# --telemetry, or else the worker output (ssh_logs/ssh_out_<job_id>).
+def get_output_file(args):
+    if args.log is not None:
+        return args.log
+    if args.telemetry:
+        return get_telemetry_file(args)
+    return os.path.join("ssh_logs", "ssh_out_{}".format(args.job_id))
+
+# Campaign manifest, to resume a campaign that was interrupted (e.g. by
+# preemption) with --manifest. The manifest is a JSON file:
+#   {
+#     "n_cutpoints", "n_gpus", "trimmed", "minimal": the settings of the campaign,
+#     "runs": [{"stage_to_cut": varuna cutpoints, "profiling_stages": stages or None,
+#               "status": "pending", "running", "completed" or "failed",
+#               "output": path of the profiling output the run was read from, "returncode": ...,
+#               "mem": peak memory per stage, "mem_reserved": ...}, ...],
+#     "sources": {path of profiling output: number of runs read from it}
+#   }
+# It is updated from the profiling output after every run. A resumed campaign
+# only launches the runs that did not complete; the completed runs of all
+# attempts are merged into one telemetry file for the predictor (see write_merged_output()).
+
+def get_manifest_settings(args):
+    return {"n_cutpoints": args.n_cutpoints, "n_gpus": args.n_gpus, "trimmed": args.trimmed, "minimal": args.minimal}
+
+def get_run_key(stage_to_cut, profiling_stages):
+    return json.dumps([list(stage_to_cut), None if profiling_stages is None else list(profiling_stages)])
+
+def load_manifest(args, partitionings, profiling_stages):
+    if os.path.exists(args.manifest):
+        with open(args.manifest, "r") as f:
+            manifest = json.load(f)
+        for setting, value in get_manifest_settings(args).items():
+            if manifest[setting] != value:
+                raise ValueError("{} was written for a campaign with {} {}, not {}".format(
+                    args.manifest, setting, manifest[setting], value))
+        return manifest
+
+    manifest = get_manifest_settings(args)
+    manifest["runs"] = []
+    for i, partitioning in enumerate(partitionings):
+        manifest["runs"].append({"stage_to_cut": list(partitioning),
+                                 "profiling_stages": list(profiling_stages[i]) if args.trimmed else None,
+                                 "status": "pending", "output": None, "returncode": None,
+                                 "mem": None, "mem_reserved": None})
+    manifest["sources"] = {}
+    save_manifest(manifest, args.manifest)
+    return manifest
+
+def save_manifest(manifest, manifest_filename):
+    # Write to a temporary file first, so an interrupted write does not corrupt the manifest.
+    tmp_filename = manifest_filename + ".tmp"
+    with open(tmp_filename, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_filename, manifest_filename)
+
+# Record the runs in the profiling output that were not read yet in the
+# manifest. A completed run is never overwritten by a later failure.
+def update_manifest(args, manifest):
+    output = get_output_file(args)
+    if not os.path.exists(output):
+        return
+    source = os.path.abspath(output)
+    n_read = manifest["sources"].get(source, 0)
+    # a partitioning can be profiled more than once in a campaign
+    by_key = {}
+    for r in manifest["runs"]:
+        by_key.setdefault(get_run_key(r["stage_to_cut"], r["profiling_stages"]), []).append(r)
+
+    n_runs = 0
+    for i, run in enumerate(iter_profiling_runs(output)):
+        n_runs = i + 1
+        if i < n_read or run["partitioning"] is None:
+            continue
+        entries = [r for r in by_key.get(get_run_key(run["partitioning"][:-1], run["profiling_stages"]), [])
+                   if r["status"] != "completed"]
+        if len(entries) == 0:
+            continue
+        entry = next((r for r in entries if r["status"] == "running"), entries[0])
+        entry.update({"status": "failed" if run["mem"] is None else "completed", "output": source,
+                      "returncode": run["returncode"], "mem": run["mem"], "mem_reserved": run["mem_reserved"]})
+
+    manifest["sources"][source] = max(n_runs, n_read)
+    save_manifest(manifest, args.manifest)
+
+# Record that a run is launched, so that a resumed campaign can tell which
+# run was interrupted (see close_interrupted_run()).
+def mark_running(args, manifest, partitioning, profiling_stages):
+    key = get_run_key(partitioning, profiling_stages)
+    for run in manifest["runs"]:
+        if run["status"] in ("pending", "failed") and get_run_key(run["stage_to_cut"], run["profiling_stages"]) == key:
+            run["status"] = "running"
+            break
+    save_manifest(manifest, args.manifest)
+
+# A run whose partitioning is in the log without a done line was interrupted,
+# and its memory lines would be counted for the next run appended to the same
+# log. It is ended with a failed done line. This is detected from the log
+# itself, as an in-process job logs more runs than the one marked as running.
+# Runs that are still marked as running are recorded as failed.
+# Telemetry files do not need this, a partitioning record starts a new run.
+# Call after update_manifest(), which records the runs that did end.
+def close_interrupted_run(args, manifest):
+    output = get_output_file(args)
+    if os.path.exists(output) and not output.endswith(".jsonl") and has_unterminated_run(output):
+        with open(output, "a") as f:
+            f.write("Process done with return code 1\n")
+        update_manifest(args, manifest)
+
+    if not any(run["status"] == "running" for run in manifest["runs"]):
+        return
+    for run in manifest["runs"]:
+        if run["status"] == "running":
+            run["status"] = "failed"
+    save_manifest(manifest, args.manifest)
+
+# The partitionings (and profiling stages) that did not complete yet, in campaign order.
+def get_pending_runs(args, manifest):
+    runs = [r for r in manifest["runs"] if r["status"] != "completed"]
+    partitionings = [r["stage_to_cut"] for r in runs]
+    profiling_stages = [r["profiling_stages"] for r in runs] if args.trimmed else None
+    return partitionings, profiling_stages
+
+def print_manifest_status(manifest):
+    counts = {status: 0 for status in ("completed", "failed", "running", "pending")}
+    for run in manifest["runs"]:
+        counts[run["status"]] += 1
+    print("CAMPAIGN MANIFEST:", ", ".join("{} {}".format(n, status) for status, n in counts.items()), flush=True)
+
+# Write the completed runs of the manifest as one telemetry file (see
+# varuna_mem_stats.iter_telemetry_runs()), which CAPSlog reads like a log.
+def write_merged_output(manifest, merged_filename):
+    tmp_filename = merged_filename + ".tmp"
+    with open(tmp_filename, "w") as f:
+        for i, run in enumerate(manifest["runs"]):
+            if run["status"] != "completed":
+                continue
+            records = [{"type": "partitioning", "num_cutpoints": manifest["n_cutpoints"],
+                        "stage_to_cut": run["stage_to_cut"], "profiling_stages": run["profiling_stages"]}]
+            for rank, (mem, mem_reserved) in enumerate(zip(run["mem"], run["mem_reserved"])):
+                records.append({"type": "memory", "rank": rank, "peak_allocated": mem, "peak_reserved": mem_reserved})
+            records.append({"type": "done", "returncode": 0, "n_expected": 1})
+            for record in records:
+                record["run_id"] = str(i)
+                f.write(json.dumps(record) + "\n")
+    os.replace(tmp_filename, merged_filename)
+    print("MERGED PROFILING OUTPUT:", merged_filename, flush=True)
+
+# Convert varuna cutpoints (the first cutpoint of each stage) to the number of layers on each GPU.
+def to_layer_counts(partitioning, n_layers):
+    ends = list(partitioning[1:]) + [n_layers]
+    return [end - start for start, end in zip(partitioning, ends)]
+
+# The statistics that cannot be extracted from the successful runs so far,
+# nor from the queued runs if they succeed.
+def get_uncovered_stats(store, queue, n_layers, trimmed):
+    data = list(store["live"]["runs"]) if "live" in store else []
+    partitionings = [run["partitioning"] for run in queue]
+    profiling_stages = [run["profiling_stages"] for run in queue] if trimmed else None
+    data += get_mocked_profiling_data(partitionings, profiling_stages)
+    return get_missing_stats(get_mem_stats(data, n_layers), n_layers)
+
+# Run the profiling runs one after another, extracting the statistics from the
+# logs (args.log) as each run completes. The campaign stops as soon as all
+# statistics can be extracted. When a run fails, substitute runs are queued
+# right away for the statistics that the remaining runs cannot provide, with
+# half as many profiled stages per run; a run with one profiled stage is not replaced.
+def run_live(args, partitionings, profiling_stages, current_env):
+    n_layers = args.n_cutpoints + 1
+    log = get_output_file(args)
+
+    queue = []
+    for i, partitioning in enumerate(partitionings):
+        stages = profiling_stages[i] if args.trimmed else None
+        queue.append({"partitioning": to_layer_counts(partitioning, n_layers), "profiling_stages": stages,
+                      "max_profiled": len(partitioning) if stages is None else len(stages)})
+
+    store = {}
+    n_runs = 0
+    while len(queue) > 0:
+        run = queue.pop(0)
+        cmd = launch_cmd(args, convert_to_varuna_cutpoints([run["partitioning"]])[0], run["profiling_stages"])
+        process = subprocess.Popen(cmd, env=current_env, stdout=sys.stdout, stderr=sys.stdout)
+        process.wait()
+        print("Process done with return code", process.returncode, flush=True)
+        n_runs += 1
+
+        succeeded = os.path.exists(log) and add_profiling_output(store, "live", log) > 0
+        if len(get_uncovered_stats(store, [], n_layers, args.trimmed)) == 0:
+            print("ALL MEMORY STATISTICS EXTRACTABLE after", n_runs, "runs, skipping", len(queue), "runs", flush=True)
+            return
+
+        if succeeded:
+            continue
+        uncovered = get_uncovered_stats(store, queue, n_layers, args.trimmed)
+        max_profiled = run["max_profiled"] // 2
+        if len(uncovered) == 0 or max_profiled == 0:
+            continue
+
+        isolated = set()
+        if "live" in store:
+            isolated = {layer for layer, stats in store["live"]["stats"].items() if len(stats["mem_isolated"]) > 0}
+        substitutes, substitute_stages = get_substitute_partitionings(uncovered, args.n_gpus, n_layers, max_profiled,
+                                                                      args.trimmed, isolated)
+        print("RUN FAILED, ADDING", len(substitutes), "SUBSTITUTE RUNS FOR", uncovered, flush=True)
+        for i, partitioning in enumerate(substitutes):
+            queue.insert(i, {"partitioning": partitioning,
+                             "profiling_stages": None if substitute_stages is None else substitute_stages[i],
+                             "max_profiled": max_profiled})
+
+    print("MEMORY STATISTICS MISSING AFTER", n_runs, "RUNS:", get_uncovered_stats(store, [], n_layers, args.trimmed))
+
 def main(args):
     n_layers = args.n_cutpoints + 1
-    partitionings, profiling_stages = get_varuna_partitionings(n_layers, args.n_gpus, args.trimmed)
+    if args.boundaries:
+        assert args.telemetry, "the boundary snapshots are written to the telemetry file, use --telemetry"
+        assert not (args.trimmed or args.minimal or args.in_process or args.live), \
+            "--boundaries profiles all layers in a single untrimmed run"
+        partitionings, profiling_stages = [get_boundary_partitioning(n_layers, args.n_gpus)], None
+        print("BOUNDARY PROFILING: 1 partitioning, read with boundary_stats.py", flush=True)
+    else:
+        partitionings, profiling_stages = get_varuna_partitionings(n_layers, args.n_gpus, args.trimmed, args.minimal)
 
     current_env = os.environ.copy()
     processes = []
     
     start_time = datetime.now()    
-    for i, partitioning in enumerate(partitionings):
-        if args.trimmed:
-            stages = profiling_stages[i]
-        else:
-            stages = None
+    manifest = None
+    if args.manifest is not None:
+        assert not args.live, "--live decides which runs to launch while profiling, it cannot be resumed from a manifest"
+        manifest = load_manifest(args, partitionings, profiling_stages)
+        update_manifest(args, manifest)
+        close_interrupted_run(args, manifest)
+        print_manifest_status(manifest)
+        partitionings, profiling_stages = get_pending_runs(args, manifest)
 
-        cmd = launch_cmd(args, partitioning, stages)
-        
-        process = subprocess.Popen(cmd, env=current_env, stdout=sys.stdout, stderr=sys.stdout)
-        processes.append(process)
-        process.wait()
-        print("Process done with return code", process.returncode)
+    campaigns = None
+    if args.in_process:
+        partitionings, profiling_stages, campaigns = get_in_process_campaigns(args, partitionings, profiling_stages)
+
+    if args.live:
+        assert not (args.concurrent or args.in_process), "--live runs the profiling runs one after another"
+        run_live(args, partitionings, profiling_stages, current_env)
+    elif args.concurrent:
+        run_concurrent(args, partitionings, profiling_stages, current_env, campaigns, manifest)
+    else:
+        for i, partitioning in enumerate(partitionings):
+            if args.trimmed:
+                stages = profiling_stages[i]
+            else:
+                stages = None
+
+            campaign = None if campaigns is None else campaigns[i]
+            if manifest is not None:
+                mark_running(args, manifest, partitioning, stages)
+            cmd = launch_cmd(args, partitioning, stages, campaign=campaign)
+
+            process = subprocess.Popen(cmd, env=current_env, stdout=sys.stdout, stderr=sys.stdout)
+            processes.append(process)
+            process.wait()
+            print("Process done with return code", process.returncode)
+            if manifest is not None:
+                update_manifest(args, manifest)
+
+    if manifest is not None:
+        print_manifest_status(manifest)
+        write_merged_output(manifest, os.path.splitext(args.manifest)[0] + ".jsonl")
     end_time = datetime.now()
     
     execution_time = end_time - start_time
@@ -85,6 +525,8 @@ def parse_args():
     parser = ArgumentParser(description="mCAP profiler for Varuna framework")
     parser.add_argument("--job_id", type=str, default=None, help= "SLURM job ID.")
     parser.add_argument("--trimmed", required=False, action="store_true", help = "Use model trimming in profiling.")
+    parser.add_argument("--minimal", required=False, action="store_true",
+                        help = "Profile the fewest partitionings found by the covering search (see mcap_utils.py).")
     parser.add_argument('--n_gpus', type=int, default=8, help = "number of GPUs to profile for")
     parser.add_argument('--n_cutpoints', type=int, default=24, help = "number of Varuna cutpoints in the model")
     parser.add_argument("--machine_list", type=str, help = "path to a file with reachable IPs written line-wise.")
@@ -95,6 +537,35 @@ def parse_args():
     parser.add_argument("--gpus_per_node", type=int, default=4, help = "number of GPUs per machine")
     parser.add_argument("--code_dir", default=None, type=str,
                         help="Path on all machines of directory to run training in.")
+    parser.add_argument("--concurrent", required=False, action="store_true",
+                        help="Run profiling runs at the same time on disjoint GPUs of the machines, "
+                        "with one GPU per stage (no data parallelism).")
+    parser.add_argument("--in_process", required=False, action="store_true",
+                        help="Profile all partitionings with the same number of stages in one job, "
+                        "re-partitioning in the worker processes. The training script gets the "
+                        "configurations with --profiling_campaign (see Varuna.profile_campaign).")
+    parser.add_argument("--steady_state", required=False, action="store_true",
+                        help="End each profiling run once the peak memory usage is steady on all GPUs. "
+                        "The training script gets --stop_at_steady_state (see Varuna stop_at_steady_state).")
+    parser.add_argument("--live", required=False, action="store_true",
+                        help="Extract the memory statistics as runs complete: stop once all statistics "
+                        "can be extracted, and replace failed runs right away.")
+    parser.add_argument("--log", type=str, default=None,
+                        help="Profiling output read with --live, defaults to ssh_logs/ssh_out_<job_id>, "
+                        "or the telemetry file with --telemetry.")
+    parser.add_argument("--manifest", type=str, default=None,
+                        help="Campaign manifest (JSON) recording which runs completed, created if it does not "
+                        "exist. Rerunning with the same manifest resumes the campaign: only the runs that failed "
+                        "or did not run are launched. The completed runs are merged into <manifest>.jsonl.")
+    parser.add_argument("--telemetry", required=False, action="store_true",
+                        help="Have the workers write JSONL telemetry records to ssh_logs/telemetry_<job_id>.jsonl, "
+                        "which CAPSlog reads instead of the logs.")
+    parser.add_argument("--boundaries", required=False, action="store_true",
+                        help="Profile all layers in a single run from allocator snapshots at the CutPoint "
+                        "boundaries (see boundary_stats.py). The training script gets --profile_boundaries "
+                        "(see Varuna boundary_allocator). Needs --telemetry.")
+    parser.add_argument("--master_port", type=int, default=29500,
+                        help="Master port of the first concurrent run, the i-th run uses master_port + i.")
     parser.add_argument("training_script", type=str, default=None, nargs='?', 
                             help="The full path to the training program/script "
                              "followed by all its arguments")
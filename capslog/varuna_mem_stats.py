@@ -1,143 +1,348 @@
-import re
-from collections import defaultdict
-
-# Filters the logged stages line starting with a given preamble
-# In args:
-#   line: the line from the profiling logs listing to be filtered.
-#       For example: "Stage to cut is: [0, 13, 14, 15, 16, 17, 18, 19]"
-#
-#   preamble: the preamble of the line to be filtered away.
-#       For example: "Stage to cut is: "
-# Out args:
-#   line: an integer list of the stages listed in the given line.
-#       For example: [0, 13, 14, 15, 16, 17, 18, 19]
-def filter_stages_line(line, preamble):
-    if not (line.startswith(preamble)):
-        line = line.split(preamble)[1]
-    else:
-        line = line.replace(preamble, "")
-    line = line.split("]")[0]
-    line = [int(s) for s in line.split(', ')]
-    return line
-
-# Filters the logged memory lines from profiling output.
-# In args:
-#   line: the loggedd memory line as a String, which has the format
-#       "Memory allocated on rank W after X iterations | peak allocated: Y | peak reserved: Z"
-# Out args:
-#   line: list of integers of the format [STAGE, ITERATION, PEAK ALLOCATED MEM, PEAK RESERVED MEM]
-def filter_mem_line(line):
-    # Memory line includes RANK#, ITERATION#, PEAK_ALLOC#, PEAK_RES#
-    line = [int(x) for x in re.findall(r'\d+', line)]
-    return line
-
-# Sort the peak memory statistics per stage
-# In args:
-#   extracted_mems: list of contents of the logged memory lines from profiling output.
-#       Each entry in the list is a 4-item list with the following contents:
-#       [STAGE, ITERATION, PEAK ALLOCATED MEM, PEAK RESERVED MEM]
-# Out args:
-#   mems: A list of the peak allocated memory for each stage in the profiling run,
-#       arranged in ascending order of stage ID.
-def sort_mems(extracted_mems):
-    max_mems = defaultdict(int)
-
-    for line in extracted_mems:
-        rank = line[0]
-        mem = line[2]
-        max_mems[rank] = max(max_mems[rank], mem)
-
-    mems = [max_mems[i] for i in range(len(max_mems))]
-    return mems
-
-# Voids the memory statistics for trimmed stages
-# In args:
-#   contentful_stages: the list of non-trimmed stages for each profiling run
-#
-#   mem: the list of per-stage memory statistics for each profiling run
-# Out args:
-#   mem: the mem input argument where the trimmed stages have the memory statistic set to -1
-def clear_trimmed_stages(contentful_stages, mem):
-    for i, stages in enumerate(contentful_stages):
-        maxi = len(mem[i])
-        for s in range(maxi):
-            if not s in stages:
-                # stage was not contentful, set mem to -1
-                mem[i][s] = -1
-    return mem
-
-# Read input file containing the output of multiple profiling runs performed in Varuna.
-# In args:
-#   slurm_filename: file to output of the profiling run, e.g. ssh_out_<jobid>
-# Out args:
-#   partitionings: list of partitionings that were found in the input file,
-#       each partitioning is a list of the first cutpoint included in each stage,
-#       appended with the total number of cutpoints at the end.
-#       [ first cutpoint on stage 0, ..., first cutpoint on stage n, total nr cutpoints ]
-#       Example: [0, 2, 3, 7, 11, 15, 18, 21, 24]
-#
-#   mem: list of peak memory usage (in bytes) of each GPU during the
-#       runs described by 'partitionings'. Each element looks like:
-#       [peak_mem_gpu_0, ..., peak_mem_gpu_k]
-def read_input_varuna(slurm_filename):
-    num_cutpoints = 0
-    partitionings = []
-    contentful_stages = []
-    mem = []
-
-    failed_partitionings = []
-    gpu_mem = [] # list of list of rank/iter/alloc/res
-
-    with open(slurm_filename, 'r') as f:
-        lines = f.readlines()
-
-    skip = False
-
-    for l in lines:
-        if "Num cutpoints is" in l:
-            l = l.split("Num cutpoints is")[1]
-            num_cutpoints = int(re.findall(r'\d+', l)[0])
-        elif "Stage to cut is: " in l:
-            if skip:
-                skip = False
-            partitioning = filter_stages_line(l, "Stage to cut is: [")
-            partitioning.append(num_cutpoints+1)
-            partitionings.append(partitioning)
-
-        elif "Profiling stages" in l:
-            contentful_stages.append(filter_stages_line(l, "PROFILING MODE; Profiling stages: ["))
-        if skip:
-            continue
-        elif l.startswith("Process done with return code 0"):
-            # reached end of profiling run
-            mem.append(sort_mems(gpu_mem))
-            gpu_mem = []
-            skip = True
-
-        elif l.startswith("Memory allocated on rank"):
-            if "Epoch:" in l:
-                l = l.split("Epoch:")[0]
-
-            filtered_line = filter_mem_line(l)
-            if len(filtered_line) != 4: # in case multiple gpus printed on same line
-                for i in range(0, len(filtered_line), 4):
-                    gpu_mem.append(filtered_line[i:i+4])
-            else:
-                gpu_mem.append(filtered_line)
-
-        elif l.startswith("Process done with return code"):
-            # Skip this partitioning, because this run went OOM or another error occurred.
-            skip = True
-            if len(contentful_stages) > 0:
-                contentful_stages.pop()
-            failed_partitionings.append(partitionings.pop())
-            gpu_mem = []
-
-    if len(failed_partitionings) > 0:
-        print("FAILED PARTITIONINGS: ", failed_partitionings)
-
-    # If profiling was done using trimming, void the trimmed memory statistics
-    if len(contentful_stages) > 0:
-        mem = clear_trimmed_stages(contentful_stages, mem)
-
-    return partitionings, mem
+import re
+import json
+import mmap
+import heapq
+from collections import defaultdict
+
+# Precompiled patterns for the lines in the profiling logs.
+# The logs are scanned as bytes, only matching lines are decoded.
+# Lines with one of the CONTROL_MARKERS are handled one by one, the memory
+# lines in between are found in bulk with MEMORY_LINE.
+NUM_CUTPOINTS = b"Num cutpoints is"
+STAGE_TO_CUT = b"Stage to cut is: "
+PROFILING_STAGES = b"Profiling stages"
+PROCESS_DONE = b"Process done with return code"
+PROCESS_DONE_OK = b"Process done with return code 0"
+MEMORY_ALLOCATED = b"Memory allocated on rank"
+EPOCH = b"Epoch:"
+DIGITS = re.compile(rb'\d+')
+RETURN_CODE = re.compile(rb'-?\d+')
+MEMORY_LINE = re.compile(rb'Memory allocated on rank[^\n]*')
+NEWLINE = ord("\n")
+CONTROL_MARKERS = [NUM_CUTPOINTS, STAGE_TO_CUT, PROFILING_STAGES, PROCESS_DONE]
+
+# The memory metrics in the logged memory lines, and the key of their
+# peak memory usage per stage in the records of iter_profiling_runs().
+# The caching allocator reserves more memory than is allocated, the reserved
+# memory is what has to fit on the GPU.
+METRICS = {"allocated": "mem", "reserved": "mem_reserved"}
+
+# Filters the logged stages line starting with a given preamble
+# In args:
+#   line: the line from the profiling logs listing to be filtered.
+#       For example: "Stage to cut is: [0, 13, 14, 15, 16, 17, 18, 19]"
+#
+#   preamble: the preamble of the line to be filtered away.
+#       For example: "Stage to cut is: "
+# Out args:
+#   line: an integer list of the stages listed in the given line.
+#       For example: [0, 13, 14, 15, 16, 17, 18, 19]
+def filter_stages_line(line, preamble):
+    if not (line.startswith(preamble)):
+        line = line.split(preamble)[1]
+    else:
+        line = line.replace(preamble, "")
+    line = line.split("]")[0]
+    line = [int(s) for s in line.split(', ')]
+    return line
+
+# Filters the logged memory lines from profiling output.
+# In args:
+#   line: the loggedd memory line as a String, which has the format
+#       "Memory allocated on rank W after X iterations | peak allocated: Y | peak reserved: Z"
+# Out args:
+#   line: list of integers of the format [STAGE, ITERATION, PEAK ALLOCATED MEM, PEAK RESERVED MEM]
+def filter_mem_line(line):
+    # Memory line includes RANK#, ITERATION#, PEAK_ALLOC#, PEAK_RES#
+    line = [int(x) for x in re.findall(r'\d+', line)]
+    return line
+
+# Sort the peak memory statistics per stage
+# In args:
+#   extracted_mems: list of contents of the logged memory lines from profiling output.
+#       Each entry in the list is a 4-item list with the following contents:
+#       [STAGE, ITERATION, PEAK ALLOCATED MEM, PEAK RESERVED MEM]
+#   metric: "allocated" or "reserved"
+# Out args:
+#   mems: A list of the peak allocated (or reserved) memory for each stage in the
+#       profiling run, arranged in ascending order of stage ID.
+def sort_mems(extracted_mems, metric="allocated"):
+    max_mems = defaultdict(int)
+
+    for line in extracted_mems:
+        update_max_mems(max_mems, line, metric)
+
+    return list_max_mems(max_mems)
+
+# Update the highest peak allocated (or reserved) memory per rank with a filtered memory line.
+def update_max_mems(max_mems, line, metric="allocated"):
+    rank = line[0]
+    mem = line[2] if metric == "allocated" else line[3]
+    max_mems[rank] = max(max_mems[rank], mem)
+
+# List the highest peak allocated memory per rank in ascending order of rank.
+def list_max_mems(max_mems):
+    mems = [max_mems[i] for i in range(len(max_mems))]
+    return mems
+
+# Voids the memory statistics for trimmed stages
+# In args:
+#   contentful_stages: the list of non-trimmed stages for each profiling run
+#
+#   mem: the list of per-stage memory statistics for each profiling run
+# Out args:
+#   mem: the mem input argument where the trimmed stages have the memory statistic set to -1
+def clear_trimmed_stages(contentful_stages, mem):
+    for i, stages in enumerate(contentful_stages):
+        maxi = len(mem[i])
+        for s in range(maxi):
+            if not s in stages:
+                # stage was not contentful, set mem to -1
+                mem[i][s] = -1
+    return mem
+
+# Update the highest peak allocated and peak reserved memory per rank with a logged memory line.
+def parse_mem_line(max_mems, max_reserved, line):
+    if EPOCH in line:
+        line = line.split(EPOCH)[0]
+
+    # RANK#, ITERATION#, PEAK_ALLOC#, PEAK_RES# for every gpu
+    # (multiple gpus can print on the same line).
+    numbers = DIGITS.findall(line)
+    for i in range(0, len(numbers), 4):
+        rank = int(numbers[i])
+        max_mems[rank] = max(max_mems[rank], int(numbers[i+2]))
+        max_reserved[rank] = max(max_reserved[rank], int(numbers[i+3]))
+
+# Yield the offset of the start of every line in 'mm' that contains 'marker', in order.
+def iter_marker_line_starts(mm, marker):
+    pos = mm.find(marker)
+    while pos != -1:
+        yield mm.rfind(b"\n", 0, pos) + 1
+        end = mm.find(b"\n", pos)
+        if end == -1:
+            return
+        pos = mm.find(marker, end)
+
+# Yield the (start, end) offsets of every line in 'mm' that contains
+# any of the given markers, in order. 'mm' is searched for each marker
+# separately, so the (many) other lines are skipped without being looked at in Python.
+def iter_marker_lines(mm, markers):
+    last_start = -1
+    starts = [iter_marker_line_starts(mm, marker) for marker in markers]
+    for start in heapq.merge(*starts):
+        # Lines with multiple markers are only yielded once.
+        if start == last_start:
+            continue
+        last_start = start
+        end = mm.find(b"\n", start)
+        yield start, len(mm) if end == -1 else end + 1
+
+# Parse the output of multiple profiling runs performed in Varuna in a single pass,
+# yielding a record for each profiling run as soon as the run is done.
+# The file is memory-mapped, so it is never read into memory as a whole.
+# In args:
+#   slurm_filename: file to output of the profiling run, e.g. ssh_out_<jobid>
+# Out args (per run):
+#   partitioning: the first cutpoint included in each stage, appended with the
+#       total number of cutpoints (see read_input_varuna). None if the run failed
+#       before printing it.
+#   profiling_stages: the non-trimmed stages, or None if trimming was not used.
+#   mem: peak memory usage (in bytes) of each GPU, -1 for trimmed stages.
+#       None if the run failed.
+#   mem_reserved: same as mem, for the peak reserved memory.
+#   returncode: the return code of the run.
+# Telemetry files written by Varuna (*.jsonl) are read with iter_telemetry_runs().
+def iter_profiling_runs(slurm_filename):
+    if slurm_filename.endswith(".jsonl"):
+        yield from iter_telemetry_runs(slurm_filename)
+        return
+
+    with open(slurm_filename, 'rb') as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file, which cannot be memory-mapped.
+            return
+        with mm:
+            yield from parse_profiling_runs(mm)
+
+def parse_profiling_runs(mm):
+    num_cutpoints = 0
+    partitioning = None
+    profiling_stages = None
+    # Highest peak allocated and reserved memory per rank. Kept up to date while
+    # parsing, so the memory lines of a run do not have to be stored.
+    max_mems = defaultdict(int)
+    max_reserved = defaultdict(int)
+    skip = False
+    prev_end = 0
+
+    for start, end in iter_marker_lines(mm, CONTROL_MARKERS):
+        # Memory lines since the previous control line.
+        if not skip:
+            for match in MEMORY_LINE.finditer(mm, prev_end, start):
+                # Only lines starting with the memory report count.
+                if match.start() == prev_end or mm[match.start()-1] == NEWLINE:
+                    parse_mem_line(max_mems, max_reserved, match.group())
+        prev_end = end
+        l = mm[start:end]
+
+        if NUM_CUTPOINTS in l:
+            l = l.split(NUM_CUTPOINTS)[1]
+            num_cutpoints = int(DIGITS.search(l).group())
+        elif STAGE_TO_CUT in l:
+            skip = False
+            partitioning = filter_stages_line(l.decode(), "Stage to cut is: [")
+            partitioning.append(num_cutpoints+1)
+            profiling_stages = None
+        elif PROFILING_STAGES in l:
+            profiling_stages = filter_stages_line(l.decode(), "PROFILING MODE; Profiling stages: [")
+
+        if skip:
+            continue
+        elif l.startswith(PROCESS_DONE):
+            # Reached the end of a profiling run. If it failed (OOM or another
+            # error), there are no memory statistics for this partitioning.
+            run = {"partitioning": partitioning, "profiling_stages": profiling_stages,
+                   "mem": None, "mem_reserved": None,
+                   "returncode": int(RETURN_CODE.search(l[len(PROCESS_DONE):]).group())}
+            if l.startswith(PROCESS_DONE_OK):
+                run["mem"] = list_max_mems(max_mems)
+                run["mem_reserved"] = list_max_mems(max_reserved)
+                if profiling_stages is not None:
+                    run["mem"], run["mem_reserved"] = clear_trimmed_stages([profiling_stages] * 2,
+                                                                           [run["mem"], run["mem_reserved"]])
+            yield run
+
+            partitioning = None
+            profiling_stages = None
+            max_mems = defaultdict(int)
+            max_reserved = defaultdict(int)
+            skip = True
+
+        elif l.startswith(MEMORY_ALLOCATED):
+            parse_mem_line(max_mems, max_reserved, l)
+
+# Whether the log ends with a profiling run that has no done line, i.e. a run
+# that was interrupted (or is still running): its memory lines would be
+# counted for the next run appended to the log.
+def has_unterminated_run(slurm_filename):
+    with open(slurm_filename, 'rb') as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file, which cannot be memory-mapped.
+            return False
+        with mm:
+            return mm.rfind(STAGE_TO_CUT) > mm.rfind(PROCESS_DONE)
+
+# Read the typed JSONL telemetry records written by Varuna (see
+# varuna/utils.write_telemetry()), yielding the same records as iter_profiling_runs().
+# Records of different runs (e.g. concurrent runs) are told apart by their run
+# id. Within a run id, a "partitioning" record starts a profiling run, the
+# "memory" records that follow are its memory usage per rank, and the run is
+# done once n_expected "done" records are read, or one with a non-zero return
+# code. Runs are yielded in the order in which they are done, so a file that
+# is still being written can be read again with the same runs first.
+# A run without its "done" records (yet) is not yielded. Like in a log, a run
+# that failed before it printed its partitioning is yielded with partitioning
+# None. A "done" record without an open run belongs to the last run with that
+# id if its node (or rank) did not report yet, e.g. the other nodes of a run
+# that failed, and otherwise starts a run without partitioning.
+def iter_telemetry_runs(telemetry_filename):
+    runs = {}
+    # Nodes and ranks that reported the last done run of each run id.
+    reported = {}
+
+    def new_run(partitioning, profiling_stages):
+        return {"partitioning": partitioning, "profiling_stages": profiling_stages,
+                "max_mems": defaultdict(int), "max_reserved": defaultdict(int), "reported": set()}
+
+    with open(telemetry_filename, 'r') as f:
+        for line in f:
+            if not line.endswith("\n"):
+                # The last record is still being written.
+                break
+            record = json.loads(line)
+            run_id = record["run_id"]
+
+            if record["type"] == "partitioning":
+                runs[run_id] = new_run(record["stage_to_cut"] + [record["num_cutpoints"]+1],
+                                       record["profiling_stages"])
+                continue
+
+            run = runs.get(run_id)
+            if record["type"] == "done":
+                reporter = ("node_rank", record["node_rank"]) if "node_rank" in record else ("rank", record.get("rank"))
+                if run is None:
+                    if run_id in reported and reporter not in reported[run_id]:
+                        reported[run_id].add(reporter)
+                        continue
+                    run = runs[run_id] = new_run(None, None)
+            elif run is None:
+                # Memory usage before the run printed its partitioning.
+                continue
+
+            if record["type"] == "memory":
+                rank = record["rank"]
+                run["max_mems"][rank] = max(run["max_mems"][rank], record["peak_allocated"])
+                run["max_reserved"][rank] = max(run["max_reserved"][rank], record["peak_reserved"])
+
+            elif record["type"] == "done":
+                run["reported"].add(reporter)
+                if record["returncode"] == 0 and len(run["reported"]) < record["n_expected"]:
+                    continue
+
+                del runs[run_id]
+                reported[run_id] = run["reported"]
+                result = {"partitioning": run["partitioning"], "profiling_stages": run["profiling_stages"],
+                          "mem": None, "mem_reserved": None, "returncode": record["returncode"]}
+                if record["returncode"] == 0 and run["partitioning"] is not None:
+                    result["mem"] = list_max_mems(run["max_mems"])
+                    result["mem_reserved"] = list_max_mems(run["max_reserved"])
+                    if run["profiling_stages"] is not None:
+                        result["mem"], result["mem_reserved"] = clear_trimmed_stages(
+                            [run["profiling_stages"]] * 2, [result["mem"], result["mem_reserved"]])
+                yield result
+
+# Read input file containing the output of multiple profiling runs performed in Varuna.
+# In args:
+#   slurm_filename: file to output of the profiling run, e.g. ssh_out_<jobid>
+# Out args:
+#   partitionings: list of partitionings that were found in the input file,
+#       each partitioning is a list of the first cutpoint included in each stage,
+#       appended with the total number of cutpoints at the end.
+#       [ first cutpoint on stage 0, ..., first cutpoint on stage n, total nr cutpoints ]
+#       Example: [0, 2, 3, 7, 11, 15, 18, 21, 24]
+#
+#   mem: list of peak memory usage (in bytes) of each GPU during the
+#       runs described by 'partitionings'. Each element looks like:
+#       [peak_mem_gpu_0, ..., peak_mem_gpu_k]
+#       Trimmed stages have their memory usage set to -1.
+#
+#   metric: "allocated" for the peak allocated memory, "reserved" for the
+#       peak reserved memory.
+def read_input_varuna(slurm_filename, metric="allocated"):
+    partitionings, mems = read_input_varuna_metrics(slurm_filename)
+    return partitionings, mems[metric]
+
+# Same as read_input_varuna(), but returns the memory usage for all METRICS
+# (read in a single pass), e.g.: mems["reserved"][run][gpu]
+def read_input_varuna_metrics(slurm_filename):
+    partitionings = []
+    mems = {metric: [] for metric in METRICS}
+    failed_partitionings = []
+
+    for run in iter_profiling_runs(slurm_filename):
+        if run["mem"] is None:
+            failed_partitionings.append(run["partitioning"])
+        else:
+            partitionings.append(run["partitioning"])
+            for metric, key in METRICS.items():
+                mems[metric].append(run[key])
+
+    if len(failed_partitionings) > 0:
+        print("FAILED PARTITIONINGS: ", failed_partitionings)
+
+    return partitionings, mems
@@ -0,0 +1,32 @@
+#! /bin/bash
+
+# Memory profiling of train_mlp.py for 8 GPUs with CAPSlog, in two ways.
+# Run from the directory with train_mlp.py, with available_machines.out listing the machines.
+
+JOB_ID=mlp_profile
+GPUS_PER_SERVER=4
+MODEL_ARGS="--num-layers 24 --hidden-size 1024 --train-iters 20"
+
+# 1. Trimmed profiling runs. All partitionings with the same number of stages are profiled
+# in one job (--in_process, passes --profiling_campaign), and every configuration ends once
+# its memory usage is steady (--steady_state, passes --stop_at_steady_state).
+python ../../capslog/profile_varuna.py --job_id $JOB_ID \
+        --n_gpus 8 --n_cutpoints 23 --trimmed \
+        --batch_size 64 --chunk_size 4 \
+        --gpus_per_node $GPUS_PER_SERVER \
+        --machine_list available_machines.out \
+        --in_process --steady_state \
+        train_mlp.py $MODEL_ARGS
+
+# 2. A single untrimmed run that records the memory usage at every cutpoint
+# (--boundaries, passes --profile_boundaries) in the telemetry file.
+python ../../capslog/profile_varuna.py --job_id ${JOB_ID}_boundaries \
+        --n_gpus 8 --n_cutpoints 23 \
+        --batch_size 64 --chunk_size 4 \
+        --gpus_per_node $GPUS_PER_SERVER \
+        --machine_list available_machines.out \
+        --steady_state --telemetry --boundaries \
+        train_mlp.py $MODEL_ARGS
+
+# memory statistics of all layers from the boundary snapshots, and the best partitioning
+python ../../capslog/boundary_stats.py ssh_logs/telemetry_${JOB_ID}_boundaries.jsonl dp 8
@@ -0,0 +1,121 @@
+""" Minimal Varuna training script for memory profiling with CAPSlog (see profile_mlp.sh).
+
+Besides the arguments passed by the varuna launcher, it takes the arguments that
+capslog/profile_varuna.py adds to the training script:
+    --profiling_stages       stages to keep intact, the other stages are trimmed
+    --profiling_campaign     campaign file of profile_varuna --in_process
+    --stop_at_steady_state   passed by profile_varuna --steady_state
+    --profile_boundaries     passed by profile_varuna --boundaries
+"""
+
+import argparse
+import builtins
+
+import torch
+import torch.distributed as dist
+from torch import nn
+
+import varuna
+from varuna import Varuna, CutPoint
+
+parser = argparse.ArgumentParser(description="Varuna memory profiling example")
+parser.add_argument("--num-layers", type=int, default=24)
+parser.add_argument("--hidden-size", type=int, default=1024)
+parser.add_argument("--train-iters", type=int, default=20)
+parser.add_argument("--lr", type=float, default=0.01)
+parser.add_argument("--fp16", action="store_true", default=False)
+
+# passed by the varuna launcher
+parser.add_argument("--rank", type=int, default=-1)
+parser.add_argument("--local_rank", type=int, default=-1)
+parser.add_argument("--stage_to_rank_map", type=str, default=None,
+                        help = "stage to rank map of Varuna model")
+parser.add_argument("--chunk_size", type=int, default=None,
+                        help = "number of microbatches for pipeline")
+parser.add_argument("--batch-size", type=int, default=None,
+                        help = "batch size per data parallel replica")
+parser.add_argument("--stage_to_cut", type=str, default=None,
+                        help = "stage to cutpoint map of Varuna model")
+
+# passed by capslog/profile_varuna.py
+parser.add_argument("--profiling_stages", type=str, default=None,
+                        help = "stages to keep intact for memory profiling")
+parser.add_argument("--profiling_campaign", type=str, default=None,
+                        help = "configurations to profile in this job (see Varuna.profile_campaign)")
+parser.add_argument("--stop_at_steady_state", action="store_true", default=False,
+                        help = "end the profiling run once the memory usage is steady")
+parser.add_argument("--profile_boundaries", action="store_true", default=False,
+                        help = "record the memory usage at every cutpoint of the stage")
+
+
+class MLP(nn.Module):
+    # a CutPoint between every two layers, so every layer can be a stage
+
+    def __init__(self, num_layers, hidden_size):
+        super(MLP, self).__init__()
+        self.layers = nn.ModuleList([nn.Sequential(nn.Linear(hidden_size, hidden_size), nn.ReLU())
+                                     for _ in range(num_layers)])
+        self.cutpoints = nn.ModuleList([CutPoint() for _ in range(num_layers - 1)])
+        self.loss_fn = nn.MSELoss()
+
+    def forward(self, inputs, target):
+        x = inputs
+        for i, layer in enumerate(self.layers):
+            x = layer(x)
+            if i < len(self.cutpoints):
+                x = self.cutpoints[i](x)
+        return self.loss_fn(x, target)
+
+
+def setup_print(rank):
+    # Varuna prints with force=True what every worker should print
+    builtin_print = builtins.print
+    def print(*args, **kwargs):
+        force = kwargs.pop("force", False)
+        if rank == 0 or force:
+            builtin_print(*args, **kwargs)
+    builtins.print = print
+
+
+def main():
+    args = parser.parse_args()
+    dist.init_process_group(backend="gloo", init_method="env://", rank=args.rank)
+    setup_print(args.rank)
+
+    def get_batch_fn(size, device=None):
+        inputs = {"inputs": torch.randn(size, args.hidden_size), "target": torch.randn(size, args.hidden_size)}
+        if device is not None:
+            inputs = {k: v.to(device) for k, v in inputs.items()}
+        return inputs
+
+    def get_optimizer_fn(parameters):
+        return torch.optim.SGD(parameters, args.lr)
+
+    model = MLP(args.num_layers, args.hidden_size)
+    model = Varuna(model, args.stage_to_rank_map, get_batch_fn, args.batch_size,
+                   args.chunk_size, args.stage_to_cut, fp16=args.fp16,
+                   local_rank=args.local_rank, device=args.local_rank,
+                   profiling_stages=args.profiling_stages,
+                   keep_cpu_model=args.profiling_campaign is not None,
+                   stop_at_steady_state=args.stop_at_steady_state,
+                   boundary_allocator=torch.cuda if args.profile_boundaries else None)
+
+    def get_inputs_fn():
+        return get_batch_fn(args.batch_size, model.device)
+
+    if args.profiling_campaign is not None:
+        campaign = varuna.utils.read_profiling_campaign(args.profiling_campaign)
+        model.profile_campaign(campaign, get_optimizer_fn, get_inputs_fn)
+        return
+
+    optimizer = get_optimizer_fn(model.parameters())
+    model.set_optimizer(optimizer)
+    for _ in range(args.train_iters):
+        # with --stop_at_steady_state, step() ends the job once the memory usage is steady
+        model.zero_grad()
+        model.step(get_inputs_fn())
+        optimizer.step()
+
+
+if __name__ == "__main__":
+    main()
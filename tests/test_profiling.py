@@ -0,0 +1,81 @@
+""" Tests of Varuna's memory profiling that run on CPU, without GPUs. """
+
+import socket
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip("torch")
+import torch.distributed as dist
+
+from varuna import varuna as varuna_module
+from varuna.varuna import Varuna
+from varuna.partitioned_model import BoundarySnapshotFunction
+
+
+@pytest.fixture(scope="module")
+def process_group():
+    # single worker gloo group, for the all-reduce of the steady state
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    dist.init_process_group(backend="gloo", init_method="tcp://127.0.0.1:{}".format(port),
+                            world_size=1, rank=0)
+    yield
+    dist.destroy_process_group()
+
+
+def test_boundary_snapshot_function_is_identity():
+    calls = []
+    x = torch.randn(3, 4, requires_grad=True)
+    y = BoundarySnapshotFunction.apply(lambda backward=False: calls.append(backward), x)
+    assert torch.equal(y, x)
+    # no snapshot until the gradients reach the boundary
+    assert calls == []
+
+    (2 * y).sum().backward()
+    assert calls == [True]
+    assert torch.equal(x.grad, torch.full_like(x, 2))
+
+
+def test_boundary_snapshot_function_multiple_inputs():
+    calls = []
+    a = torch.randn(2, requires_grad=True)
+    b = torch.randn(2, requires_grad=True)
+    y_a, y_b = BoundarySnapshotFunction.apply(lambda backward=False: calls.append(backward), a, b)
+    (y_a * 3 + y_b).sum().backward()
+    assert calls == [True]
+    assert torch.equal(a.grad, torch.full_like(a, 3))
+    assert torch.equal(b.grad, torch.ones_like(b))
+
+
+def test_steady_state(process_group):
+    model = SimpleNamespace(device=torch.device("cpu"))
+    Varuna.reset_steady_state(model)
+
+    # steady once the peak did not grow for steady_state_steps steps
+    peaks = [100, 200] + [200] * (varuna_module.steady_state_steps - 1)
+    for peak in peaks:
+        Varuna.update_steady_state(model, peak)
+        assert not model.steady_state
+    Varuna.update_steady_state(model, 150)
+    assert model.steady_state
+
+    # a new peak starts over
+    Varuna.update_steady_state(model, 300)
+    assert not model.steady_state
+
+    Varuna.reset_steady_state(model)
+    assert not model.steady_state
+    assert model.max_allocated_peak == 0
+
+
+def test_end_profiling_run_exits(process_group, monkeypatch, capsys):
+    # the training script prints with force=True (see examples/profiling/train_mlp.py)
+    builtin_print = print
+    monkeypatch.setattr("builtins.print", lambda *args, force=False, **kwargs: builtin_print(*args, **kwargs))
+    model = SimpleNamespace(rank=0, iteration=5)
+    with pytest.raises(SystemExit) as exit_info:
+        Varuna.end_profiling_run(model)
+    assert exit_info.value.code == 0
+    assert "steady after 5 iterations" in capsys.readouterr().out
@@ -0,0 +1,36 @@
+class BoundarySnapshots:
+    """ Records the allocator counters at the CutPoint boundaries of a stage, for memory profiling
+        in a single run (see ``boundary_stats.py`` in CAPSlog). At every boundary, the currently allocated
+        memory and the peak allocated memory since the previous boundary are recorded, after which the
+        peak is reset. Snapshots are lists ``[phase, cut, allocated, peak]``, where phase is "forward",
+        "recompute" or "backward" and cut is the index of the CutPoint, or "entry"/"exit" for the start and
+        end of the pass over the stage.
+
+        The allocator backend is pluggable: any object with ``memory_allocated()``, ``max_memory_allocated()``,
+        ``max_memory_reserved()`` and ``reset_peak_memory_stats()``, such as ``torch.cuda``.
+        This module does not import torch, so the recording can be tested on CPU with a fake allocator. """
+
+    def __init__(self, allocator):
+        self.allocator = allocator
+        self.snapshots = []
+        # peaks since the last pop(), as the allocator's peaks are reset at every snapshot
+        self.max_allocated = 0
+        self.max_reserved = 0
+
+    def snapshot(self, phase, cut):
+        peak = self.allocator.max_memory_allocated()
+        self.max_allocated = max(self.max_allocated, peak)
+        self.max_reserved = max(self.max_reserved, self.allocator.max_memory_reserved())
+        self.snapshots.append([phase, cut, self.allocator.memory_allocated(), peak])
+        self.allocator.reset_peak_memory_stats()
+
+    def pop(self):
+        """ returns the snapshots since the last call, and the peak allocated and reserved memory
+            over that time (which the allocator's own peaks do not cover) """
+        peaks = (max(self.max_allocated, self.allocator.max_memory_allocated()),
+                 max(self.max_reserved, self.allocator.max_memory_reserved()))
+        snapshots = self.snapshots
+        self.snapshots = []
+        self.max_allocated = 0
+        self.max_reserved = 0
+        return snapshots, peaks
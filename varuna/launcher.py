@@ -8,9 +8,11 @@ import signal
 import math
 import random
 import socket
+import json
 
 from .checkpoint import get_local_ckpt_tracker
-from .utils import update_local_varuna_pid, VARUNA_TEMP_FOLDER, MORPH_PORT_ENV_VAR, HEARTBEAT_IP_ENV_VAR
+from .utils import update_local_varuna_pid, write_telemetry, VARUNA_TEMP_FOLDER, MORPH_PORT_ENV_VAR, HEARTBEAT_IP_ENV_VAR, \
+    TELEMETRY_FILE_ENV_VAR, TELEMETRY_RUN_ID_ENV_VAR
 from .auto_config import AutoConfig
 
 processes = []
@@ -20,6 +22,8 @@ def calculate_config(args):
     gpus_available = args.ngpus_per_server * args.nservers
     if args.nstages is None:
         args.nstages, args.chunk_size = num_partitions(gpus_available, args.ngpus_per_server, args.batch_size)
+    if args.stage_to_cut is None and args.stage_to_cut_table is not None:
+        args.stage_to_cut = lookup_stage_to_cut(args.stage_to_cut_table, args.nstages)
     gpus_per_stage = (gpus_available // args.nstages) if args.gpus_per_stage == 0 else args.gpus_per_stage
     # args.gpus_per_stage = gpus_per_stage
     print(gpus_per_stage, "per stage")
@@ -85,6 +89,17 @@ def num_partitions(world_size, ngpus_per_server, batch_size):
     print("expected time is", time, flush=True)
     return num_partitions, chunk_size
 
+def lookup_stage_to_cut(table_filename, nstages):
+    """ looks up the stage_to_cut map for nstages in a table written by
+        CAPSlog (calc_mem_stats.py dp_all); None if it has no entry """
+    with open(table_filename, "r") as f:
+        table = json.load(f)
+    entry = table.get(str(nstages))
+    if entry is None:
+        print(f"WARNING: no stage to cut map for {nstages} stages in {table_filename}")
+        return None
+    return entry["stage_to_cut"]
+
 def send_to_manager(message, manager_ip, manager_port):
     try:
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
@@ -136,6 +151,9 @@ def parse_args():
     
     parser.add_argument("--stage_to_cut", default=None, type=str,
                         help = "stage to cutpoint map of Varuna model")
+    parser.add_argument("--stage_to_cut_table", default=None, type=str,
+                        help = "JSON table with a stage to cutpoint map per number of stages, "
+                        "used if --stage_to_cut is not given")
     # need a better way to pass this information ?
     # parser.add_argument("--total_num_stages", required=True, type=int,
     #                     help="The total number of potential stages/partitions the model is divided into")
@@ -151,6 +169,10 @@ def parse_args():
                              "training")
     parser.add_argument("--custom_placement", default=False, action="store_true",
                         help="place embeddings separately if possible")
+    parser.add_argument("--telemetry_file", default=None, type=str,
+                        help="JSONL file the workers append their telemetry records to")
+    parser.add_argument("--run_id", default=None, type=str,
+                        help="ID of the profiling run in the telemetry records")
 
     # parser.add_argument("--rank_aliasing", default=False, action="store_true",
     #                     help="shuffle ranks to avoid NCCL errors")
@@ -192,6 +214,11 @@ if __name__ == "__main__":
 
     signal.signal(signal.SIGUSR1, handler)
 
+    # the workers inherit the telemetry file and run id
+    if args.telemetry_file is not None:
+        os.environ[TELEMETRY_FILE_ENV_VAR] = args.telemetry_file
+        os.environ[TELEMETRY_RUN_ID_ENV_VAR] = str(args.run_id)
+
     # set PyTorch distributed related environmental variables
     current_env = os.environ.copy()
     current_env["MASTER_ADDR"] = args.master_addr
@@ -267,6 +294,10 @@ if __name__ == "__main__":
             if process.returncode != 0:
                 for p in processes:
                     p.kill()
+        # the run is done once every server reported, or a server reported a failed worker
+        returncodes = [p.returncode for p in processes]
+        write_telemetry("done", node_rank=args.node_rank, returncode=next((r for r in returncodes if r != 0), 0),
+                        returncodes=returncodes, n_expected=args.nservers)
     except Exception as e:
         print("run_varuna subprocesses quit with error:", e)
 
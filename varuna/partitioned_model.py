@@ -6,8 +6,9 @@ import os, sys
 import inspect
 import time
 import pickle
+from functools import partial
 
-from .utils import save_rng_states, restore_rng_states, VARUNA_TEMP_FOLDER
+from .utils import save_rng_states, restore_rng_states, write_telemetry, VARUNA_TEMP_FOLDER
 
 from collections import OrderedDict 
 
@@ -35,10 +36,22 @@ class CutPoint(Module):
 
         self.set_shapes = None
         self.forward_counter = 0
+        # set by PartitionedModel when profiling with boundary snapshots
+        self.snapshot_fn = None
     
     def set_pruning(self, boolean):
         self.pruning = boolean
 
+    def snapshot_boundary(self, inputs):
+        # snapshot in the forward pass, and in the backward pass once the gradients of the later layers are computed
+        self.snapshot_fn()
+        if torch.is_grad_enabled() and all(isinstance(i, torch.Tensor) for i in inputs) and \
+                any(i.requires_grad for i in inputs):
+            inputs = BoundarySnapshotFunction.apply(self.snapshot_fn, *inputs)
+            if not isinstance(inputs, tuple):
+                inputs = (inputs,)
+        return inputs
+
     def forward(self, *inputs, **kwargs):
         # not set by ModelParallel, pass through as is
         if self.barrier_event is not None:
@@ -47,6 +60,8 @@ class CutPoint(Module):
             self.boundary_func()
         
         if self.cp_func is None:
+            if self.snapshot_fn is not None:
+                inputs = self.snapshot_boundary(inputs)
             if len(inputs) == 1:
                 return inputs[0]
             return inputs
@@ -80,6 +95,9 @@ class CutPoint(Module):
 
                 self.forward_counter += 1
             out = self.cp_func.apply(*inputs)
+            if self.snapshot_fn is not None:
+                # after receiving the activations (pre cp) or sending them (post cp)
+                self.snapshot_fn()
             if self.cp_index == (self.stage + 1):
                 self.set_ret_val_func(out) 
             return out
@@ -125,6 +143,9 @@ class CutPoint(Module):
                 elif is_in_next_stage and self.send_fn is not None:
                     self.send_fn(grad_output, grads = True)
 
+                if self.snapshot_fn is not None:
+                    self.snapshot_fn(backward=True)
+
                 if len(grad_output) == 1:
                     return grad_output[0]
                 return grad_output
@@ -133,6 +154,22 @@ class CutPoint(Module):
         self.cp_func = c
 
 
+class BoundarySnapshotFunction(torch.autograd.Function):
+    # Identity, which snapshots the allocator when the gradients reach the boundary in the backward pass.
+
+    @staticmethod
+    def forward(ctx, snapshot_fn, *i):
+        ctx.snapshot_fn = snapshot_fn
+        if len(i) == 1:
+            return i[0]
+        return i
+
+    @staticmethod
+    def backward(ctx, *grad_output):
+        ctx.snapshot_fn(backward=True)
+        return (None,) + grad_output
+
+
 def dry_run(model, get_batch, from_cache):
     # executes the forward pass of the module on dummy inputs. 
     # Sets the order in which modules are used and the total number of cutpoints declared.
@@ -235,7 +272,7 @@ def read_dry_run_out(model):
 
 class PartitionedModel(Module):
 
-    def __init__(self, module, rank, local_rank, device, stage_to_rank_map, fp16, stage_to_cut, chunks, shared_weights=None, profiling_stages=None):
+    def __init__(self, module, rank, local_rank, device, stage_to_rank_map, fp16, stage_to_cut, chunks, shared_weights=None, profiling_stages=None, boundary_snapshots=None):
         super(PartitionedModel, self).__init__()
         self.module = module
         self.num_stages = len(stage_to_rank_map)
@@ -277,6 +314,9 @@ class PartitionedModel(Module):
             self.profiling_stages = None
 
         self.trimmed = False
+        # BoundarySnapshots when profiling the memory usage at the CutPoint boundaries
+        self.boundary_snapshots = boundary_snapshots
+        self.forward_phase = "forward"
         # self.logfile = open("wait_logs" + str(self.rank),"w")
 
     def initialize(self, get_batch_fn, from_cache=False):
@@ -306,10 +346,45 @@ class PartitionedModel(Module):
                 else:
                     upper_cut = self.num_cutpoints
 
+        # starts a (new) profiling run in the telemetry, the memory records that follow belong to it
+        if self.rank == 0:
+            write_telemetry("partitioning", num_cutpoints=self.num_cutpoints, stage_to_cut=self.stage_to_cut,
+                            profiling_stages=self.profiling_stages)
+
         self.prep_cutpoints()
         self.remove_unused_parameters()
         self.model_pruned = True
 
+        if self.boundary_snapshots is not None and not self.trimmed:
+            self.attach_boundary_snapshots()
+
+    def get_cut_range(self):
+        start = self.stage_to_cut[self.stage]
+        end = self.stage_to_cut[self.stage+1] if self.stage < (self.num_stages - 1) else (self.num_cutpoints + 1)
+        return start, end
+
+    def attach_boundary_snapshots(self):
+        # snapshot at every CutPoint of this stage, and log the parameter memory of each of its layers
+        # (cut index i is the boundary before layer i, as in stage_to_cut)
+        start, end = self.get_cut_range()
+        index = 1
+        for name in self.ordered_modules:
+            module = self.ordered_modules[name]
+            if isinstance(module, CutPoint):
+                if start <= index <= end:
+                    module.snapshot_fn = partial(self.snapshot_boundary, index)
+                index += 1
+
+        layer_params = {layer: 0 for layer in range(start, end)}
+        for n, p in self.module.named_parameters():
+            layer = self.param_name_to_pstage.get(n, start)
+            layer = layer if layer in layer_params else start
+            layer_params[layer] += p.numel() * p.element_size()
+        write_telemetry("layer_params", rank=self.rank, stage=self.stage, start=start, end=end, layer_params=layer_params)
+
+    def snapshot_boundary(self, cut, backward=False):
+        self.boundary_snapshots.snapshot("backward" if backward else self.forward_phase, cut)
+
     def dry_run(self, get_batch, from_cache):
 
         if self.local_rank == 0 and not (from_cache and \
@@ -759,6 +834,11 @@ class PartitionedModel(Module):
         else:
             self.clear_recv_fn()
 
+        snapshots = self.boundary_snapshots is not None and not self.trimmed
+        if snapshots:
+            self.forward_phase = "recompute" if recompute else "forward"
+            self.snapshot_boundary("entry")
+
         try:
             calc_val = self.module(**inputs_as_dict)
             ret_val = self.ret_val if self.ret_val is not None else calc_val
@@ -769,6 +849,8 @@ class PartitionedModel(Module):
 
             ret_val = self.ret_val
         self.ret_val = None
+        if snapshots:
+            self.snapshot_boundary("exit")
 
         if recording:
             if self.stage == self.num_stages - 1:
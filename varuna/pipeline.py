@@ -319,6 +319,10 @@ class Pipeline:
                 self.loss = self.loss/self.chunks
                 self.average_loss += (self.loss.item())
 
+            snapshots = self.model.boundary_snapshots is not None and not self.model.trimmed
+            if snapshots:
+                self.model.snapshot_boundary("entry", backward=True)
+
             if self.fp16:
                 with amp.scale_loss(self.loss, self.optimizer, delay_overflow_check=True, 
                             last_partition=(self.stage == self.partitions-1)) as scaled_loss:
@@ -328,6 +332,8 @@ class Pipeline:
 
             del self.loss
             self.loss = None
+            if snapshots:
+                self.model.snapshot_boundary("exit", backward=True)
         
     def run(self):
         if self.verbose:
@@ -14,6 +14,12 @@ launch_args_filename = "launch_args"
 # TODO move this to args/utils
 running_machines_list = "varuna_current_machines"
 
+def get_job_filename(name, job_id):
+    # per job, so that concurrent runs sharing a machine (and home directory) do not overwrite each other's files
+    if job_id is None:
+        return name
+    return f"{name}_{job_id}"
+
 def check_morph_listeners(manager_ip):
     running = True
     for port in [HEARTBEAT_PORT, MORPH_PORT]:
@@ -24,7 +30,7 @@ def check_morph_listeners(manager_ip):
             running = running and ("yes" in response)
     return running
 
-def start_morph_listeners(available_machine_list):
+def start_morph_listeners(available_machine_list, running_machines_list):
     # TODO : need to ssh into manager ip and run these
     # morph server
     cmd = f"python -m varuna.morph_server " \
@@ -51,11 +57,16 @@ def get_launch_cmd_format(args):
         +  f" --ngpus_per_server {args.gpus_per_node}  " \
         +  " --node_rank {} --nservers {} --master_addr {}"
         +  f" --nstages {args.nstages} --batch_size {args.batch_size}" \
-        +  f" --chunk_size {args.chunk_size} --code_dir {args.code_dir}")
+        +  f" --chunk_size {args.chunk_size} --code_dir {args.code_dir}" \
+        +  f" --master_port {args.master_port}")
     if args.stage_to_cut is not None:
         launch_cmd.append(f"--stage_to_cut {args.stage_to_cut}")
+    if args.stage_to_cut_table is not None:
+        launch_cmd.append(f"--stage_to_cut_table {args.stage_to_cut_table}")
     if args.profiling_stages is not None:
         launch_cmd.append(f"--profiling_stages {args.profiling_stages}")
+    if args.telemetry_file is not None:
+        launch_cmd.append(f"--telemetry_file {args.telemetry_file} --run_id {args.run_id}")
     launch_cmd.append(args.training_script)
     launch_cmd.extend(args.training_script_args)
     launch_cmd = " ".join(launch_cmd)
@@ -92,6 +103,19 @@ def parse_args():
                         help = "file with environment variables for varuna command")
     parser.add_argument("--job_id", type=str, default=None,
                             help= "SLURM job ID.")
+    parser.add_argument("--master_port", type=int, default=29500,
+                            help= "Port of the master process, must differ between runs sharing a machine.")
+    parser.add_argument("--telemetry_file", type=str, default=None,
+                            help= "JSONL file the workers append their telemetry records to "
+                            "(memory usage, partitioning, return codes), read by CAPSlog.")
+    parser.add_argument("--run_id", type=str, default=None,
+                            help= "ID of the profiling run in the telemetry records, defaults to the job id.")
+    parser.add_argument("--new_logs", action="store_true",
+                            help= "Truncate ssh_logs/ssh_out_<job_id> and ssh_err_<job_id> at startup instead of "
+                            "appending, for job ids that are used again (e.g. the slots of concurrent profiling runs).")
+    parser.add_argument("--cuda_visible_devices", type=str, default=None,
+                            help= "GPUs to use on every machine (CUDA_VISIBLE_DEVICES), "
+                            "to run on a slice of the GPUs of the machines.")
 
     # launch worker args
     parser.add_argument("--nstages", type=int, default=None,
@@ -107,6 +131,9 @@ def parse_args():
                         help="Resume a varuna run.")
     parser.add_argument("--stage_to_cut", default=None, type=str,
                         help = "stage to cutpoint map of Varuna model")
+    parser.add_argument("--stage_to_cut_table", default=None, type=str,
+                        help = "JSON table with a stage to cutpoint map per number of stages, "
+                        "looked up when the number of stages changes")
     parser.add_argument('--profiling_stages', type=str, default=None,
                         help="Stages to keep intact for profiling")
 
@@ -128,7 +155,7 @@ if __name__ == "__main__":
         content = f.read()
         reachable_machines = content.split("\n")
         reachable_machines = [m for m in reachable_machines if len(m) > 0]
-        with open(running_machines_list, "w") as of:
+        with open(get_job_filename(running_machines_list, args.job_id), "w") as of:
             of.write(content)
     print(reachable_machines)
 
@@ -142,18 +169,20 @@ if __name__ == "__main__":
 
     if args.code_dir is None:
         args.code_dir = os.getcwd()
+    if args.run_id is None:
+        args.run_id = args.job_id
     if args.manager_ip is None:
         args.manager_ip = socket.gethostbyname(socket.gethostname())
 
     if not args.no_morphing:
         if not args.resume:
             kill_morph_listeners()
-            start_morph_listeners(args.machine_list)
+            start_morph_listeners(args.machine_list, get_job_filename(running_machines_list, args.job_id))
         assert check_morph_listeners(args.manager_ip), "Listeners not in place for morphing!"
 
     if not os.path.exists(VARUNA_TEMP_FOLDER):
         os.makedirs(VARUNA_TEMP_FOLDER)
-    arg_file = os.path.join(VARUNA_TEMP_FOLDER, launch_args_filename)
+    arg_file = os.path.join(VARUNA_TEMP_FOLDER, get_job_filename(launch_args_filename, args.job_id))
     if args.resume:
         assert os.path.exists(arg_file), "Args file not found for resumed run!"
         with open(arg_file, "r") as f:
@@ -169,13 +198,19 @@ if __name__ == "__main__":
     current_env[HEARTBEAT_IP_ENV_VAR] = str(args.manager_ip)
     current_env[HEARTBEAT_PORT_ENV_VAR] = str(HEARTBEAT_PORT)
     current_env[MORPH_PORT_ENV_VAR] = str(MORPH_PORT)
+    if args.cuda_visible_devices is not None:
+        current_env["CUDA_VISIBLE_DEVICES"] = args.cuda_visible_devices
    # current_env["PATH"] = "PATH=\"/home/varuna/anaconda3/bin:$PATH\""
 
+    # opened once, shared by the processes of all machines
+    log_mode = "w" if args.new_logs and not args.resume else "a"
+    out_file = open(f"ssh_logs/ssh_out_{args.job_id}", log_mode)
+    err_file = open(f"ssh_logs/ssh_err_{args.job_id}", log_mode)
+
     processes = []
     for i,machine in enumerate(reachable_machines):
         launch_cmd = launch_cmd_format.format(i, reachable_count, master_addr)
-        out_file = open(f"ssh_logs/ssh_out_{args.job_id}", "a")
-        err_file = open(f"ssh_logs/ssh_err_{args.job_id}", "a")
+        launch_script = get_job_filename("launch_varuna", args.job_id) + f"_{i}.sh"
 
         if machine == "127.0.0.1":
             cmd = launch_cmd.split(" ")
@@ -184,13 +219,15 @@ if __name__ == "__main__":
         else:
             cmd = ["ssh"]
             cmd.append(machine)
-            cmd.append(f"echo \"{launch_cmd}\" > launch_varuna_{i}.sh; chmod 755 launch_varuna_{i}.sh; ")
+            cmd.append(f"echo \"{launch_cmd}\" > {launch_script}; chmod 755 {launch_script}; ")
             cmd.append(f"conda activate varuna; module load cuda11.7/toolkit; ")
             cmd.append(f"LD_LIBRARY_PATH=/var/scratch/als271/Anaconda/pkgs/cuda-nvml-dev-11.7.91-0/lib:/var/scratch/als271/Anaconda/envs/varuna/lib:$LD_LIBRARY_PATH; ")
             cmd.append(f"{HEARTBEAT_IP_ENV_VAR}={args.manager_ip}")
             cmd.append(f"{MORPH_PORT_ENV_VAR}={MORPH_PORT} {HEARTBEAT_PORT_ENV_VAR}={HEARTBEAT_PORT}")
             cmd.append(get_env_vars(args.env_file))
-            cmd.append(f"bash launch_varuna_{i}.sh")
+            if args.cuda_visible_devices is not None:
+                cmd.append(f"CUDA_VISIBLE_DEVICES={args.cuda_visible_devices}")
+            cmd.append(f"bash {launch_script}")
             print(" ".join(cmd ))
 
         process = subprocess.Popen(cmd, env=current_env,
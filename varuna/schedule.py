@@ -0,0 +1,19 @@
+import os
+
+# Kept apart from utils (which imports torch and apex), so that CAPSlog can
+# load it without torch.
+
+def generate_schedule(chunks, stage, partitions):
+    print(chunks,"chunks")
+    gensched_binary = os.path.join(os.path.dirname(os.path.abspath(__file__)),'genschedule')
+    c_schedule = os.popen( gensched_binary + ' ' +
+                            str(partitions) + ' ' +
+                            str(chunks) + ' ' +
+                            str(stage)).read()
+    schedule = list()
+    steps = c_schedule.split(';')
+    steps = steps[:-1]
+    for step in steps:
+        task = step.split(',')
+        schedule.append((int(task[0]), int(task[1])))
+    return schedule
@@ -1,5 +1,7 @@
 
 import os
+import json
+import time
 import socket
 import math
 
@@ -9,11 +11,15 @@ try:
     from apex.amp import _amp_state
 except:
     pass
+
+from .schedule import generate_schedule
     
 VARUNA_TEMP_FOLDER = "/home/als271/tmp_varuna"
 HEARTBEAT_IP_ENV_VAR = "VARUNA_MANAGER_IP"
 HEARTBEAT_PORT_ENV_VAR = "VARUNA_HEARTBEAT_PORT"
 MORPH_PORT_ENV_VAR = "VARUNA_MORPH_PORT"
+TELEMETRY_FILE_ENV_VAR = "VARUNA_TELEMETRY_FILE"
+TELEMETRY_RUN_ID_ENV_VAR = "VARUNA_TELEMETRY_RUN_ID"
 LOCAL_PID_FILENAME = "local_parent_pid"
 
 def scatter(input, batch_size, chunk_size):
@@ -111,21 +117,6 @@ def heartbeat(message, ip, port):
         except:
             print("Could not send progress update message")
 
-def generate_schedule(chunks, stage, partitions):
-    print(chunks,"chunks")
-    gensched_binary = os.path.join(os.path.dirname(os.path.abspath(__file__)),'genschedule')
-    c_schedule = os.popen( gensched_binary + ' ' +
-                            str(partitions) + ' ' +
-                            str(chunks) + ' ' +
-                            str(stage)).read()
-    schedule = list()
-    steps = c_schedule.split(';')
-    steps = steps[:-1]
-    for step in steps:
-        task = step.split(',')
-        schedule.append((int(task[0]), int(task[1])))
-    return schedule
-
 def parse_stage_to_rank_map(stage_to_rank_map_str):
     """ parses the stage_to_rank_map string recieved from varuna launcher """
     # parse stage_to_rank_map
@@ -150,6 +141,13 @@ def parse_stage_to_cut(stage_to_cut_str):
     return stage_to_cut
 
 
+def read_profiling_campaign(campaign_filename):
+    """ reads the configurations of a profiling campaign written by profile_varuna (JSON),
+        a list of {"stage_to_cut": "0,3,8", "profiling_stages": "1,2" or None} """
+    with open(campaign_filename, "r") as f:
+        return json.load(f)
+
+
 def get_varuna_config(stage_to_rank_map_str):
     """ parses the stage_to_rank_map string recieved from varuna launcher to
         return a tuple of the form (num_pipeline_stages, num_data_parallel_replicas)"""
@@ -188,10 +186,31 @@ def get_local_varuna_pid():
     return pid
 
 
-def report_memory(name, rank):
-    """Simple GPU memory report."""
+def write_telemetry(record_type, **fields):
+    """ appends a typed record to the JSONL telemetry file of the job, if the launcher set one
+        (VARUNA_TELEMETRY_FILE). Every record has the record type and the run id of the profiling run.
+        A record is written with a single appending write, so the records of concurrent
+        workers do not interleave. """
+    telemetry_file = os.environ.get(TELEMETRY_FILE_ENV_VAR, None)
+    if telemetry_file is None:
+        return
+    record = {"type": record_type, "run_id": os.environ.get(TELEMETRY_RUN_ID_ENV_VAR, None), "time": time.time()}
+    record.update(fields)
+    fd = os.open(telemetry_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(record) + "\n").encode())
+    finally:
+        os.close(fd)
+
+
+def report_memory(name, rank, iteration=None, peaks=None):
+    """Simple GPU memory report. 'peaks' are the peak allocated and reserved memory of the
+    iteration if the allocator's peaks were reset during it (see BoundarySnapshots.pop)."""
     allocated_peak = torch.cuda.max_memory_allocated()
     reserved_peak = torch.cuda.max_memory_reserved()
+    if peaks is not None:
+        allocated_peak = max(allocated_peak, peaks[0])
+        reserved_peak = max(reserved_peak, peaks[1])
 
     string = 'Memory allocated on rank {} '.format(rank)
     string += name
@@ -199,6 +218,8 @@ def report_memory(name, rank):
     string += ' | peak reserved: {}'.format(reserved_peak)
     
     print(string, force=True)
+    write_telemetry("memory", rank=rank, iteration=iteration, name=name,
+                    peak_allocated=allocated_peak, peak_reserved=reserved_peak)
     torch.cuda.reset_peak_memory_stats()
 
     return (allocated_peak, reserved_peak)
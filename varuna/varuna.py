@@ -16,11 +16,13 @@ except:
 import concurrent.futures
 
 from .partitioned_model import PartitionedModel
+from .boundary_snapshots import BoundarySnapshots
 from .pipeline import Pipeline
 from . import utils
 from .checkpoint import write_varuna_checkpoint, get_local_ckpt_tracker, \
          load_varuna_checkpoint, load_varuna_optimizer, num_params_written, get_prev_checkpoint
 import gc
+import copy
 import numpy
 import socket
 
@@ -32,6 +34,10 @@ Module = nn.Module
 
 log_verbose = False
 
+# Number of consecutive steps without a new peak allocated memory after which
+# the memory usage of a profiling run is steady (see stop_at_steady_state).
+steady_state_steps = 2
+
 TASK = ["fwd", "rec", "bwd"]
     
 class Varuna(Module):
@@ -71,6 +77,20 @@ class Varuna(Module):
     :type shared_weights: list or None
     :param from_cache: Whether to use cached profiling information if available.
     :type from_cache: bool
+    :param profiling_stages: Stages to keep intact for memory profiling, as passed by ``profile_varuna``
+        to the training script. The other stages are trimmed.
+    :type profiling_stages: str or None
+    :param keep_cpu_model: Whether to keep a copy of the full model on CPU, so that the model can be
+        re-partitioned with :func:`repartition` without restarting the job.
+    :type keep_cpu_model: bool
+    :param stop_at_steady_state: For memory profiling: whether to end the job once the peak allocated
+        memory has stopped growing on all workers, after which further steps give no new memory statistics.
+    :type stop_at_steady_state: bool
+    :param boundary_allocator: For memory profiling: an allocator backend (e.g. ``torch.cuda``) whose current
+        and peak allocated memory are recorded at every CutPoint boundary of the stage during the forward,
+        recompute and backward passes, and written to the telemetry file every step. From these, CAPSlog
+        derives approximate per-layer memory statistics from a single run (see ``boundary_stats.py``).
+    :type boundary_allocator: object or None
     
     .. note::
 
@@ -92,7 +112,10 @@ class Varuna(Module):
                 device=-1,
                 shared_weights=None,
                 from_cache=True,
-                profiling_stages=None):
+                profiling_stages=None,
+                keep_cpu_model=False,
+                stop_at_steady_state=False,
+                boundary_allocator=None):
         super().__init__()
 
         self.rank = dist.get_rank()
@@ -122,6 +145,7 @@ class Varuna(Module):
 
         if device == -1:
             device = self.local_rank
+        self.device_id = device
         if device == "cpu":
             self.device = torch.device("cpu")
         else:
@@ -132,8 +156,14 @@ class Varuna(Module):
         self.fp16 = fp16
         self.shared_weights = shared_weights
 
+        # the full model is pruned in place, keep a copy to re-partition from.
+        # Not registered as a submodule, so its parameters are not part of this module's parameters.
+        self.__dict__["cpu_model"] = copy.deepcopy(model) if keep_cpu_model else None
+        self.get_batch_fn = get_batch_fn
+        self.boundary_snapshots = BoundarySnapshots(boundary_allocator) if boundary_allocator is not None else None
+
         # partition model based on "CutPoint"s using a dry run with dummy inputs (dict)
-        self.model = PartitionedModel(model, self.rank, self.local_rank, device, self.stage_to_rank_map, self.fp16, self.stage_to_cut, self.chunks, shared_weights, profiling_stages)
+        self.model = PartitionedModel(model, self.rank, self.local_rank, device, self.stage_to_rank_map, self.fp16, self.stage_to_cut, self.chunks, shared_weights, profiling_stages, self.boundary_snapshots)
         self.model.initialize( get_batch_fn, from_cache=from_cache )
         self.partitioned_model = self.model
         self.shared_weight_stages = self.model.shared_weight_stages if self.shared_weights is not None else None
@@ -171,6 +201,136 @@ class Varuna(Module):
         self.iteration = 0
         self.current_step = 0
 
+        self.stop_at_steady_state = stop_at_steady_state
+        self.campaign_running = False
+        self.reset_steady_state()
+
+    def repartition(self, stage_to_cut, profiling_stages=None):
+        r"""Re-partition the model with another stage to cutpoint mapping (with the same number of stages),
+        without restarting the distributed job. The partition is pruned from the copy of the full model
+        kept on CPU, and the cached dry run outputs are re-used, so the cost of starting the job, the dry run
+        and loading the model is only paid once. Must be called on all workers, and requires ``keep_cpu_model``.
+        The optimizer of the previous partition is dropped, a new one must be set with :func:`set_optimizer`.
+
+        :param stage_to_cut: the first cutpoint of each stage, in the format passed by ``varuna.launcher``.
+        :type stage_to_cut: str
+        :param profiling_stages: stages to keep intact for memory profiling, the other stages are trimmed.
+        :type profiling_stages: str or None, optional
+        """
+        assert self.cpu_model is not None, "Varuna must be initialised with keep_cpu_model=True to repartition!"
+
+        # free the current partition before creating the new one
+        self.optimizer = None
+        self.pipeline = None
+        self.model = self.partitioned_model = None
+        gc.collect()
+        if self.device.type == "cuda":
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats()
+
+        self.stage_to_cut = utils.parse_stage_to_cut(stage_to_cut)
+        self.profiling = profiling_stages is not None
+        self.model = PartitionedModel(copy.deepcopy(self.cpu_model), self.rank, self.local_rank, self.device_id,
+                                      self.stage_to_rank_map, self.fp16, self.stage_to_cut, self.chunks,
+                                      self.shared_weights, profiling_stages, self.boundary_snapshots)
+        self.reset_steady_state()
+        # the dry run outputs were cached when the job started
+        self.model.initialize( self.get_batch_fn, from_cache=True )
+        self.partitioned_model = self.model
+        self.shared_weight_stages = self.model.shared_weight_stages if self.shared_weights is not None else None
+
+        self.init_communication()
+        self.model.to(self.device)
+        # tied weight groups depend on the stages holding the shared weights
+        if self.shared_weights is not None:
+            self.init_distributed()
+        self.configure_checkpointing()
+
+        self.config.update({
+            "fwd_inp_shape": self.fwd_inp_shape,
+            "fwd_inp_shape_changes": self.fwd_inp_shape_changes,
+            "bwd_grad_shape": self.bwd_grad_shape,
+            "bwd_grad_shape_changes": self.bwd_grad_shape_changes,
+            "pipeline_process_group": self.pipeline_group
+        })
+        self.config.pop("parameter_names", None)
+
+    def profile_campaign(self, campaign, get_optimizer_fn, get_inputs_fn, num_steps=2):
+        r"""Profile the memory usage of every configuration of a profiling campaign in this job,
+        re-partitioning the model (see :func:`repartition`) between configurations.
+        For each configuration, ``num_steps`` training steps are run and the memory usage is reported,
+        after which the end of the profiling run is logged the same way as when a job exits,
+        so the logs can be read by CAPSlog as if every configuration was a separate job.
+        If a configuration fails (e.g. out of memory), it is logged as failed and the error is raised.
+        With ``stop_at_steady_state``, the next configuration is profiled as soon as the memory usage is steady.
+        Must be called on all workers, and requires ``keep_cpu_model``.
+
+        :param campaign: the configurations, as read by :func:`utils.read_profiling_campaign`.
+        :type campaign: list
+        :param get_optimizer_fn: Function returning a new optimizer for the given model parameters.
+        :type get_optimizer_fn: function(parameters: iterable)
+        :param get_inputs_fn: Function returning the inputs for a training step, see :func:`step`.
+        :type get_inputs_fn: function()
+        :param num_steps: Number of training steps to profile each configuration for.
+        :type num_steps: int, optional
+        """
+        self.campaign_running = True
+        for config in campaign:
+            profiling_stages = config.get("profiling_stages")
+            stages = None if profiling_stages is None else [int(i) for i in profiling_stages.split(',')]
+            if utils.parse_stage_to_cut(config["stage_to_cut"]) != self.stage_to_cut or \
+                    stages != self.model.profiling_stages:
+                self.repartition(config["stage_to_cut"], profiling_stages)
+
+            try:
+                self.set_optimizer(get_optimizer_fn(self.parameters()))
+                self.reset_steady_state()
+                for _ in range(num_steps):
+                    self.zero_grad()
+                    self.step(get_inputs_fn())
+                    self.optimizer.step()
+                    if self.steady_state:
+                        break
+            except Exception as e:
+                # a failed worker ends the job, like a failed profiling run
+                print("Process done with return code 1", flush=True, force=True)
+                utils.write_telemetry("done", rank=self.rank, returncode=1, n_expected=1)
+                raise e
+
+            # all memory is reported before the next configuration is logged
+            dist.barrier()
+            if self.rank == 0:
+                print("Process done with return code 0", flush=True, force=True)
+                utils.write_telemetry("done", rank=self.rank, returncode=0, n_expected=1)
+            dist.barrier()
+        self.campaign_running = False
+
+    def reset_steady_state(self):
+        self.max_allocated_peak = 0
+        self.steps_without_new_peak = 0
+        self.steady_state = False
+
+    def update_steady_state(self, allocated_peak):
+        """ the memory usage is steady once no worker had a new peak for steady_state_steps steps """
+        if allocated_peak > self.max_allocated_peak:
+            self.max_allocated_peak = allocated_peak
+            self.steps_without_new_peak = 0
+        else:
+            self.steps_without_new_peak += 1
+
+        # every worker that is not steady yet adds one
+        device = self.device if dist.get_backend() == "nccl" else torch.device("cpu")
+        not_steady = torch.tensor([0 if self.steps_without_new_peak >= steady_state_steps else 1], device=device)
+        dist.all_reduce(not_steady)
+        self.steady_state = not_steady.item() == 0
+
+    def end_profiling_run(self):
+        dist.barrier()
+        if self.rank == 0:
+            print("Memory usage steady after {} iterations, ending profiling run".format(self.iteration),
+                  flush=True, force=True)
+        sys.exit(0)
+
     def init_communication(self):
         rank_within_stage = self.rank_within_stage
         self.send_rank = None; self.receive_rank = None
@@ -312,7 +472,17 @@ class Varuna(Module):
         batch_time = time.time() - batch_time        
         self.iteration += 1
         self.current_step += 1
-        utils.report_memory('after {} iterations'.format(self.iteration), self.rank)
+        peaks = None
+        if self.boundary_snapshots is not None:
+            snapshots, peaks = self.boundary_snapshots.pop()
+            utils.write_telemetry("boundaries", rank=self.rank, stage=self.stage, iteration=self.iteration,
+                                  snapshots=snapshots)
+        allocated_peak, _ = utils.report_memory('after {} iterations'.format(self.iteration), self.rank,
+                                                self.iteration, peaks)
+        if self.stop_at_steady_state:
+            self.update_steady_state(allocated_peak)
+            if self.steady_state and not self.campaign_running:
+                self.end_profiling_run()
         
         # if self.current_step <= 5:
         #     message = "slowcheck {} {} {} {}".\